@@ -0,0 +1,117 @@
+"""Микробенчмарк: старая цепочка any(word in message) против FallbackEngine/KeywordMatcher.
+Цепочка выходит на первой подстроке ("hi" в "thinking"), поэтому на таких сообщениях она быстрее,
+но с неверным интентом; колонка legacy -> matcher показывает, где ответы расходятся.
+
+Запуск из корня репозитория:
+    python benchmarks/bench_fallback.py
+"""
+import os
+import re
+import sys
+import tempfile
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+os.chdir(tempfile.mkdtemp())  # bot при импорте открывает bot_data.json в текущей папке
+
+import bot
+
+MESSAGES = [
+    "hi",
+    "ok",
+    "what are you doing today my dear?",
+    "thank you so much, that was really sweet",
+    "i was thinking about going to the store later tonight, maybe you want to come along with me",
+    "tell me a long story about dragons, knights and a princess who saves everyone",
+]
+USERNAMES = ["", "alex_99", "natalie", "cool_gamer_2000"]
+RUNS = 20000
+
+
+def legacy_intent(user_message):
+    """Старая лестница проверок (только классификация, без текстов ответов)"""
+    message_lower = user_message.lower().strip()
+    if any(phrase in message_lower for phrase in ['name colors', 'say colors', 'colors game', 'list colors']):
+        return 'colors_game'
+    elif any(phrase in message_lower for phrase in ['count numbers', 'say numbers', 'count to', 'let\'s count']):
+        return 'count_game'
+    elif any(word in message_lower for word in ['hi', 'hello', 'hey', 'sup', 'what\'s up']):
+        return 'greeting'
+    elif any(word in message_lower for word in ['bye', 'goodbye', 'see you', 'night', 'sleep']):
+        return 'bye'
+    elif any(word in message_lower for word in ['how are you', 'how you doing', 'what\'s up', 'how do you feel']):
+        return 'how_are_you'
+    elif any(word in message_lower for word in ['what are you doing', 'what you up to', 'whatcha doing']):
+        return 'doing'
+    elif any(word in message_lower for word in ['your name', 'who are you', 'remind me', 'my name']):
+        return 'name'
+    elif any(word in message_lower for word in ['beautiful', 'smart', 'awesome', 'like you', 'love you', 'cute']):
+        return 'compliment'
+    elif '?' in user_message or any(word in message_lower for word in ['why', 'how', 'what', 'when', 'where']):
+        return 'question'
+    elif any(word in message_lower for word in ['yes', 'yeah', 'ok', 'okay', 'sure', 'alright']):
+        return 'agree'
+    elif any(word in message_lower for word in ['no', 'nope', 'not really', 'don\'t want']):
+        return 'refuse'
+    elif any(word in message_lower for word in ['thank you', 'thanks', 'appreciate']):
+        return 'thanks'
+    elif any(word in message_lower for word in ['what', 'huh', 'don\'t understand', 'confused']):
+        return 'confused'
+    elif any(phrase in message_lower for phrase in ['name letters', 'alphabet game', 'say letters', 'alphabet']):
+        return 'alphabet_game'
+    elif any(word in message_lower for word in ['game', 'play', 'fun', 'bored']):
+        return 'game'
+    return None
+
+
+def matcher_intent(user_message):
+    return bot.FALLBACK_ENGINE.classify(user_message)
+
+
+def engine_response(user_message):
+    return bot.get_smart_fallback(user_message, "friend", bot.RELATIONSHIP_LEVELS[1], "Bob")
+
+
+def legacy_gender(user_message, username=""):
+    male_names = ['alex', 'max', 'mike', 'john', 'david', 'chris', 'andrew', 'daniel']
+    female_names = ['anna', 'maria', 'sophia', 'emma', 'olivia', 'lily', 'natalie']
+    if username:
+        username_lower = username.lower()
+        for name in male_names:
+            if name in username_lower:
+                return 'male'
+        for name in female_names:
+            if name in username_lower:
+                return 'female'
+    message_lower = user_message.lower()
+    male_patterns = [r'\bbro\b', r'\bdude\b', r'\bman\b', r'\bbuddy\b']
+    female_patterns = [r'\bgirl\b', r'\bsis\b', r'\bqueen\b']
+    male_score = sum(1 for pattern in male_patterns if re.search(pattern, message_lower))
+    female_score = sum(1 for pattern in female_patterns if re.search(pattern, message_lower))
+    if male_score > female_score:
+        return 'male'
+    elif female_score > male_score:
+        return 'female'
+    return 'unknown'
+
+
+def per_call_us(func, *args):
+    return timeit.timeit(lambda: func(*args), number=RUNS) / RUNS * 1e6
+
+
+def main():
+    print(f"{'message':<45} {'legacy us':>10} {'matcher us':>11} {'reply us':>9}  legacy -> matcher")
+    for message in MESSAGES:
+        print(f"{message[:44]:<45} {per_call_us(legacy_intent, message):>10.2f} "
+              f"{per_call_us(matcher_intent, message):>11.2f} {per_call_us(engine_response, message):>9.2f}  "
+              f"{legacy_intent(message)} -> {matcher_intent(message)}")
+
+    print(f"\n{'gender (message, username)':<45} {'legacy us':>10} {'matcher us':>11}")
+    for message, username in zip(MESSAGES, USERNAMES * 2):
+        label = f"{message[:24]} / {username or '-'}"
+        print(f"{label:<45} {per_call_us(legacy_gender, message, username):>10.2f} "
+              f"{per_call_us(bot.detect_user_gender, message, username):>11.2f}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,140 @@
+"""Бенчмарк снимка: старый JSON (indent=2) против компактного JSON и ColumnarSnapshot.
+Загрузка меряется целиком, как в load_data: чтение файла + записи пользователей в памяти.
+
+Запуск из корня репозитория (по умолчанию 10k, 100k и 1M синтетических пользователей):
+    python benchmarks/bench_snapshot.py
+    python benchmarks/bench_snapshot.py 10000 100000
+"""
+import contextlib
+import datetime
+import io
+import json
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+os.chdir(tempfile.mkdtemp())  # bot при импорте открывает bot_data.json в текущей папке
+
+import bot
+
+SIZES = [10000, 100000, 1000000]
+TURNS = 2  # Реплик контекста на пользователя (в боте до MAX_CONTEXT_LENGTH)
+BUTTONS = ['stats', 'menu', 'level', 'achievements', 'premium']
+
+
+def synthetic_data(users):
+    """Снимок в том же виде, что пишет SimpleDatabase.write_snapshot"""
+    start = datetime.datetime(2025, 1, 1)
+    data = {section: {} for section, _ in bot.SimpleDatabase.SECTIONS}
+    for index in range(users):
+        user_id = str(100000000 + index)
+        first_seen = start + datetime.timedelta(seconds=index * 7, microseconds=index % 999983)
+        last_seen = (first_seen + datetime.timedelta(hours=index % 500)).isoformat()
+        data['user_stats'][user_id] = {
+            'message_count': index % 700,
+            'first_seen': first_seen.isoformat(),
+            'last_seen': last_seen,
+            'current_level': 1 + index % 4,
+            'waiting_feedback': False
+        }
+        data['user_gender'][user_id] = ('unknown', 'male', 'female')[index % 3]
+        data['user_context'][user_id] = [
+            {'user': f"hey luna, message {index}-{turn}", 'bot': "Hi there! 💖 How's your day going?", 'time': last_seen}
+            for turn in range(TURNS)
+        ]
+        if index % 50 == 0:
+            data['premium_users'][user_id] = {
+                'premium_type': 'basic',
+                'activated': first_seen.isoformat(),
+                'expires': (first_seen + datetime.timedelta(days=30)).isoformat(),
+                'features': ['unlimited_messages', 'priority_access', 'extended_memory', 'ad_free']
+            }
+        progress = {
+            'messages_sent': index % 700,
+            'buttons_used': index % 30,
+            'different_buttons': BUTTONS[:index % len(BUTTONS)],
+            'levels_reached': 1 + index % 4,
+            'days_active': 1
+        }
+        data['user_achievements'][user_id] = {'unlocked': unlocked_for(progress), 'progress': progress}
+    data.update(last_save=start.isoformat(), total_users=users, save_type='regular')
+    return data
+
+
+def unlocked_for(progress):
+    """Настоящие id из ACHIEVEMENTS, открытые по тем же правилам, что в боте"""
+    unlocked = []
+    for achievement_id, achievement in bot.ACHIEVEMENTS.items():
+        value = progress[achievement['type']]
+        if (len(value) if isinstance(value, list) else value) >= achievement['goal']:
+            unlocked.append(achievement_id)
+    return unlocked
+
+
+def legacy_save(data, path):
+    with open(path, 'w', encoding='utf-8') as f:
+        f.write(json.dumps(data, ensure_ascii=False, indent=2))
+
+
+def legacy_load(path):
+    with open(path, 'r', encoding='utf-8') as f:
+        bot.db.load_from_data(json.load(f))
+
+
+def snapshot_save(fmt):
+    def save(data, path):
+        bot.db.data_file, bot.db.backup_file = path, path + '.backup'
+        bot.db.write_snapshot_file(data, fmt)
+    return save
+
+
+def snapshot_load(path):
+    bot.db.data_file, bot.db.backup_file = path, path + '.backup'
+    with contextlib.redirect_stdout(io.StringIO()):
+        bot.db.load_from_data(bot.db.read_snapshot(records=True))
+
+
+def exported_state():
+    """Загруженное состояние обратно в JSON-вид - для проверки, что форматы дают одно и то же"""
+    return {
+        section: {user_id: bot.db.export_section(key, value) for user_id, value in getattr(bot.db, section).items()}
+        for section, key in bot.SimpleDatabase.SECTIONS
+    }
+
+
+FORMATS = [
+    ('json indent=2 (old)', legacy_save, legacy_load),
+    ('json + header', snapshot_save('json'), snapshot_load),
+    ('columnar', snapshot_save('columnar'), snapshot_load),
+]
+
+
+def timed(func, *args):
+    started = time.perf_counter()
+    result = func(*args)
+    return time.perf_counter() - started, result
+
+
+def main():
+    sizes = [int(arg) for arg in sys.argv[1:]] or SIZES
+    print(f"{'users':>9} {'format':<22} {'save s':>8} {'load s':>8} {'size MB':>9}  roundtrip")
+    for users in sizes:
+        data = synthetic_data(users)
+        expected = None
+        for name, save, load in FORMATS:
+            path = f"snapshot_{users}_{name.split()[0]}.bin"
+            save_time, _ = timed(save, data, path)
+            load_time, _ = timed(load, path)
+            size_mb = os.path.getsize(path) / 1024 / 1024
+            loaded = exported_state()
+            expected = expected or loaded  # Эталон - загрузка старого JSON
+            print(f"{users:>9} {name:<22} {save_time:>8.2f} {load_time:>8.2f} {size_mb:>9.1f}  {loaded == expected}")
+            os.remove(path)
+            del loaded
+        del data, expected
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,55 @@
+"""Память на пользователя: вложенные dict (как раньше лежали в SimpleDatabase) против записей на __slots__.
+
+Запуск из корня репозитория:
+    python benchmarks/bench_user_memory.py
+    python benchmarks/bench_user_memory.py 100000
+"""
+import gc
+import json
+import sys
+import tracemalloc
+
+from bench_snapshot import bot, synthetic_data
+
+USERS = 20000
+
+
+def legacy_load(payload):
+    """Старый load_from_data: JSON как есть, different_buttons -> set"""
+    data = json.loads(payload)
+    for achievements in data['user_achievements'].values():
+        achievements['progress']['different_buttons'] = set(achievements['progress']['different_buttons'])
+    return {section: data[section] for section, _ in bot.SimpleDatabase.SECTIONS}
+
+
+def slots_load(payload):
+    db = bot.SimpleDatabase.__new__(bot.SimpleDatabase)  # Без файлов и потоков - только словари пользователей
+    db.load_from_data(json.loads(payload))
+    return {section: getattr(db, section) for section, _ in bot.SimpleDatabase.SECTIONS}
+
+
+def resident_bytes(load, payload):
+    gc.collect()
+    tracemalloc.start()
+    sections = load(payload)
+    gc.collect()
+    size = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    del sections
+    return size
+
+
+def main():
+    users = int(sys.argv[1]) if len(sys.argv) > 1 else USERS
+    data = synthetic_data(users)
+    # Неизвестные id уходят в unlocked_other (кортеж строк) - замер был бы не про битовую маску
+    unknown = {a for record in data['user_achievements'].values() for a in record['unlocked']} - set(bot.ACHIEVEMENT_BITS)
+    assert not unknown, f"synthetic achievement ids missing from ACHIEVEMENTS: {sorted(unknown)}"
+    payload = json.dumps(data, ensure_ascii=False)
+    print(f"{'layout':<12} {'bytes/user':>11}  ({users} users)")
+    for name, load in (('dicts (old)', legacy_load), ('__slots__', slots_load)):
+        print(f"{name:<12} {resident_bytes(load, payload) / users:>11.0f}")
+
+
+if __name__ == '__main__':
+    main()
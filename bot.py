@@ -2,17 +2,31 @@ import os
 import telebot
 from telebot import types
 import requests
+from requests.adapters import HTTPAdapter
 import random
 import datetime
 import time
 import re
 import json
+import sqlite3
 import threading
+import functools
+import heapq
+import hashlib
+import struct
+import bisect
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from collections import deque
+from array import array
 import atexit
-from flask import Flask
+from collections import OrderedDict
+from flask import Flask, request
+from waitress import serve
 from threading import Thread
 import signal
 import sys
+import asyncio
+import contextlib
 
 print("=== LUNA AI BOT - ULTRA STABLE EDITION ===")
 
@@ -20,23 +34,932 @@ print("=== LUNA AI BOT - ULTRA STABLE EDITION ===")
 API_TOKEN = os.environ.get('TELEGRAM_BOT_TOKEN')
 GROQ_API_KEY = os.environ.get('GROQ_API_KEY')
 FEEDBACK_CHAT_ID = os.environ.get('FEEDBACK_CHAT_ID', '')  # 🆕 Чат для фидбеков
+GROQ_API_URL = os.environ.get('GROQ_API_URL', 'https://api.groq.com/openai/v1/chat/completions')  # Любой OpenAI-совместимый /chat/completions
+AI_MODEL = os.environ.get('AI_MODEL', 'llama-3.1-8b-instant')
+AI_TARGETS_JSON = os.environ.get('AI_TARGETS', '')  # 🆕 [{"name", "url", "model", "api_key_env"}, ...] по приоритету
+AI_HEDGE_DELAY = float(os.environ.get('AI_HEDGE_DELAY', 2.0))  # Нет ответа за N секунд - дублируем запрос на следующую цель
+AI_RPM = int(os.environ.get('AI_RPM', 0))  # 🆕 Бюджет запросов в минуту (0 = без лимита; у бесплатного Groq - 30)
+AI_TPM = int(os.environ.get('AI_TPM', 0))  # Бюджет токенов в минуту (0 = без лимита)
+AI_QUEUE_SIZE = int(os.environ.get('AI_QUEUE_SIZE', 100))  # Больше ждущих - сразу fallback
+AI_QUEUE_WAIT = float(os.environ.get('AI_QUEUE_WAIT', 3))  # Дольше ждать бюджет не будем - fallback
+HTTP_POOL_SIZE = int(os.environ.get('HTTP_POOL_SIZE', 20))  # 🆕 Keep-alive соединений на хост
+HTTP_CONNECT_TIMEOUT = float(os.environ.get('HTTP_CONNECT_TIMEOUT', 3.05))
+HTTP_READ_TIMEOUT = float(os.environ.get('HTTP_READ_TIMEOUT', 15))
+BOT_WORKERS = int(os.environ.get('BOT_WORKERS', 8))  # 🆕 Потоков для обработки апдейтов
+GROQ_MAX_CONCURRENCY = int(os.environ.get('GROQ_MAX_CONCURRENCY', 4))  # 🆕 Одновременных запросов к каждой AI-цели (в AI_TARGETS - max_concurrency)
+RUNTIME = os.environ.get('RUNTIME', 'threads')  # 🆕 threads | asyncio (или флаг --asyncio)
+WEBHOOK_URL = os.environ.get('WEBHOOK_URL', '')  # 🆕 Публичный адрес сервиса - если задан, работаем через webhook
+WEBHOOK_SECRET = os.environ.get('WEBHOOK_SECRET', '')  # Проверяется в X-Telegram-Bot-Api-Secret-Token
+WEBHOOK_QUEUE_SIZE = int(os.environ.get('WEBHOOK_QUEUE_SIZE', 1000))  # Максимум апдейтов в очереди
+WEB_THREADS = int(os.environ.get('WEB_THREADS', 8))  # Потоков у waitress
+OUTBOX_RATE = float(os.environ.get('OUTBOX_RATE', 25))  # 🆕 Исходящих сообщений в секунду на всего бота (лимит Telegram ~30)
+OUTBOX_CHAT_INTERVAL = float(os.environ.get('OUTBOX_CHAT_INTERVAL', 1.0))  # Секунд между сообщениями в один чат
+OUTBOX_LINGER = float(os.environ.get('OUTBOX_LINGER', 0.05))  # Столько ждем соседние сообщения в тот же чат, чтобы склеить
+OUTBOX_SENDERS = int(os.environ.get('OUTBOX_SENDERS', 4))  # Потоков отправки: вызовы Bot API идут параллельно, один чат - по порядку
+RESPONSE_CACHE_SIZE = int(os.environ.get('RESPONSE_CACHE_SIZE', 0))  # 🆕 Кэш ответов AI (0 = выключен)
+RESPONSE_CACHE_TTL = int(os.environ.get('RESPONSE_CACHE_TTL', 3600))
+RESPONSE_CACHE_VARIANTS = int(os.environ.get('RESPONSE_CACHE_VARIANTS', 3))  # Вариантов ответа на ключ
+RESPONSE_CACHE_MAX_WORDS = int(os.environ.get('RESPONSE_CACHE_MAX_WORDS', 4))  # Кэшируем только короткие фразы
+AI_STREAMING = os.environ.get('AI_STREAMING', '0') == '1'  # 🆕 Стриминг ответа с правками сообщения
+STREAM_FIRST_CHUNK_CHARS = int(os.environ.get('STREAM_FIRST_CHUNK_CHARS', 20))  # Сколько символов ждать до первого сообщения
+STREAM_EDIT_INTERVAL = float(os.environ.get('STREAM_EDIT_INTERVAL', 1.0))  # Не чаще одной правки в N секунд
+STREAM_SEND_WAIT = float(os.environ.get('STREAM_SEND_WAIT', 10))  # Сколько ждать слот outbox для первого сообщения и финальной правки
+BREAKER_WINDOW = int(os.environ.get('BREAKER_WINDOW', 50))  # 🆕 Circuit breaker: сколько последних запросов к Groq учитываем
+BREAKER_MIN_CALLS = int(os.environ.get('BREAKER_MIN_CALLS', 10))  # Меньше запросов в окне - не размыкаем
+BREAKER_ERROR_RATE = float(os.environ.get('BREAKER_ERROR_RATE', 0.5))  # Доля ошибок, при которой размыкаем
+BREAKER_COOLDOWN = int(os.environ.get('BREAKER_COOLDOWN', 30))  # Секунд сразу в fallback перед пробными запросами
+BREAKER_PROBES = int(os.environ.get('BREAKER_PROBES', 2))  # Успешных проб для замыкания
+ADAPTIVE_TIMEOUT_MIN = float(os.environ.get('ADAPTIVE_TIMEOUT_MIN', 3))  # Нижняя граница read-таймаута
+ADAPTIVE_TIMEOUT_FACTOR = float(os.environ.get('ADAPTIVE_TIMEOUT_FACTOR', 2))  # Таймаут = p95 * factor (не больше HTTP_READ_TIMEOUT)
+STORAGE_MODE = os.environ.get('STORAGE_MODE', 'json')  # 🆕 json | wal | sqlite
+SQLITE_FILE = os.environ.get('SQLITE_FILE', 'bot_data.db')
+MAX_RESIDENT_USERS = int(os.environ.get('MAX_RESIDENT_USERS', 0))  # 🆕 LRU-лимит юзеров в памяти (0 = без лимита)
+WAL_COMPACT_RECORDS = int(os.environ.get('WAL_COMPACT_RECORDS', 5000))  # Компакция после N записей
+WAL_COMPACT_INTERVAL = int(os.environ.get('WAL_COMPACT_INTERVAL', 300))  # ...или раз в N секунд
+SAVE_INTERVAL = int(os.environ.get('SAVE_INTERVAL', 10))  # 🆕 Сброс изменений раз в N секунд
+SAVE_DIRTY_THRESHOLD = int(os.environ.get('SAVE_DIRTY_THRESHOLD', 100))  # ...или сразу при N измененных юзерах
+SNAPSHOT_MAGIC = b'LUNA-SNAPSHOT/1'  # 🆕 Заголовок снимка: поколение, формат, длина и sha256 содержимого
+SNAPSHOT_FORMAT = os.environ.get('SNAPSHOT_FORMAT', 'json')  # 🆕 json | columnar (компактный бинарный, см. ColumnarSnapshot)
+MAX_CONTEXT_LENGTH = int(os.environ.get('MAX_CONTEXT_LENGTH', 4))  # Реплик в памяти разговора
+PREMIUM_CONTEXT_LENGTH = int(os.environ.get('PREMIUM_CONTEXT_LENGTH', 8))  # 🆕 ...с premium-фичей extended_memory
+CONTEXT_SUMMARY = os.environ.get('CONTEXT_SUMMARY', 'local')  # 🆕 off | local | ai - сжатие старых реплик extended_memory в сводку
+SUMMARY_BATCH = int(os.environ.get('SUMMARY_BATCH', 4))  # Сколько самых старых реплик сворачивать за раз
+SUMMARY_MAX_CHARS = int(os.environ.get('SUMMARY_MAX_CHARS', 400))  # Потолок длины сводки в промпте
+PROMPT_CONTEXT_TOKENS = int(os.environ.get('PROMPT_CONTEXT_TOKENS', 500))  # 🆕 Бюджет токенов на контекст в промпте (лишние старые реплики отрезаются)
+USER_LOCK_STRIPES = int(os.environ.get('USER_LOCK_STRIPES', 64))  # 🆕 Локов на пользователей (user_id -> лок по хэшу)
+
+# ==================== 🆕 ОБЩИЙ HTTP КЛИЕНТ ====================
+# Одна сессия с пулом keep-alive соединений: TCP+TLS рукопожатие один раз, а не на каждое сообщение
+http_session = requests.Session()
+http_adapter = HTTPAdapter(pool_connections=10, pool_maxsize=HTTP_POOL_SIZE, max_retries=0)
+http_session.mount('https://', http_adapter)
+http_session.mount('http://', http_adapter)
+http_metrics = {'requests': 0}
+
+def count_http_request(response, *args, **kwargs):
+    http_metrics['requests'] += 1
+
+http_session.hooks['response'].append(count_http_request)
+
+def get_http_stats():
+    """Сколько запросов прошло и сколько из них переиспользовали соединение"""
+    pools = http_adapter.poolmanager.pools
+    new_connections = sum(pools[key].num_connections for key in pools.keys())
+    return {
+        'requests': http_metrics['requests'],
+        'new_connections': new_connections,
+        'reused_connections': max(http_metrics['requests'] - new_connections, 0),
+        'pool_size': HTTP_POOL_SIZE
+    }
+
+# Telegram API (в том числе пересылка фидбеков) ходит через тот же пул
+telebot.apihelper.session = http_session
 
 if not API_TOKEN:
     print("❌ TELEGRAM_BOT_TOKEN not found!")
     bot = None
 else:
-    bot = telebot.TeleBot(API_TOKEN)
+    # Апдейты раздает ChatDispatcher, поэтому встроенный пул потоков telebot не нужен
+    bot = telebot.TeleBot(API_TOKEN, threaded=False)
+
+# ==================== 🆕 SQLITE ХРАНИЛИЩЕ ====================
+class SqliteStorage:
+    """Один пользователь = одна строка, обновление трогает только ее"""
+    
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute('PRAGMA synchronous=NORMAL')
+        self.conn.executescript("""
+            CREATE TABLE IF NOT EXISTS users (
+                user_id TEXT PRIMARY KEY,
+                message_count INTEGER NOT NULL DEFAULT 0,
+                premium_expires TEXT,
+                stats TEXT,
+                gender TEXT,
+                context TEXT,
+                premium TEXT,
+                achievements TEXT,
+                summary TEXT
+            );
+            CREATE INDEX IF NOT EXISTS idx_users_message_count ON users(message_count);
+            CREATE INDEX IF NOT EXISTS idx_users_premium_expires ON users(premium_expires);
+            CREATE TABLE IF NOT EXISTS meta (
+                key TEXT PRIMARY KEY,
+                value TEXT
+            );
+        """)
+        columns = [row[1] for row in self.conn.execute('PRAGMA table_info(users)')]
+        if 'summary' not in columns:
+            # 🆕 База от прошлых версий - колонка сводки разговора
+            self.conn.execute('ALTER TABLE users ADD COLUMN summary TEXT')
+        self.conn.commit()
+    
+    def load_user(self, user_id):
+        """Читает одну строку и возвращает запись в формате WAL"""
+        with self.lock:
+            row = self.conn.execute(
+                'SELECT stats, gender, context, premium, achievements, summary FROM users WHERE user_id = ?',
+                (str(user_id),)
+            ).fetchone()
+        
+        if row is None:
+            return None
+        
+        stats, gender, context, premium, achievements, summary = row
+        return {
+            'u': str(user_id),
+            'stats': json.loads(stats) if stats else None,
+            'gender': gender,
+            'context': json.loads(context) if context else None,
+            'premium': json.loads(premium) if premium else None,
+            'achievements': json.loads(achievements) if achievements else None,
+            'summary': json.loads(summary) if summary else None
+        }
+    
+    def save_users(self, records, aggregates=None):
+        """UPSERT только измененных пользователей одной транзакцией (вместе со счетчиками)"""
+        rows = []
+        for record in records:
+            stats = record.get('stats')
+            premium = record.get('premium')
+            rows.append((
+                record['u'],
+                stats.get('message_count', 0) if stats else 0,
+                premium.get('expires', '9999') if premium else None,
+                json.dumps(stats, ensure_ascii=False) if stats is not None else None,
+                record.get('gender'),
+                json.dumps(record.get('context'), ensure_ascii=False) if record.get('context') is not None else None,
+                json.dumps(premium, ensure_ascii=False) if premium is not None else None,
+                json.dumps(record.get('achievements'), ensure_ascii=False) if record.get('achievements') is not None else None,
+                json.dumps(record.get('summary'), ensure_ascii=False) if record.get('summary') is not None else None
+            ))
+        
+        with self.lock:
+            with self.conn:
+                self.conn.executemany("""
+                    INSERT INTO users (user_id, message_count, premium_expires, stats, gender, context, premium, achievements, summary)
+                    VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+                    ON CONFLICT(user_id) DO UPDATE SET
+                        message_count = excluded.message_count,
+                        premium_expires = excluded.premium_expires,
+                        stats = excluded.stats,
+                        gender = excluded.gender,
+                        context = excluded.context,
+                        premium = excluded.premium,
+                        achievements = excluded.achievements,
+                        summary = excluded.summary
+                """, rows)
+                if aggregates is not None:
+                    self.conn.execute(
+                        'INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)',
+                        ('aggregates', json.dumps(aggregates))
+                    )
+    
+    def query_value(self, sql, params=()):
+        with self.lock:
+            return self.conn.execute(sql, params).fetchone()[0]
+    
+    def count_users(self):
+        return self.query_value('SELECT COUNT(*) FROM users WHERE stats IS NOT NULL')
+    
+    def total_messages(self):
+        # Покрывающий индекс по message_count - таблицу не читаем
+        return self.query_value('SELECT COALESCE(SUM(message_count), 0) FROM users INDEXED BY idx_users_message_count')
+    
+    def count_with_achievements(self):
+        return self.query_value('SELECT COUNT(*) FROM users WHERE achievements IS NOT NULL')
+    
+    def load_aggregates(self):
+        with self.lock:
+            row = self.conn.execute("SELECT value FROM meta WHERE key = 'aggregates'").fetchone()
+        return json.loads(row[0]) if row else None
+    
+    def compute_aggregates(self):
+        """Полный пересчет счетчиков - только если их еще нет в meta"""
+        with self.lock:
+            levels = self.conn.execute(
+                "SELECT json_extract(stats, '$.current_level'), COUNT(*) FROM users WHERE stats IS NOT NULL GROUP BY 1"
+            ).fetchall()
+        return {
+            'total_users': self.count_users(),
+            'total_messages': self.total_messages(),
+            'users_with_achievements': self.count_with_achievements(),
+            'levels': {str(level or 1): count for level, count in levels}
+        }
+    
+    def premium_expiries(self):
+        with self.lock:
+            return self.conn.execute('SELECT user_id, premium_expires FROM users WHERE premium_expires IS NOT NULL').fetchall()
+    
+    def all_user_ids(self):
+        with self.lock:
+            return [row[0] for row in self.conn.execute('SELECT user_id FROM users WHERE stats IS NOT NULL')]
+    
+    def close(self):
+        with self.lock:
+            self.conn.close()
+
+# ==================== 🆕 КОМПАКТНЫЙ СНИМОК ====================
+EPOCH = datetime.datetime(1970, 1, 1)
+MICROSECOND = datetime.timedelta(microseconds=1)
+
+def iso_to_micros(value):
+    """ISO-строка -> int микросекунд, только если обратное преобразование даст ту же строку"""
+    try:
+        moment = datetime.datetime.fromisoformat(value)
+    except ValueError:
+        return None
+    if moment.tzinfo is not None or moment.isoformat() != value:
+        return None
+    return (moment - EPOCH) // MICROSECOND
+
+def micros_to_iso(micros):
+    return (EPOCH + MICROSECOND * micros).isoformat()
+
+GENDERS = ('unknown', 'male', 'female')  # В памяти пол - индекс в этом кортеже
+GENDER_CODES = {gender: code for code, gender in enumerate(GENDERS)}
+
+class ColumnarSnapshot:
+    """Бинарный снимок без зависимостей: пользователи разложены по колонкам (int64-массивы,
+    строки через \\x00), ISO-время хранится как int микросекунд от эпохи.
+    Запись, не подходящая под схему, целиком уходит в JSON-хвост своей секции - формат без потерь.
+    decode(records=True) собирает сразу записи для памяти (UserStats и т.д.): время остается int,
+    ни одной ISO-строки при загрузке"""
+    SECTIONS = ('user_stats', 'user_gender', 'user_context', 'premium_users', 'user_achievements', 'user_summary')
+    SEP = '\x00'  # Между строками колонки
+    LIST_SEP = '\x1f'  # Между элементами списка внутри ячейки
+    ODD_GENDER = 255
+    # Поля записи: (путь, тип). Набор ключей каждого словаря должен совпадать со схемой
+    SCHEMAS = {
+        'user_stats': ((('message_count',), 'int'), (('first_seen',), 'ts'), (('last_seen',), 'ts'),
+                       (('current_level',), 'int'), (('waiting_feedback',), 'bool')),
+        'premium_users': ((('premium_type',), 'str'), (('activated',), 'ts'), (('expires',), 'ts'),
+                          (('features',), 'strlist')),
+        'user_achievements': ((('unlocked',), 'strlist'), (('progress', 'messages_sent'), 'int'),
+                              (('progress', 'buttons_used'), 'int'), (('progress', 'different_buttons'), 'strlist'),
+                              (('progress', 'levels_reached'), 'int'), (('progress', 'days_active'), 'int')),
+        'user_summary': ((('text',), 'str'), (('turns',), 'int'), (('updated',), 'ts'))
+    }
+    TURN_FIELDS = ((('user',), 'str'), (('bot',), 'str'), (('time',), 'ts'))
+    
+    @classmethod
+    def encode(cls, data):
+        user_ids = list(dict.fromkeys(user_id for section in cls.SECTIONS for user_id in data.get(section, {})))
+        if any(cls.SEP in user_id for user_id in user_ids):
+            raise ValueError("user id contains NUL")
+        positions = {user_id: index for index, user_id in enumerate(user_ids)}
+        meta = {key: value for key, value in data.items() if key not in cls.SECTIONS}
+        
+        blocks = [
+            ('meta', json.dumps(meta, ensure_ascii=False, separators=(',', ':')).encode('utf-8')),
+            ('users', struct.pack('<Q', len(user_ids))),
+            ('ids', cls.pack_column('str', user_ids))
+        ]
+        for section in cls.SECTIONS:
+            values = data.get(section, {})
+            blocks.append((f'{section}.rows', cls.pack_array('I', [positions[user_id] for user_id in values])))
+            odd = {}
+            
+            if section == 'user_gender':
+                codes = []
+                for index, gender in enumerate(values.values()):
+                    if gender in GENDER_CODES:
+                        codes.append(GENDER_CODES[gender])
+                    else:
+                        codes.append(cls.ODD_GENDER)
+                        odd[index] = gender
+                blocks.append(('user_gender.code', bytes(codes)))
+            elif section == 'user_context':
+                # Реплики всех пользователей подряд + число реплик у каждого
+                contexts = list(values.values())
+                counts = [len(context) if type(context) is list else 0 for context in contexts]
+                owners = [index for index, count in enumerate(counts) for _ in range(count)]
+                turns = [turn for context, count in zip(contexts, counts) if count for turn in context]
+                columns, bad_turns = cls.encode_records(cls.TURN_FIELDS, turns)
+                bad = {owners[turn] for turn in bad_turns}
+                bad.update(index for index, context in enumerate(contexts) if type(context) is not list)
+                odd = {index: contexts[index] for index in sorted(bad)}
+                blocks.append(('user_context.turns', cls.pack_array('I', counts)))
+                blocks.extend(cls.pack_records(section, cls.TURN_FIELDS, columns))
+            else:
+                records = list(values.values())
+                columns, bad = cls.encode_records(cls.SCHEMAS[section], records)
+                odd = {index: records[index] for index in sorted(bad)}
+                blocks.extend(cls.pack_records(section, cls.SCHEMAS[section], columns))
+            
+            blocks.append((f'{section}.odd', json.dumps(odd, ensure_ascii=False, separators=(',', ':')).encode('utf-8')))
+        
+        return cls.pack_blocks(blocks)
+    
+    @classmethod
+    def decode(cls, payload, records=False):
+        """JSON-вид снимка или (records=True) секции сразу в представлении SimpleDatabase.
+        Записи из JSON-хвоста остаются dict - их приводит import_section"""
+        blocks = cls.unpack_blocks(payload)
+        data = json.loads(blocks['meta'])
+        user_ids = cls.unpack_column('str', blocks['ids'], struct.unpack('<Q', blocks['users'])[0])
+        record_types = {'user_stats': UserStats, 'premium_users': PremiumRecord,
+                        'user_summary': ConversationSummary, 'user_context': ContextTurn}
+        
+        for section in cls.SECTIONS:
+            if f'{section}.rows' not in blocks:
+                continue  # Секция появилась позже, чем записан файл
+            rows = cls.unpack_array('I', blocks[f'{section}.rows'])
+            record_type = record_types.get(section) if records else None
+            if section == 'user_gender':
+                codes = list(blocks['user_gender.code'])  # В памяти пол и так хранится кодом
+                values = codes if records else [GENDERS[code] if code < len(GENDERS) else None for code in codes]
+            elif section == 'user_context':
+                counts = cls.unpack_array('I', blocks['user_context.turns'])
+                turns = cls.unpack_records(blocks, section, cls.TURN_FIELDS, sum(counts), record_type)
+                values, offset = [], 0
+                for count in counts:
+                    values.append(turns[offset:offset + count])
+                    offset += count
+                if records:
+                    # Буфер с емкостью по числу реплик - как ConversationMemory(turns), без __init__ на каждого
+                    values = cls.build_slot_records(ConversationMemory, ['turns', 'start', 'capacity', 'text'], [
+                        values, [0] * len(values), [max(len(turns), MAX_CONTEXT_LENGTH) for turns in values], [None] * len(values)
+                    ], len(values))
+            elif section == 'user_achievements' and records:
+                values = cls.unpack_achievements(blocks, len(rows))
+            else:
+                values = cls.unpack_records(blocks, section, cls.SCHEMAS[section], len(rows), record_type)
+            
+            for index, value in json.loads(blocks[f'{section}.odd']).items():
+                values[int(index)] = value
+            data[section] = {user_ids[row]: value for row, value in zip(rows, values)}
+        
+        return data
+    
+    @classmethod
+    def encode_records(cls, fields, records):
+        """Колонки ячеек по полям схемы и номера записей, которые в схему не ложатся.
+        Проверки идут по колонкам целиком - без цикла Python по каждому полю каждой записи"""
+        columns = [cls.to_cells(kind, cls.pluck(records, path)) for path, kind in fields]
+        
+        # Все поля на месте + столько же ключей на каждом уровне = лишних ключей нет
+        bad = set()
+        for prefix, size in cls.shape(fields).items():
+            nodes = cls.pluck(records, prefix)
+            bad.update(index for index, node in enumerate(nodes) if type(node) is not dict or len(node) != size)
+        for column in columns:
+            bad.update(index for index, cell in enumerate(column) if cell is None)
+        
+        for (path, kind), column in zip(fields, columns):
+            default = 0 if kind in ('int', 'ts', 'bool') else ''
+            for index in bad:
+                column[index] = default
+        return columns, bad
+    
+    @staticmethod
+    def shape(fields):
+        """{префикс пути: число ключей в словаре на этом уровне}"""
+        levels = {}
+        for path, _ in fields:
+            for depth in range(len(path)):
+                levels.setdefault(path[:depth], set()).add(path[depth])
+        return {prefix: len(keys) for prefix, keys in levels.items()}
+    
+    @staticmethod
+    def pluck(records, path):
+        nodes = records
+        for key in path:
+            nodes = [node.get(key) if type(node) is dict else None for node in nodes]
+        return nodes
+    
+    @classmethod
+    def to_cells(cls, kind, values):
+        """Значения -> ячейки колонки; None - значение не подходит под тип"""
+        if kind == 'int':
+            return [value if type(value) is int and -2 ** 63 <= value < 2 ** 63 else None for value in values]
+        if kind == 'bool':
+            return [int(value) if type(value) is bool else None for value in values]
+        if kind == 'ts':
+            return [iso_to_micros(value) if type(value) is str else None for value in values]
+        if kind == 'str':
+            return [value if type(value) is str and cls.SEP not in value else None for value in values]
+        return [cls.join_list(value) if type(value) is list else None for value in values]
+    
+    @classmethod
+    def join_list(cls, items):
+        for item in items:
+            if type(item) is not str or not item or cls.SEP in item or cls.LIST_SEP in item:
+                return None
+        return cls.LIST_SEP.join(items)
+    
+    @classmethod
+    def pack_records(cls, section, fields, columns):
+        return [(f"{section}.{'.'.join(path)}", cls.pack_column(kind, column)) for (path, kind), column in zip(fields, columns)]
+    
+    @classmethod
+    def unpack_records(cls, blocks, section, fields, count, record_type=None):
+        if record_type is None:
+            columns = [cls.unpack_column(kind, blocks[f"{section}.{'.'.join(path)}"], count) for path, kind in fields]
+            return cls.build_records(fields, columns)
+        # В записях время - int микросекунд, как в колонке
+        columns = [cls.unpack_column('int' if kind == 'ts' else kind, blocks[f"{section}.{'.'.join(path)}"], count)
+                   for path, kind in fields]
+        return cls.build_slot_records(record_type, [path[-1] for path, _ in fields], columns, count)
+    
+    @classmethod
+    def unpack_achievements(cls, blocks, count):
+        """UserAchievements без промежуточных dict: маска unlocked считается один раз на каждый
+        встретившийся набор достижений (у большинства пользователей наборы совпадают)"""
+        column = lambda name, kind: cls.unpack_column(kind, blocks[f'user_achievements.{name}'], count)
+        progress_fields = [path[-1] for path, _ in cls.SCHEMAS['user_achievements'][1:]]
+        progress_columns = [
+            list(map(set, column(f'progress.{name}', 'strlist'))) if name == 'different_buttons' else column(f'progress.{name}', 'int')
+            for name in progress_fields
+        ]
+        progress = cls.build_slot_records(AchievementProgress, progress_fields, progress_columns, count)
+        
+        unlocked = column('unlocked', 'str')
+        states = {}
+        for cell in set(unlocked):
+            holder = UserAchievements()
+            holder.unlocked = cell.split(cls.LIST_SEP) if cell else []
+            states[cell] = (holder.unlocked_mask, holder.unlocked_other)
+        masks = [states[cell][0] for cell in unlocked]
+        others = [states[cell][1] for cell in unlocked]
+        return cls.build_slot_records(UserAchievements, ['unlocked_mask', 'unlocked_other', '_progress'],
+                                      [masks, others, progress], count)
+    
+    @staticmethod
+    def build_slot_records(record_type, names, columns, count):
+        """count пустых записей и заполнение слотов колонками: map по дескрипторам слотов,
+        без цикла Python по полям каждой записи"""
+        records = list(map(object.__new__, [record_type] * count))
+        if issubclass(record_type, SlotRecord):
+            deque(map(SlotRecord._extra.__set__, records, [None] * count), maxlen=0)
+        for name, values in zip(names, columns):
+            deque(map(getattr(record_type, name).__set__, records, values), maxlen=0)
+        return records
+    
+    @classmethod
+    def build_records(cls, fields, columns, prefix=()):
+        """Собирает словари из колонок (вложенные уровни - рекурсивно), через zip без цикла по полям"""
+        keys, values = [], []
+        for (path, _), column in zip(fields, columns):
+            if path[:len(prefix)] != prefix or path[len(prefix)] in keys:
+                continue
+            keys.append(path[len(prefix)])
+            values.append(column if len(path) == len(prefix) + 1 else cls.build_records(fields, columns, prefix + (path[len(prefix)],)))
+        return [dict(zip(keys, row)) for row in zip(*values)]
+    
+    @classmethod
+    def pack_column(cls, kind, cells):
+        if kind in ('int', 'ts'):
+            return cls.pack_array('q', cells)
+        if kind == 'bool':
+            return bytes(cells)
+        return cls.SEP.join(cells).encode('utf-8')
+    
+    @classmethod
+    def unpack_column(cls, kind, blob, count):
+        if kind == 'int':
+            return cls.unpack_array('q', blob)
+        if kind == 'ts':
+            return [micros_to_iso(micros) for micros in cls.unpack_array('q', blob)]
+        if kind == 'bool':
+            return [cell == 1 for cell in blob]
+        cells = blob.decode('utf-8').split(cls.SEP) if count else []
+        if kind == 'strlist':
+            return [cell.split(cls.LIST_SEP) if cell else [] for cell in cells]
+        return cells
+    
+    @staticmethod
+    def pack_array(typecode, values):
+        packed = array(typecode, values)
+        if sys.byteorder != 'little':
+            packed.byteswap()
+        return packed.tobytes()
+    
+    @staticmethod
+    def unpack_array(typecode, blob):
+        values = array(typecode)
+        values.frombytes(blob)
+        if sys.byteorder != 'little':
+            values.byteswap()
+        return values.tolist()
+    
+    @staticmethod
+    def pack_blocks(blocks):
+        """Блок = <длина имени u16><длина данных u64><имя><данные>"""
+        parts = []
+        for name, blob in blocks:
+            name_bytes = name.encode('ascii')
+            parts.append(struct.pack('<HQ', len(name_bytes), len(blob)))
+            parts.append(name_bytes)
+            parts.append(blob)
+        return b''.join(parts)
+    
+    @staticmethod
+    def unpack_blocks(payload):
+        blocks = {}
+        offset = 0
+        while offset < len(payload):
+            name_length, blob_length = struct.unpack_from('<HQ', payload, offset)
+            offset += 10
+            name = payload[offset:offset + name_length].decode('ascii')
+            offset += name_length
+            blocks[name] = payload[offset:offset + blob_length]
+            offset += blob_length
+        return blocks
+
+# ==================== 🆕 КОМПАКТНЫЕ ЗАПИСИ ПОЛЬЗОВАТЕЛЕЙ ====================
+def encode_gender(gender):
+    return GENDER_CODES.get(gender, gender)
+
+def decode_gender(code):
+    return GENDERS[code] if type(code) is int else code
+
+class SlotRecord:
+    """Запись пользователя на __slots__ вместо dict. Снаружи - тот же dict-API
+    (record['key'], .get, dict(record), ==), внутри - слоты, время как int микросекунд.
+    Незаданный слот = отсутствующий ключ, чужие ключи лежат в _extra"""
+    __slots__ = ('_extra',)
+    FIELDS = ()
+    TIMESTAMPS = ()
+    
+    def __init__(self, data=()):
+        self._extra = None
+        for key, value in dict(data).items():
+            self[key] = value
+    
+    @classmethod
+    def from_value(cls, value):
+        """dict из JSON или старого кода -> запись; готовая запись отдается как есть"""
+        return value if isinstance(value, cls) else cls(value)
+    
+    def __getitem__(self, key):
+        if key in self.FIELDS:
+            try:
+                value = getattr(self, key)
+            except AttributeError:
+                raise KeyError(key) from None
+            return micros_to_iso(value) if type(value) is int and key in self.TIMESTAMPS else value
+        if self._extra is not None and key in self._extra:
+            return self._extra[key]
+        raise KeyError(key)
+    
+    def __setitem__(self, key, value):
+        if key not in self.FIELDS:
+            if self._extra is None:
+                self._extra = {}
+            self._extra[key] = value
+            return
+        if type(value) is str and key in self.TIMESTAMPS:
+            micros = iso_to_micros(value)
+            value = value if micros is None else micros  # Нестандартную строку храним как есть
+        setattr(self, key, value)
+    
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+    
+    def keys(self):
+        keys = [key for key in self.FIELDS if hasattr(self, key)]
+        if self._extra:
+            keys.extend(self._extra)
+        return keys
+    
+    def __contains__(self, key):
+        return key in self.keys()
+    
+    def __iter__(self):
+        return iter(self.keys())
+    
+    def __len__(self):
+        return len(self.keys())
+    
+    def items(self):
+        return [(key, self[key]) for key in self.keys()]
+    
+    def to_dict(self):
+        return dict(self.items())
+    
+    def copy(self):
+        clone = self.__class__.__new__(self.__class__)
+        clone._extra = dict(self._extra) if self._extra else None
+        for key in self.FIELDS:
+            if hasattr(self, key):
+                setattr(clone, key, getattr(self, key))
+        return clone
+    
+    def state(self):
+        """Сырые значения слотов - для быстрого сравнения записей одного типа"""
+        return [getattr(self, key, None) for key in self.FIELDS] + [self._extra or None]
+    
+    def __eq__(self, other):
+        if type(other) is type(self):
+            return self.state() == other.state()
+        if isinstance(other, (SlotRecord, dict)):
+            return self.to_dict() == dict(other)
+        return NotImplemented
+    
+    __hash__ = None
+    
+    def __repr__(self):
+        return f"{type(self).__name__}({self.to_dict()!r})"
+
+class UserStats(SlotRecord):
+    __slots__ = FIELDS = ('message_count', 'first_seen', 'last_seen', 'current_level', 'waiting_feedback')
+    TIMESTAMPS = ('first_seen', 'last_seen')
+
+class ContextTurn(SlotRecord):
+    __slots__ = FIELDS = ('user', 'bot', 'time')
+    TIMESTAMPS = ('time',)
+
+class PremiumRecord(SlotRecord):
+    __slots__ = FIELDS = ('premium_type', 'activated', 'expires', 'features')
+    TIMESTAMPS = ('activated', 'expires')
+
+class ConversationSummary(SlotRecord):
+    """🆕 Сводка свернутых старых реплик: текст, сколько реплик в нее вошло, когда обновлена"""
+    __slots__ = FIELDS = ('text', 'turns', 'updated')
+    TIMESTAMPS = ('updated',)
+    
+    def render(self):
+        return f"Earlier in your conversation: {self['text']}\n" if self.get('text') else ""
+
+class AchievementProgress(SlotRecord):
+    __slots__ = FIELDS = ('messages_sent', 'buttons_used', 'different_buttons', 'levels_reached', 'days_active')
+    
+    def copy(self):
+        clone = super().copy()
+        if hasattr(self, 'different_buttons'):
+            clone.different_buttons = set(self.different_buttons)
+        return clone
+
+class UnlockedAchievements:
+    """Список открытых достижений поверх битовой маски владельца (порядок - как в ACHIEVEMENTS).
+    Id, которых нет в ACHIEVEMENTS, хранятся отдельным кортежем"""
+    __slots__ = ('owner',)
+    
+    def __init__(self, owner):
+        self.owner = owner
+    
+    def __contains__(self, achievement_id):
+        bit = ACHIEVEMENT_BITS.get(achievement_id)
+        if bit is None:
+            return achievement_id in self.owner.unlocked_other
+        return bool(self.owner.unlocked_mask & bit)
+    
+    def append(self, achievement_id):
+        if achievement_id in self:
+            return
+        bit = ACHIEVEMENT_BITS.get(achievement_id)
+        if bit is None:
+            self.owner.unlocked_other += (achievement_id,)
+        else:
+            self.owner.unlocked_mask |= bit
+    
+    def __iter__(self):
+        mask = self.owner.unlocked_mask
+        for achievement_id, bit in ACHIEVEMENT_BITS.items():
+            if mask & bit:
+                yield achievement_id
+        yield from self.owner.unlocked_other
+    
+    def __len__(self):
+        return self.owner.unlocked_mask.bit_count() + len(self.owner.unlocked_other)
+    
+    def copy(self):
+        return list(self)
+    
+    def __eq__(self, other):
+        if isinstance(other, (UnlockedAchievements, list, tuple)):
+            return list(self) == list(other)
+        return NotImplemented
+    
+    __hash__ = None
+    
+    def __repr__(self):
+        return repr(list(self))
+
+class UserAchievements(SlotRecord):
+    """{'unlocked': [...], 'progress': {...}} - unlocked хранится как битовая маска"""
+    __slots__ = ('unlocked_mask', 'unlocked_other', '_progress')
+    FIELDS = ('unlocked', 'progress')
+    
+    def __init__(self, data=()):
+        self.unlocked_mask = 0
+        self.unlocked_other = ()
+        super().__init__(data)
+    
+    @property
+    def unlocked(self):
+        return UnlockedAchievements(self)
+    
+    @unlocked.setter
+    def unlocked(self, achievement_ids):
+        achievement_ids = list(achievement_ids)
+        self.unlocked_mask = 0
+        self.unlocked_other = ()
+        for achievement_id in achievement_ids:
+            self.unlocked.append(achievement_id)
+    
+    @property
+    def progress(self):
+        return self._progress
+    
+    @progress.setter
+    def progress(self, value):
+        self._progress = AchievementProgress.from_value(value)
+    
+    def copy(self):
+        clone = self.__class__.__new__(self.__class__)
+        clone._extra = dict(self._extra) if self._extra else None
+        clone.unlocked_mask = self.unlocked_mask
+        clone.unlocked_other = self.unlocked_other
+        if hasattr(self, '_progress'):
+            clone._progress = self._progress.copy()
+        return clone
+    
+    def state(self):
+        return [self.unlocked_mask, self.unlocked_other, getattr(self, '_progress', None), self._extra or None]
+
+class ConversationMemory:
+    """🆕 Кольцевой буфер последних реплик (список фиксированной емкости + индекс самой старой)
+    и готовый блок "Recent conversation" для промпта. Блок собирается при первом чтении,
+    дальше на каждую реплику правится на месте: минус вытесненная, плюс новая"""
+    __slots__ = ('turns', 'start', 'capacity', 'text')
+    HEADER = "Recent conversation:\n"
+    FOOTER = "Continue naturally!\n"
+    
+    def __init__(self, turns=(), capacity=None):
+        self.turns = list(turns)
+        self.start = 0
+        self.capacity = capacity or max(len(self.turns), MAX_CONTEXT_LENGTH)
+        del self.turns[:-self.capacity]
+        self.text = None
+    
+    @classmethod
+    def from_value(cls, value):
+        if isinstance(value, cls):
+            return value
+        return cls([ContextTurn.from_value(turn) for turn in value])
+    
+    def ordered(self):
+        return self.turns[self.start:] + self.turns[:self.start]
+    
+    def __iter__(self):
+        return iter(self.ordered())
+    
+    def __len__(self):
+        return len(self.turns)
+    
+    def __eq__(self, other):
+        if isinstance(other, (ConversationMemory, list)):
+            return self.ordered() == list(other)
+        return NotImplemented
+    
+    __hash__ = None
+    
+    def __repr__(self):
+        return f"ConversationMemory({self.ordered()!r}, capacity={self.capacity})"
+    
+    def copy(self):
+        clone = ConversationMemory.__new__(ConversationMemory)
+        clone.turns = list(self.turns)
+        clone.start = self.start
+        clone.capacity = self.capacity
+        clone.text = self.text
+        return clone
+    
+    @staticmethod
+    def render_turn(turn):
+        return f"User: {turn['user']}\nLuna: {turn['bot']}\n"
+    
+    def render(self):
+        if not self.turns:
+            return ""
+        if self.text is None:
+            self.text = self.HEADER + "".join(self.render_turn(turn) for turn in self.ordered()) + self.FOOTER
+        return self.text
+    
+    def push(self, turn, capacity):
+        """Добавляет реплику; смена тарифа (другая емкость) перестраивает буфер"""
+        capacity = max(capacity, 1)
+        if capacity != self.capacity:
+            self.turns = self.ordered()[-capacity:]
+            self.start = 0
+            self.capacity = capacity
+            self.text = None
+        
+        if len(self.turns) < self.capacity:
+            evicted = None
+            self.turns.append(turn)
+        else:
+            evicted = self.turns[self.start]
+            self.turns[self.start] = turn
+            self.start = (self.start + 1) % self.capacity
+        
+        if self.text is not None:
+            body_start = len(self.HEADER) + (len(self.render_turn(evicted)) if evicted is not None else 0)
+            self.text = self.HEADER + self.text[body_start:-len(self.FOOTER)] + self.render_turn(turn) + self.FOOTER
+    
+    def drop(self, turns):
+        """🆕 Убирает реплики, вошедшие в сводку (по идентичности - объекты реплик не меняются)"""
+        folded = {id(turn) for turn in turns}
+        kept = [turn for turn in self.ordered() if id(turn) not in folded]
+        if len(kept) != len(self.turns):
+            self.turns = kept
+            self.start = 0
+            self.text = None
 
 # ==================== СУПЕР-НАДЕЖНАЯ БАЗА ДАННЫХ ====================
+def synchronized(method):
+    """🆕 Метод базы выполняется под self.lock - хендлеры работают из разных потоков"""
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        with self.lock:
+            return method(self, *args, **kwargs)
+    return wrapper
+
+class UserRecord:
+    """🆕 Рабочая копия одного пользователя внутри db.user(): секции копируются при первом
+    обращении и подменяют оригиналы при выходе из with. Сохраненные объекты никогда
+    не меняются на месте (copy-on-write), поэтому снимок видит только целые версии"""
+    SECTIONS = ('stats', 'gender', 'context', 'premium', 'achievements', 'summary')
+    EMPTY = {'gender': 'unknown', 'context': [], 'premium': None, 'summary': None}  # Такие значения не сохраняем
+    
+    def __init__(self, db, user_id_str):
+        self._db = db
+        self._originals = {}
+        self.user_id = user_id_str
+    
+    def __getattr__(self, name):
+        # Вызывается только для еще не загруженных секций
+        if name not in self.SECTIONS:
+            raise AttributeError(name)
+        original, value = self._db.read_section(self.user_id, name)
+        self._originals[name] = original
+        setattr(self, name, value)
+        return value
+    
+    def changes(self):
+        """(секция, новое значение) для всех измененных секций"""
+        for name in self.SECTIONS:
+            if name not in self.__dict__:
+                continue
+            value = self.__dict__[name]
+            if name in self._originals:
+                original = self._originals[name]
+                if value == original or (original is None and name in self.EMPTY and value == self.EMPTY[name]):
+                    continue
+            yield name, value
+
 class SimpleDatabase:
+    # Словарь в памяти / ключ JSON-снимка -> ключ секции в записях WAL, SQLite и UserRecord
+    SECTIONS = (('user_stats', 'stats'), ('user_gender', 'gender'), ('user_context', 'context'),
+                ('premium_users', 'premium'), ('user_achievements', 'achievements'), ('user_summary', 'summary'))
+    
     def __init__(self):
         self.data_file = 'bot_data.json'
         self.backup_file = 'bot_data_backup.json'
+        self.storage_mode = STORAGE_MODE
+        self.lock = threading.RLock()  # Структура словарей, LRU и счетчики - держим недолго
+        self.user_locks = [threading.RLock() for _ in range(max(USER_LOCK_STRIPES, 1))]
+        self.local = threading.local()  # Открытые в этом потоке db.user()
+        self.flush_lock = threading.Lock()
+        self.snapshot_lock = threading.RLock()  # RLock: quick_save из signal handler в том же потоке
+        self.snapshot_generation = 0
+        self.main_snapshot_ok = False  # Основной файл проверен и цел - при записи его можно сдвинуть в backup
+        self.wal_file = 'bot_data.wal'
+        self.wal_compacting_file = 'bot_data.wal.compacting'
+        self.wal_lock = threading.Lock()
+        self.wal_handle = None
+        self.wal_records = 0
+        self.compact_event = threading.Event()
+        self.dirty_users = set()
+        self.flushing_users = set()  # Уже забраны flush, но еще не на диске
+        self.dirty_lock = threading.Lock()
+        self.flush_event = threading.Event()
+        self.sqlite_file = SQLITE_FILE
+        self.storage = None
+        self.loaded_users = OrderedDict()  # LRU: самые старые - в начале
+        self.max_resident_users = MAX_RESIDENT_USERS
+        self.cache_hits = 0
+        self.cache_misses = 0
+        self.cache_evictions = 0
+        # 🆕 Счетчики поддерживаются на каждом изменении - статистика за O(1)
+        self.aggregates = self.empty_aggregates()
+        self.counted_stats = {}  # user_id -> (message_count, current_level), уже учтенные в aggregates
+        self.premium_expiry = {}  # user_id -> expires (ISO)
+        self.premium_heap = []  # (expires, user_id) - ближайшие истечения сверху
         self.user_stats = {}
         self.user_gender = {} 
         self.user_context = {}
         self.premium_users = {}
         self.user_achievements = {}
+        self.user_summary = {}  # 🆕 Сводки свернутых реплик (extended_memory)
         self.last_memory_backup = None
         self.backup_interval = 10
         self.last_backup_time = time.time()
@@ -48,31 +971,30 @@ class SimpleDatabase:
         """УМНАЯ загрузка с приоритетом надежности"""
         print("🔍 Loading data...")
         
-        if os.path.exists(self.data_file):
-            try:
-                with open(self.data_file, 'r', encoding='utf-8') as f:
-                    data = json.load(f)
-                    self.load_from_data(data)
-                
-                # 🛠️ ФИКС: Логируем загруженные достижения
-                total_achievements = sum(len(ach['unlocked']) for ach in self.user_achievements.values())
-                print(f"💾 Loaded from main: {len(self.user_stats)} users, {total_achievements} total achievements unlocked")
-                return
-            except Exception as e:
-                print(f"❌ Main file corrupted: {e}")
+        if self.storage_mode == 'sqlite':
+            # 🆕 Пользователи подгружаются по одному при первом обращении
+            self.storage = SqliteStorage(self.sqlite_file)
+            if self.storage.count_users() == 0:
+                self.migrate_to_sqlite()
+            self.aggregates = self.storage.load_aggregates() or self.storage.compute_aggregates()
+            for user_id_str, expires in self.storage.premium_expiries():
+                self.track_premium(user_id_str, expires)
+            print(f"🗄️ SQLite storage ready: {self.aggregates['total_users']} users in {self.sqlite_file}")
+            return
         
-        if os.path.exists(self.backup_file):
-            try:
-                print("⚠️  Trying backup file...")
-                with open(self.backup_file, 'r', encoding='utf-8') as f:
-                    data = json.load(f)
-                    self.load_from_data(data)
-                
-                total_achievements = sum(len(ach['unlocked']) for ach in self.user_achievements.values())
-                print(f"✅ Restored from backup: {len(self.user_stats)} users, {total_achievements} achievements")
-                return
-            except Exception as e:
-                print(f"❌ Backup file corrupted: {e}")
+        data = self.read_snapshot(records=True)
+        
+        if self.storage_mode == 'wal':
+            # 🆕 Snapshot + журнал: доигрываем все записи поверх снимка
+            data = data or {}
+            replayed = self.replay_wal(data, self.wal_compacting_file)
+            self.wal_records = self.replay_wal(data, self.wal_file)
+            print(f"📜 WAL replayed: {replayed + self.wal_records} records")
+            self.open_wal()
+        
+        if data:
+            self.load_from_data(data)
+            return
         
         print("💾 No valid data files, starting fresh")
         self.user_stats = {}
@@ -80,192 +1002,758 @@ class SimpleDatabase:
         self.user_context = {}
         self.premium_users = {}
         self.user_achievements = {}
+        self.user_summary = {}
+    
+    def read_snapshot(self, records=False):
+        """🆕 Читает самое новое целое поколение из основного файла и backup.
+        Сначала только заголовки; битый файл отбрасывается по длине/sha256 без разбора JSON.
+        records=True - для load_from_data: columnar-снимок отдает сразу записи в памяти"""
+        candidates = []
+        self.main_snapshot_ok = False
+        for path, label in ((self.data_file, 'main'), (self.backup_file, 'backup')):
+            header = self.read_snapshot_header(path)
+            if header is not None:
+                candidates.append((header['gen'], label, path, header))
+                self.snapshot_generation = max(self.snapshot_generation, header['gen'])
+        
+        for generation, label, path, header in sorted(candidates, key=lambda candidate: candidate[0], reverse=True):
+            try:
+                data = self.read_snapshot_payload(path, header, records)
+                self.main_snapshot_ok = path == self.data_file
+                
+                # 🛠️ ФИКС: Логируем загруженные достижения
+                total_achievements = sum(len(ach.get('unlocked', [])) for ach in data.get('user_achievements', {}).values())
+                print(f"💾 Loaded from {label} (generation {generation}): {len(data.get('user_stats', {}))} users, {total_achievements} total achievements unlocked")
+                return data
+            except Exception as e:
+                print(f"❌ {label.capitalize()} file corrupted: {e}")
+        
+        return None
+    
+    @staticmethod
+    def read_snapshot_header(path):
+        """{'gen', 'fmt', 'len', 'sha256', 'offset'} или None, если файла нет; старый JSON без заголовка - поколение 0"""
+        try:
+            with open(path, 'rb') as f:
+                first_line = f.readline(256)
+        except FileNotFoundError:
+            return None
+        except Exception as e:
+            print(f"❌ Can't read {path}: {e}")
+            return None
+        
+        if not first_line.startswith(SNAPSHOT_MAGIC):
+            return {'gen': 0, 'fmt': 'json', 'len': None, 'sha256': None, 'offset': 0}
+        try:
+            fields = dict(field.split('=', 1) for field in first_line.decode('ascii').split()[1:])
+            return {'gen': int(fields['gen']), 'fmt': fields.get('fmt', 'json'), 'len': int(fields['len']),
+                    'sha256': fields['sha256'], 'offset': len(first_line)}
+        except Exception:
+            return {'gen': -1, 'fmt': None, 'len': -1, 'sha256': None, 'offset': len(first_line)}  # Заголовок испорчен
+    
+    @staticmethod
+    def read_snapshot_payload(path, header, records=False):
+        if header['len'] is not None and os.path.getsize(path) != header['offset'] + header['len']:
+            raise ValueError("size mismatch (truncated write?)")
+        
+        with open(path, 'rb') as f:
+            f.seek(header['offset'])
+            payload = f.read()
+        
+        if header['sha256'] is not None and hashlib.sha256(payload).hexdigest() != header['sha256']:
+            raise ValueError("checksum mismatch")
+        if header['fmt'] == 'columnar':
+            return ColumnarSnapshot.decode(payload, records)
+        if header['fmt'] == 'json':
+            return json.loads(payload)
+        raise ValueError(f"unknown snapshot format {header['fmt']}")
+    
+    def write_snapshot_file(self, data, fmt=None):
+        """🆕 Атомарная запись: temp-файл с заголовком -> fsync -> rename.
+        Прошлое поколение становится backup, так что на диске всегда есть два целых снимка"""
+        fmt = fmt or SNAPSHOT_FORMAT
+        if fmt == 'columnar':
+            payload = ColumnarSnapshot.encode(data)
+        else:
+            fmt = 'json'
+            payload = json.dumps(data, ensure_ascii=False, separators=(',', ':')).encode('utf-8')
+        checksum = hashlib.sha256(payload).hexdigest()
+        
+        with self.snapshot_lock:
+            self.snapshot_generation += 1
+            header = SNAPSHOT_MAGIC + f" gen={self.snapshot_generation} fmt={fmt} len={len(payload)} sha256={checksum}\n".encode('ascii')
+            
+            temp_file = self.data_file + '.tmp'
+            with open(temp_file, 'wb') as f:
+                f.write(header)
+                f.write(payload)
+                f.flush()
+                os.fsync(f.fileno())
+            
+            # Битый (или не проверенный) основной файл в backup не сдвигаем - там последнее целое поколение
+            if self.main_snapshot_ok and os.path.exists(self.data_file):
+                os.replace(self.data_file, self.backup_file)
+            os.replace(temp_file, self.data_file)
+            self.main_snapshot_ok = True
+            self.fsync_data_dir()
+            return self.snapshot_generation
+    
+    def fsync_data_dir(self):
+        """rename долговечен только после fsync каталога (на Windows не поддерживается)"""
+        try:
+            dir_fd = os.open(os.path.dirname(os.path.abspath(self.data_file)), os.O_RDONLY)
+        except OSError:
+            return
+        try:
+            os.fsync(dir_fd)
+        except OSError:
+            pass
+        finally:
+            os.close(dir_fd)
+    
+    def migrate_to_sqlite(self):
+        """🆕 Разовый перенос bot_data.json / bot_data_backup.json (+ WAL) в SQLite"""
+        data = self.read_snapshot() or {}
+        self.replay_wal(data, self.wal_compacting_file)
+        self.replay_wal(data, self.wal_file)
+        
+        records = self.records_from_data(data)
+        if not records:
+            return 0
+        
+        self.storage.save_users(records)
+        print(f"📦 Migrated {len(records)} users from JSON to SQLite")
+        return len(records)
+    
+    @staticmethod
+    def records_from_data(data):
+        """Раскладывает сырые JSON-данные на записи по пользователям"""
+        user_ids = set()
+        for section, _ in SimpleDatabase.SECTIONS:
+            user_ids.update(data.get(section, {}).keys())
+        
+        return [
+            dict([('u', user_id)] + [(key, data.get(section, {}).get(user_id)) for section, key in SimpleDatabase.SECTIONS])
+            for user_id in user_ids
+        ]
+    
+    def ensure_user(self, user_id):
+        """В режиме SQLite подгружает пользователя при первом обращении"""
+        if self.storage is None:
+            return
+        
+        user_id_str = str(user_id)
+        if user_id_str in self.loaded_users:
+            self.loaded_users.move_to_end(user_id_str)
+            self.cache_hits += 1
+            return
+        
+        self.cache_misses += 1
+        record = self.storage.load_user(user_id_str)
+        if record:
+            self.apply_user_record(record)
+        self.loaded_users[user_id_str] = True
+        
+        if self.max_resident_users > 0:
+            # Один проход: невыгружаемые (еще не записанные) уходят в конец очереди
+            for _ in range(len(self.loaded_users) - self.max_resident_users):
+                oldest_id, _ = self.loaded_users.popitem(last=False)
+                self.evict_user(oldest_id)
+    
+    def evict_user(self, user_id_str):
+        """🆕 Выгружает давно неактивного пользователя; измененного - только после того, как его запишет flush"""
+        with self.dirty_lock:
+            unsaved = user_id_str in self.dirty_users or user_id_str in self.flushing_users
+        
+        if unsaved:
+            # Писать здесь нельзя - мы под self.lock, все хендлеры ждали бы диск.
+            # Оставляем в памяти (в конце LRU) и будим flush-поток; выгрузим на следующем проходе
+            self.loaded_users[user_id_str] = True
+            self.flush_event.set()
+            return
+        
+        for section, _ in self.SECTIONS:
+            getattr(self, section).pop(user_id_str, None)
+        self.counted_stats.pop(user_id_str, None)
+        self.cache_evictions += 1
+    
+    @synchronized
+    def get_cache_stats(self):
+        """🆕 Счетчики LRU-кэша пользователей для /health"""
+        lookups = self.cache_hits + self.cache_misses
+        return {
+            'resident_users': len(self.loaded_users),
+            'max_resident_users': self.max_resident_users,
+            'hits': self.cache_hits,
+            'misses': self.cache_misses,
+            'evictions': self.cache_evictions,
+            'hit_ratio': round(self.cache_hits / lookups, 3) if lookups else 0.0
+        }
+    
+    def apply_user_record(self, record):
+        """Кладет запись пользователя в память"""
+        user_id_str = record['u']
+        for section, key in self.SECTIONS:
+            if record.get(key) is not None:
+                getattr(self, section)[user_id_str] = self.import_section(key, record[key])
+        
+        stats = record.get('stats')
+        if stats is not None:
+            # Пользователь уже учтен в сохраненных счетчиках - только запоминаем базу
+            self.counted_stats[user_id_str] = (stats.get('message_count', 0), stats.get('current_level', 1))
     
     def load_from_data(self, data):
-        """Загружает данные из JSON"""
-        self.user_stats = data.get('user_stats', {})
-        self.user_gender = data.get('user_gender', {})
-        self.user_context = data.get('user_context', {})
-        self.premium_users = data.get('premium_users', {})
-        
-        # 🛠️ ФИКС: Правильно конвертируем achievements
-        achievements_data = data.get('user_achievements', {})
-        self.user_achievements = {}
+        """Загружает данные из JSON (🆕 сразу в компактные записи)"""
+        for section, key in self.SECTIONS:
+            setattr(self, section, {user_id: self.import_section(key, value) for user_id, value in data.get(section, {}).items()})
         
-        for user_id, user_ach in achievements_data.items():
-            # 🛠️ ФИКС: Конвертируем list обратно в set
-            different_buttons = user_ach.get('progress', {}).get('different_buttons', [])
+        self.rebuild_aggregates()
+    
+    def import_section(self, key, value):
+        """🆕 Секция пользователя из JSON (или от старого API) -> представление в памяти"""
+        if key == 'stats':
+            return UserStats.from_value(value)
+        if key == 'gender':
+            return encode_gender(value)
+        if key == 'context':
+            return ConversationMemory.from_value(value)
+        if key == 'premium':
+            return PremiumRecord.from_value(value)
+        if key == 'summary':
+            return ConversationSummary.from_value(value)
+        return value if isinstance(value, UserAchievements) else self.deserialize_user_achievements(value)
+    
+    def export_section(self, key, value):
+        """Обратно в JSON-совместимый вид - для снимков, WAL и SQLite"""
+        if key == 'gender':
+            return decode_gender(value)
+        if key == 'context':
+            return [turn.to_dict() for turn in value]
+        if key == 'achievements':
+            return self.serialize_user_achievements(value)
+        return value.to_dict()
+    
+    def deserialize_user_achievements(self, user_ach):
+        # 🛠️ ФИКС: Конвертируем list обратно в set
+        different_buttons = user_ach.get('progress', {}).get('different_buttons', [])
+        
+        return UserAchievements({
+            'unlocked': user_ach.get('unlocked', []),
+            'progress': {
+                'messages_sent': user_ach.get('progress', {}).get('messages_sent', 0),
+                'buttons_used': user_ach.get('progress', {}).get('buttons_used', 0),
+                'different_buttons': set(different_buttons),  # 🛠️ ФИКС: list -> set
+                'levels_reached': user_ach.get('progress', {}).get('levels_reached', 1),
+                'days_active': user_ach.get('progress', {}).get('days_active', 1)
+            }
+        })
+    
+    # ==================== 🆕 ТРАНЗАКЦИИ ПО ПОЛЬЗОВАТЕЛЯМ ====================
+    def user_lock(self, user_id):
+        return self.user_locks[hash(str(user_id)) % len(self.user_locks)]
+    
+    @contextlib.contextmanager
+    def user(self, user_id):
+        """with db.user(user_id) as u: - атомарное чтение-изменение-запись одного пользователя.
+        Вложенные вызовы в том же потоке получают ту же запись; исключение - откат"""
+        user_id_str = str(user_id)
+        records = self.local.__dict__.setdefault('records', {})
+        if user_id_str in records:
+            yield records[user_id_str]
+            return
+        
+        with self.user_lock(user_id_str):
+            record = UserRecord(self, user_id_str)
+            records[user_id_str] = record
+            try:
+                yield record
+            finally:
+                del records[user_id_str]
+            self.commit_user(record)
+    
+    @staticmethod
+    def new_user_stats():
+        now = datetime.datetime.now().isoformat()
+        return UserStats({
+            'message_count': 0,
+            'first_seen': now,
+            'last_seen': now,
+            'current_level': 1,
+            'waiting_feedback': False
+        })
+    
+    @staticmethod
+    def new_user_achievements():
+        return UserAchievements({
+            'unlocked': [],
+            'progress': {
+                'messages_sent': 0,
+                'buttons_used': 0,
+                'different_buttons': set(),
+                'levels_reached': 1,
+                'days_active': 1
+            }
+        })
+    
+    def copy_user_achievements(self, achievements):
+        if isinstance(achievements, UserAchievements):
+            return achievements.copy()
+        return self.deserialize_user_achievements(achievements)
+    
+    def read_section(self, user_id_str, section):
+        """Сохраненная секция (не изменять!) и ее рабочая копия для UserRecord"""
+        with self.lock:
+            self.ensure_user(user_id_str)
+            if section == 'stats':
+                original = self.user_stats.get(user_id_str)
+                return original, original.copy() if original is not None else self.new_user_stats()
+            if section == 'gender':
+                original = decode_gender(self.user_gender.get(user_id_str))
+                return original, original or 'unknown'
+            if section == 'context':
+                original = self.user_context.get(user_id_str)
+                return original, original.copy() if original is not None else ConversationMemory()
+            if section == 'premium':
+                original = self.premium_users.get(user_id_str)
+                return original, original.copy() if original is not None else None
+            if section == 'summary':
+                original = self.user_summary.get(user_id_str)
+                return original, original.copy() if original is not None else None
+            original = self.user_achievements.get(user_id_str)
+            if original is None:
+                return None, self.new_user_achievements()
+            return original, self.copy_user_achievements(original)
+    
+    def commit_user(self, record):
+        """Подменяет измененные секции новыми объектами и обновляет счетчики"""
+        with self.lock:
+            self.ensure_user(record.user_id)  # Могли выгрузить из LRU, пока шла транзакция
+            changed = False
+            for section, value in record.changes():
+                self.store_section(record.user_id, section, value)
+                changed = True
             
-            self.user_achievements[user_id] = {
-                'unlocked': user_ach.get('unlocked', []),
-                'progress': {
-                    'messages_sent': user_ach.get('progress', {}).get('messages_sent', 0),
-                    'buttons_used': user_ach.get('progress', {}).get('buttons_used', 0),
-                    'different_buttons': set(different_buttons),  # 🛠️ ФИКС: list -> set
-                    'levels_reached': user_ach.get('progress', {}).get('levels_reached', 1),
-                    'days_active': user_ach.get('progress', {}).get('days_active', 1)
-                }
+            if changed:
+                # Под тем же локом: иначе LRU может выгрузить пользователя без записи
+                self.mark_dirty(record.user_id)
+    
+    def store_section(self, user_id_str, section, value):
+        if value is not None:
+            value = self.import_section(section, value)  # Старый код мог положить dict
+        if section == 'stats':
+            self.user_stats[user_id_str] = value
+            self.track_user_stats(user_id_str, value)
+        elif section == 'gender':
+            self.user_gender[user_id_str] = value
+        elif section == 'context':
+            self.user_context[user_id_str] = value
+        elif section == 'premium':
+            if value is None:
+                if self.premium_users.pop(user_id_str, None) is not None:
+                    self.untrack_premium(user_id_str)
+            else:
+                self.premium_users[user_id_str] = value
+                if self.premium_expiry.get(user_id_str) != (value.get('expires') or '9999'):
+                    self.track_premium(user_id_str, value.get('expires'))
+        elif section == 'summary':
+            if value is None:
+                self.user_summary.pop(user_id_str, None)
+            else:
+                self.user_summary[user_id_str] = value
+        else:
+            if user_id_str not in self.user_achievements:
+                self.aggregates['users_with_achievements'] += 1
+            self.user_achievements[user_id_str] = value
+    
+    def copy_for_snapshot(self):
+        """Copy-on-write снимок: значения не меняются на месте, поэтому хватает
+        поверхностных копий словарей - под локом O(пользователей) без сериализации"""
+        with self.lock:
+            return {
+                'user_stats': dict(self.user_stats),
+                'user_gender': dict(self.user_gender),
+                'user_context': dict(self.user_context),
+                'premium_users': dict(self.premium_users),
+                'user_achievements': dict(self.user_achievements),
+                'user_summary': dict(self.user_summary),
+                'aggregates': self.export_aggregates()
             }
     
-    def make_achievements_serializable(self):
-        """🛠️ ФИКС: Конвертируем set в list для JSON"""
-        serializable_achievements = {}
-        for user_id, achievements in self.user_achievements.items():
-            serializable_achievements[user_id] = {
-                'unlocked': achievements['unlocked'],
-                'progress': {
-                    'messages_sent': achievements['progress']['messages_sent'],
-                    'buttons_used': achievements['progress']['buttons_used'],
-                    'different_buttons': list(achievements['progress']['different_buttons']),  # 🛠️ set -> list
-                    'levels_reached': achievements['progress']['levels_reached'],
-                    'days_active': achievements['progress']['days_active']
-                }
+    # ==================== 🆕 RUNNING COUNTERS ====================
+    @staticmethod
+    def empty_aggregates():
+        return {'total_users': 0, 'total_messages': 0, 'users_with_achievements': 0, 'levels': {}}
+    
+    def rebuild_aggregates(self):
+        """Разовый пересчет после полной загрузки (JSON/WAL режимы)"""
+        self.aggregates = self.empty_aggregates()
+        self.counted_stats = {}
+        for user_id_str, stats in self.user_stats.items():
+            self.track_user_stats(user_id_str, stats)
+        self.aggregates['users_with_achievements'] = len(self.user_achievements)
+        
+        self.premium_expiry = {}
+        self.premium_heap = []
+        for user_id_str, premium_data in self.premium_users.items():
+            self.track_premium(user_id_str, premium_data.get('expires'))
+    
+    def track_user_stats(self, user_id_str, stats):
+        """Применяет к счетчикам разницу между учтенными и новыми stats"""
+        new_count = stats.get('message_count', 0)
+        new_level = stats.get('current_level', 1)
+        old = self.counted_stats.get(user_id_str)
+        levels = self.aggregates['levels']
+        
+        if old is None:
+            self.aggregates['total_users'] += 1
+            old_count = 0
+        else:
+            old_count, old_level = old
+            levels[str(old_level)] = levels.get(str(old_level), 0) - 1
+        
+        levels[str(new_level)] = levels.get(str(new_level), 0) + 1
+        self.aggregates['total_messages'] += new_count - old_count
+        self.counted_stats[user_id_str] = (new_count, new_level)
+    
+    def track_premium(self, user_id_str, expires):
+        self.premium_expiry[user_id_str] = expires or '9999'
+        heapq.heappush(self.premium_heap, (expires or '9999', user_id_str))
+    
+    def untrack_premium(self, user_id_str):
+        # Запись в куче останется, но будет пропущена при очистке
+        self.premium_expiry.pop(user_id_str, None)
+    
+    @synchronized
+    def get_active_premium_count(self):
+        """Снимает с кучи истекшие подписки - амортизированно O(log n)"""
+        now_iso = datetime.datetime.now().isoformat()
+        while self.premium_heap and self.premium_heap[0][0] <= now_iso:
+            expires, user_id_str = heapq.heappop(self.premium_heap)
+            if self.premium_expiry.get(user_id_str) == expires:
+                del self.premium_expiry[user_id_str]
+        return len(self.premium_expiry)
+    
+    @synchronized
+    def export_aggregates(self):
+        aggregates = dict(self.aggregates)
+        aggregates['levels'] = dict(self.aggregates['levels'])
+        aggregates['premium_users'] = self.get_active_premium_count()
+        return aggregates
+    
+    def serialize_user_achievements(self, achievements):
+        return {
+            'unlocked': list(achievements['unlocked']),
+            'progress': {
+                'messages_sent': achievements['progress']['messages_sent'],
+                'buttons_used': achievements['progress']['buttons_used'],
+                'different_buttons': list(achievements['progress']['different_buttons']),  # 🛠️ set -> list
+                'levels_reached': achievements['progress']['levels_reached'],
+                'days_active': achievements['progress']['days_active']
             }
-        return serializable_achievements
+        }
     
-    def save_data(self):
-        """СУПЕР-НАДЕЖНОЕ сохранение"""
+    # ==================== 🆕 WRITE-AHEAD LOG ====================
+    def open_wal(self):
+        self.wal_handle = open(self.wal_file, 'a', encoding='utf-8')
+    
+    def make_user_record(self, user_id):
+        """Одна компактная запись WAL = полное состояние одного пользователя"""
+        user_id_str = str(user_id)
+        record = {'u': user_id_str}
+        for section, key in self.SECTIONS:
+            value = getattr(self, section).get(user_id_str)
+            record[key] = self.export_section(key, value) if value is not None else None
+        return record
+    
+    @staticmethod
+    def apply_wal_record(data, record):
+        """Накладывает запись WAL на сырые (JSON) данные снимка"""
+        user_id_str = record['u']
+        for section, key in SimpleDatabase.SECTIONS:
+            value = record.get(key)
+            if value is None:
+                data.setdefault(section, {}).pop(user_id_str, None)
+            else:
+                data.setdefault(section, {})[user_id_str] = value
+    
+    def replay_wal(self, data, path):
+        """Доигрывает журнал в data, возвращает число примененных записей"""
+        if not os.path.exists(path):
+            return 0
+        
+        applied = 0
+        with open(path, 'r', encoding='utf-8') as f:
+            for line in f:
+                try:
+                    self.apply_wal_record(data, json.loads(line))
+                    applied += 1
+                except Exception as e:
+                    # Недописанная строка после падения - пропускаем
+                    print(f"⚠️  Skipping broken WAL record in {path}: {e}")
+        return applied
+    
+    def append_wal(self, user_ids):
+        """Пишет по одной записи на каждого измененного пользователя"""
+        with self.lock:
+            records = [self.make_user_record(user_id) for user_id in user_ids]
+        # Объекты в записях не меняются на месте (copy-on-write) - сериализуем без лока
+        lines = [json.dumps(record, ensure_ascii=False, separators=(',', ':')) + '\n' for record in records]
         try:
-            print(f"💾 Saving data for {len(self.user_stats)} users...")
+            with self.wal_lock:
+                self.wal_handle.writelines(lines)
+                self.wal_handle.flush()
+                os.fsync(self.wal_handle.fileno())
+                self.wal_records += len(lines)
+                records = self.wal_records
             
-            data = {
-                'user_stats': self.user_stats,
-                'user_gender': self.user_gender, 
-                'user_context': self.user_context,
-                'premium_users': self.premium_users,
-                'user_achievements': self.make_achievements_serializable(),  # 🛠️ Используем исправленную версию
-                'last_save': datetime.datetime.now().isoformat(),
-                'total_users': len(self.user_stats),
-                'total_messages': self.get_total_messages(),
-                'save_type': 'regular'
-            }
+            if records >= WAL_COMPACT_RECORDS:
+                self.compact_event.set()
+            return True
+        except Exception as e:
+            print(f"❌ WAL WRITE ERROR: {e}")
+            return False
+    
+    def sync_wal(self):
+        """Гарантирует, что журнал дошел до диска"""
+        try:
+            with self.wal_lock:
+                self.wal_handle.flush()
+                os.fsync(self.wal_handle.fileno())
+        except Exception as e:
+            print(f"❌ WAL SYNC ERROR: {e}")
+    
+    def compact_wal(self):
+        """Сворачивает журнал в новый снимок (работает в фоне, живые данные не трогает)"""
+        try:
+            with self.wal_lock:
+                # Ротация журнала - O(1) под локом
+                if not os.path.exists(self.wal_compacting_file):
+                    if self.wal_records == 0:
+                        return
+                    self.wal_handle.close()
+                    os.replace(self.wal_file, self.wal_compacting_file)
+                    self.open_wal()
+                    self.wal_records = 0
             
-            with open(self.data_file, 'w', encoding='utf-8') as f:
-                json.dump(data, f, ensure_ascii=False, indent=2)
+            data = self.read_snapshot() or {}
+            replayed = self.replay_wal(data, self.wal_compacting_file)
             
-            try:
-                with open(self.backup_file, 'w', encoding='utf-8') as f:
-                    json.dump(data, f, ensure_ascii=False, indent=2)
-            except:
-                pass
+            data['last_save'] = datetime.datetime.now().isoformat()
+            data['total_users'] = len(data.get('user_stats', {}))
+            data['total_messages'] = sum(stats.get('message_count', 0) for stats in data.get('user_stats', {}).values())
+            data['save_type'] = 'compaction'
+            data.pop('aggregates', None)  # Счетчики пересчитываются при загрузке
             
-            print(f"✅ Data saved! Users: {len(self.user_stats)}, Messages: {self.get_total_messages()}")
+            self.write_snapshot_file(data)
+            os.remove(self.wal_compacting_file)
             
+            print(f"🗜️ WAL compacted: {replayed} records -> {data['total_users']} users")
         except Exception as e:
-            print(f"❌ SAVE ERROR: {e}")
+            print(f"❌ COMPACTION ERROR: {e}")
     
-    def quick_save(self):
-        """ЭКСТРЕННОЕ сохранение при выключении"""
+    # ==================== 🆕 DIRTY-TRACKING ====================
+    def mark_dirty(self, user_id):
+        """Запоминает измененного пользователя - запись произойдет при flush"""
+        with self.dirty_lock:
+            self.dirty_users.add(str(user_id))
+            dirty_count = len(self.dirty_users)
+        
+        if dirty_count >= SAVE_DIRTY_THRESHOLD:
+            self.flush_event.set()
+    
+    def flush(self, force=False):
+        """Одна запись на все изменения с прошлого flush"""
+        with self.flush_lock:
+            return self.flush_locked(force)
+    
+    def flush_locked(self, force):
+        with self.dirty_lock:
+            dirty = self.dirty_users
+            self.dirty_users = set()
+            self.flushing_users = dirty
+        
+        if not dirty and not force:
+            return False
+        
+        if self.storage_mode == 'wal':
+            if dirty:
+                saved = self.append_wal(dirty)
+            else:
+                self.sync_wal()
+                saved = True
+        elif self.storage_mode == 'sqlite':
+            saved = self.write_sqlite(dirty)
+        else:
+            saved = self.write_snapshot()
+        
+        with self.dirty_lock:
+            self.flushing_users = set()
+            if not saved:
+                # Не получилось - вернем в очередь, попробуем в следующий раз
+                self.dirty_users |= dirty
+        return saved
+    
+    def write_sqlite(self, user_ids):
+        """Обновляет в SQLite только строки измененных пользователей"""
+        if not user_ids:
+            return True
+        
+        try:
+            with self.lock:
+                records = [self.make_user_record(user_id) for user_id in user_ids]
+                aggregates = self.export_aggregates()
+            self.storage.save_users(records, aggregates)
+            self.last_backup_time = time.time()
+            return True
+        except Exception as e:
+            print(f"❌ SQLITE SAVE ERROR: {e}")
+            return False
+    
+    def save_data(self):
+        """СУПЕР-НАДЕЖНОЕ сохранение (синхронно, прямо сейчас)"""
+        return self.flush(force=True)
+    
+    def write_snapshot(self, save_type='regular'):
+        """Полный снимок всех пользователей (в формате SNAPSHOT_FORMAT)"""
+        with self.snapshot_lock:  # Копия и запись одним шагом: поколение N+1 всегда новее N
+            return self.write_snapshot_locked(save_type)
+    
+    def write_snapshot_locked(self, save_type):
         try:
-            print("🚨 QUICK SAVE - Emergency mode!")
+            snapshot = self.copy_for_snapshot()
+            print(f"💾 Saving data for {len(snapshot['user_stats'])} users...")
             
+            # 🆕 Записи -> JSON-вид, сериализация, checksum и fsync - уже без лока, хендлеры не ждут
             data = {
-                'user_stats': self.user_stats,
-                'user_gender': self.user_gender,
-                'user_context': self.user_context,
-                'premium_users': self.premium_users,
-                'user_achievements': self.make_achievements_serializable(),  # 🛠️ ТОЖЕ ИСПРАВЛЕНО!
-                'last_save': datetime.datetime.now().isoformat(),
-                'save_type': 'emergency'
+                section: {user_id: self.export_section(key, value) for user_id, value in snapshot[section].items()}
+                for section, key in self.SECTIONS
             }
+            data.update({
+                'last_save': datetime.datetime.now().isoformat(),
+                'total_users': len(snapshot['user_stats']),
+                'total_messages': snapshot['aggregates']['total_messages'],
+                'aggregates': snapshot['aggregates'],
+                'save_type': save_type
+            })
+            generation = self.write_snapshot_file(data)
             
-            with open(self.data_file, 'w', encoding='utf-8') as f:
-                json.dump(data, f, ensure_ascii=False)
+            print(f"✅ Data saved! Users: {len(snapshot['user_stats'])}, Messages: {data['total_messages']} (generation {generation})")
+            self.last_backup_time = time.time()
+            return True
             
-            print("✅ Emergency save completed!")
         except Exception as e:
-            print(f"❌ EMERGENCY SAVE FAILED: {e}")
+            print(f"❌ SAVE ERROR: {e}")
+            return False
+    
+    def quick_save(self):
+        """ЭКСТРЕННОЕ сохранение при выключении"""
+        if self.storage_mode in ('wal', 'sqlite'):
+            self.flush(force=True)
+            print(f"✅ Emergency save completed ({self.storage_mode} synced)!")
+            return
+        
+        print("🚨 QUICK SAVE - Emergency mode!")
+        # 🆕 Тот же атомарный путь: прерванная запись не портит прошлый снимок
+        if self.write_snapshot(save_type='emergency'):
+            print("✅ Emergency save completed!")
+        else:
+            print("❌ EMERGENCY SAVE FAILED")
 
+    # 🆕 Старый API поверх db.user(): наружу отдаем копии, сохраняем тоже копии
     def get_user_achievements(self, user_id):
-        user_id_str = str(user_id)
-        if user_id_str not in self.user_achievements:
-            self.user_achievements[user_id_str] = {
-                'unlocked': [],
-                'progress': {
-                    'messages_sent': 0,
-                    'buttons_used': 0,
-                    'different_buttons': set(),
-                    'levels_reached': 1,
-                    'days_active': 1
-                }
-            }
-        return self.user_achievements[user_id_str]
+        with self.user(user_id) as u:
+            return self.copy_user_achievements(u.achievements)
     
     def update_user_achievements(self, user_id, achievements):
-        self.user_achievements[str(user_id)] = achievements
+        with self.user(user_id) as u:
+            u.achievements = self.copy_user_achievements(achievements)
     
     def unlock_achievement(self, user_id, achievement_id):
-        user_achievements = self.get_user_achievements(user_id)
-        
-        # 🛠️ ФИКС: Двойная проверка на дубликаты
-        if achievement_id not in user_achievements['unlocked']:
-            user_achievements['unlocked'].append(achievement_id)
-            self.save_data()
-            print(f"🔓 ACHIEVEMENT SAVED: {user_id} -> {achievement_id}")
-            return True
+        with self.user(user_id) as u:
+            # 🛠️ ФИКС: Двойная проверка на дубликаты
+            if achievement_id not in u.achievements['unlocked']:
+                u.achievements['unlocked'].append(achievement_id)
+                print(f"🔓 ACHIEVEMENT SAVED: {user_id} -> {achievement_id}")
+                return True
         
         print(f"⚠️  ACHIEVEMENT ALREADY UNLOCKED: {user_id} -> {achievement_id}")
         return False
 
     def get_user_stats(self, user_id):
-        user_id_str = str(user_id)
-        if user_id_str not in self.user_stats:
-            self.user_stats[user_id_str] = {
-                'message_count': 0,
-                'first_seen': datetime.datetime.now().isoformat(),
-                'last_seen': datetime.datetime.now().isoformat(), 
-                'current_level': 1,
-                'waiting_feedback': False
-            }
-        return self.user_stats[user_id_str]
+        with self.user(user_id) as u:
+            return dict(u.stats)
     
     def update_user_stats(self, user_id, stats):
-        user_id_str = str(user_id)
-        self.user_stats[user_id_str] = stats
+        with self.user(user_id) as u:
+            u.stats = dict(stats)
     
     def get_user_gender(self, user_id):
-        return self.user_gender.get(str(user_id), 'unknown')
+        with self.user(user_id) as u:
+            return u.gender
     
     def update_user_gender(self, user_id, gender):
-        self.user_gender[str(user_id)] = gender
+        with self.user(user_id) as u:
+            u.gender = gender
     
     def get_conversation_context(self, user_id):
-        return self.user_context.get(str(user_id), [])
+        with self.user(user_id) as u:
+            return list(u.context)
+    
+    def get_context_parts(self, user_id):
+        """🆕 (сводка, буфер реплик) для промпта - без копий, только для чтения"""
+        user_id_str = str(user_id)
+        record = self.local.__dict__.get('records', {}).get(user_id_str)
+        with self.lock:
+            self.ensure_user(user_id_str)
+            summary = self.user_summary.get(user_id_str)
+            memory = self.user_context.get(user_id_str)
+        
+        if record is not None and 'context' in record.__dict__:
+            memory = record.context  # Уже в транзакции и контекст мог измениться
+        return summary, memory
     
     def update_conversation_context(self, user_id, context):
-        self.user_context[str(user_id)] = context
+        with self.user(user_id) as u:
+            u.context = list(context)
     
     def get_all_users(self):
+        if self.storage is not None:
+            return self.storage.all_user_ids()
         return list(self.user_stats.keys())
     
+    def get_total_users(self):
+        return self.aggregates['total_users']
+    
     def get_total_messages(self):
-        return sum(stats.get('message_count', 0) for stats in self.user_stats.values())
+        return self.aggregates['total_messages']
 
     def is_premium_user(self, user_id):
         """🆕 Проверяет premium статус пользователя"""
-        user_id_str = str(user_id)
-        if user_id_str not in self.premium_users:
-            return False
-        
-        premium_data = self.premium_users[user_id_str]
-        expires = premium_data.get('expires')
-        
-        if expires:
-            try:
-                expire_date = datetime.datetime.fromisoformat(expires)
-                if datetime.datetime.now() > expire_date:
-                    # Premium истек
-                    del self.premium_users[user_id_str]
-                    return False
-            except:
-                pass
-        
-        return True
+        with self.user(user_id) as u:
+            premium_data = u.premium
+            if premium_data is None:
+                return False
+            
+            expires = premium_data.get('expires')
+            if expires:
+                try:
+                    expire_date = datetime.datetime.fromisoformat(expires)
+                    if datetime.datetime.now() > expire_date:
+                        # Premium истек
+                        u.premium = None
+                        return False
+                except:
+                    pass
+            
+            return True
+    
+    def get_premium_data(self, user_id):
+        """Копия premium-записи (или {}), без проверки срока"""
+        with self.user(user_id) as u:
+            return dict(u.premium or {})
 
     def set_premium_status(self, user_id, premium_type="basic", duration_days=30):
         """🆕 Устанавливает premium статус пользователя"""
-        user_id_str = str(user_id)
-        
         activate_date = datetime.datetime.now()
         expire_date = activate_date + datetime.timedelta(days=duration_days)
         
@@ -275,30 +1763,33 @@ class SimpleDatabase:
             "vip": ["unlimited_messages", "priority_access", "extended_memory", "ad_free", "voice_messages", "custom_personality", "dedicated_support", "feature_requests"]
         }
         
-        self.premium_users[user_id_str] = {
-            'premium_type': premium_type,
-            'activated': activate_date.isoformat(),
-            'expires': expire_date.isoformat(),
-            'features': features.get(premium_type, features['basic'])
-        }
-        
-        self.save_data()
+        with self.user(user_id) as u:
+            u.premium = {
+                'premium_type': premium_type,
+                'activated': activate_date.isoformat(),
+                'expires': expire_date.isoformat(),
+                'features': features.get(premium_type, features['basic'])
+            }
 
+    @synchronized
     def get_system_stats(self):
         """🆕 Возвращает статистику системы"""
         return {
-            'total_users': len(self.user_stats),
+            'total_users': self.get_total_users(),
             'total_messages': self.get_total_messages(),
-            'premium_users': len([uid for uid in self.premium_users if self.is_premium_user(uid)]),
-            'users_with_achievements': len(self.user_achievements),
+            'premium_users': self.get_active_premium_count(),
+            'users_with_achievements': self.aggregates['users_with_achievements'],
+            'users_per_level': dict(self.aggregates['levels']),
             'last_save_time': self.last_backup_time
         }
 
     def validate_achievements_data(self):
         """🆕 Проверяет целостность данных достижений"""
         issues = []
+        with self.lock:
+            all_achievements = list(self.user_achievements.items())
         
-        for user_id, achievements in self.user_achievements.items():
+        for user_id, achievements in all_achievements:
             # Проверяем существующие достижения
             for achievement_id in achievements['unlocked']:
                 if achievement_id not in ACHIEVEMENTS:
@@ -316,9 +1807,6 @@ class SimpleDatabase:
         
         return len(issues) == 0
 
-# Initialize enhanced database
-db = SimpleDatabase()
-
 # ==================== СИСТЕМА ДОСТИЖЕНИЙ ====================
 ACHIEVEMENTS = {
     "chatty": {
@@ -371,42 +1859,101 @@ ACHIEVEMENTS = {
     }
 }
 
-def check_achievements(user_id, stats, action_type=None, action_data=None):
-    """Проверяет и выдает достижения"""
-    user_achievements = db.get_user_achievements(user_id)
-    unlocked_achievements = []
-    
-    # 🛠️ ФИКС: Сохраняем исходное состояние перед проверкой
-    original_unlocked = user_achievements['unlocked'].copy()
-    
-    if action_type == "message_sent":
-        user_achievements['progress']['messages_sent'] += 1
-    elif action_type == "button_used":
-        user_achievements['progress']['buttons_used'] += 1
-        if action_data and 'button_type' in action_data:
-            user_achievements['progress']['different_buttons'].add(action_data['button_type'])
-    elif action_type == "level_up":
-        user_achievements['progress']['levels_reached'] = max(
-            user_achievements['progress']['levels_reached'], 
-            action_data['new_level'] if action_data else stats['current_level']
-        )
+ACHIEVEMENT_BITS = {achievement_id: 1 << index for index, achievement_id in enumerate(ACHIEVEMENTS)}  # 🆕 Для UserAchievements
+
+# Initialize enhanced database
+db = SimpleDatabase()
+
+class ProgressionEngine:
+    """🆕 Достижения, разложенные по типу счетчика с порогами по возрастанию.
+    Событие проверяет только свои счетчики: bisect по порогам дает маску всех достижений
+    с порогом <= значения, минус маска уже открытых. Цена события не зависит от числа достижений"""
+    EVENT_COUNTERS = {
+        'message_sent': ('messages_sent',),
+        'button_used': ('buttons_used', 'different_buttons'),
+        'level_up': ('levels_reached',)
+    }
     
-    # 🛠️ ФИКС: Проверяем только НОВЫЕ достижения
-    for achievement_id, achievement in ACHIEVEMENTS.items():
-        if achievement_id in original_unlocked:  # 🛠️ Уже разблокировано - пропускаем
-            continue
-            
-        progress = user_achievements['progress'][achievement['type']]
-        if achievement['type'] == 'different_buttons':
-            progress = len(user_achievements['progress']['different_buttons'])
+    def __init__(self, achievements, levels):
+        self.achievements = achievements
+        self.ids_by_bit = {bit: achievement_id for achievement_id, bit in ACHIEVEMENT_BITS.items()}
+        
+        by_counter = {}
+        for achievement_id, achievement in achievements.items():
+            by_counter.setdefault(achievement['type'], []).append((achievement['goal'], ACHIEVEMENT_BITS[achievement_id]))
+        self.thresholds = {}  # счетчик -> (пороги по возрастанию, masks[i] = первые i достижений)
+        for counter, goals in by_counter.items():
+            goals.sort()
+            masks = [0]
+            for _, bit in goals:
+                masks.append(masks[-1] | bit)
+            self.thresholds[counter] = ([goal for goal, _ in goals], masks)
+        
+        # Счетчики, которые не меняет ни одно событие (days_active), проверяем при любом событии
+        evented = {counter for counters in self.EVENT_COUNTERS.values() for counter in counters}
+        passive = tuple(counter for counter in self.thresholds if counter not in evented)
+        self.event_counters = {event: counters + passive for event, counters in self.EVENT_COUNTERS.items()}
+        
+        # Уровень для каждого числа сообщений до последнего порога; дальше - последний
+        self.levels = levels
+        top = max(info['messages'] for info in levels.values())
+        self.level_table = [
+            max((level_id for level_id, info in levels.items() if info['messages'] <= count), default=1)
+            for count in range(top + 1)
+        ]
+    
+    def level_for(self, message_count):
+        level_id = self.level_table[min(max(message_count, 0), len(self.level_table) - 1)]
+        return level_id, self.levels[level_id]
+    
+    def record_event(self, achievements, action_type, action_data=None, stats=None):
+        """Обновляет счетчики события в UserAchievements и возвращает id только что открытых"""
+        progress = achievements['progress']
+        if action_type == "message_sent":
+            progress['messages_sent'] += 1
+        elif action_type == "button_used":
+            progress['buttons_used'] += 1
+            if action_data and 'button_type' in action_data:
+                progress['different_buttons'].add(action_data['button_type'])
+        elif action_type == "level_up":
+            progress['levels_reached'] = max(
+                progress['levels_reached'],
+                action_data['new_level'] if action_data else stats['current_level']
+            )
         
-        if progress >= achievement['goal']:
-            if db.unlock_achievement(user_id, achievement_id):
-                unlocked_achievements.append(achievement)
-                print(f"🎉 NEW ACHIEVEMENT: {user_id} -> {achievement_id}")  # 🛠️ Логируем
+        # Прочие события (например first_day) - проверяем все счетчики, как раньше
+        return self.unlock_reached(achievements, self.event_counters.get(action_type, self.thresholds))
     
-    db.update_user_achievements(user_id, user_achievements)
-    return unlocked_achievements
+    def unlock_reached(self, achievements, counters):
+        progress = achievements['progress']
+        reached = 0
+        for counter in counters:
+            if counter not in self.thresholds:
+                continue
+            goals, masks = self.thresholds[counter]
+            value = progress[counter]
+            if isinstance(value, (set, list)):
+                value = len(value)
+            reached |= masks[bisect.bisect_right(goals, value)]
+        
+        new_bits = reached & ~achievements.unlocked_mask
+        achievements.unlocked_mask |= new_bits
+        unlocked = []
+        while new_bits:
+            bit = new_bits & -new_bits
+            unlocked.append(self.ids_by_bit[bit])
+            new_bits ^= bit
+        return unlocked
+
+def check_achievements(user_id, stats, action_type=None, action_data=None):
+    """Проверяет и выдает достижения.
+    🆕 Открытое достижение - просто бит в записи; на диск уйдет вместе с остальными изменениями при flush"""
+    with db.user(user_id) as u:
+        unlocked_ids = PROGRESSION.record_event(u.achievements, action_type, action_data, stats)
+    
+    for achievement_id in unlocked_ids:
+        print(f"🎉 NEW ACHIEVEMENT: {user_id} -> {achievement_id}")  # 🛠️ Логируем
+    return [ACHIEVEMENTS[achievement_id] for achievement_id in unlocked_ids]
 
 def get_achievements_message(achievements):
     """Создает сообщение о полученных достижениях"""
@@ -435,14 +1982,8 @@ signal.signal(signal.SIGINT, signal_handler)
 signal.signal(signal.SIGTERM, signal_handler)
 
 # ==================== УЛУЧШЕННАЯ СИСТЕМА ФИДБЕКОВ ====================
-def send_feedback_to_admin(user_id, username, feedback_text):
-    """🆕 Отправляет фидбек в указанный чат"""
-    if not FEEDBACK_CHAT_ID or not bot:
-        print(f"📝 Feedback from {user_id} ({username}): {feedback_text}")
-        return
-    
-    try:
-        feedback_message = f"""
+def build_feedback_message(user_id, username, feedback_text):
+    return f"""
 📝 *NEW USER FEEDBACK* 📝
 
 👤 *User ID:* `{user_id}`
@@ -452,16 +1993,16 @@ def send_feedback_to_admin(user_id, username, feedback_text):
 
 ⏰ *Time:* {datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')}
         """
-        
-        bot.send_message(
-            chat_id=FEEDBACK_CHAT_ID,
-            text=feedback_message,
-            parse_mode='Markdown'
-        )
-        print(f"✅ Feedback sent to admin chat: {user_id}")
-        
-    except Exception as e:
-        print(f"❌ Failed to send feedback: {e}")
+
+def send_feedback_to_admin(user_id, username, feedback_text):
+    """🆕 Отправляет фидбек в указанный чат"""
+    if not FEEDBACK_CHAT_ID or not API_TOKEN:
+        print(f"📝 Feedback from {user_id} ({username}): {feedback_text}")
+        return
+    
+    # 🆕 Через общую очередь отправки (лимиты Telegram); ошибку залогирует она
+    outbox.send(FEEDBACK_CHAT_ID, build_feedback_message(user_id, username, feedback_text), parse_mode='Markdown')
+    print(f"✅ Feedback queued for admin chat: {user_id}")
 
 # ==================== WEB SERVER FOR 24/7 ====================
 app = Flask(__name__)
@@ -470,7 +2011,7 @@ start_time = datetime.datetime.now()
 @app.route('/')
 def home():
     uptime = datetime.datetime.now() - start_time
-    total_users = len(db.get_all_users())
+    total_users = db.get_total_users()
     total_messages = db.get_total_messages()
     
     return f"""
@@ -509,9 +2050,18 @@ def health():
     return {
         "status": "healthy", 
         "timestamp": datetime.datetime.now().isoformat(),
-        "users": len(db.get_all_users()),
+        "users": db.get_total_users(),
         "total_messages": db.get_total_messages(),
-        "uptime": str(datetime.datetime.now() - start_time)
+        "uptime": str(datetime.datetime.now() - start_time),
+        "user_cache": db.get_cache_stats(),
+        "http": get_http_stats(),
+        "dispatcher": dispatcher.get_stats(),
+        "response_cache": response_cache.get_stats(),
+        "ai": get_ai_stats(),
+        "ai_scheduler": ai_scheduler.get_stats(),
+        "context_summary": context_summarizer.get_stats(),
+        "prompt": PROMPTS.get_stats(),
+        "outbox": outbox.get_stats()
     }
 
 @app.route('/ping')
@@ -523,13 +2073,26 @@ def manual_save():
     db.save_data()
     return "✅ Data saved manually!"
 
+@app.route('/webhook', methods=['POST'])
+def telegram_webhook():
+    """🆕 Telegram присылает апдейты сюда: кладем в очередь и сразу отвечаем 200"""
+    if not bot:
+        return "no bot", 404
+    if WEBHOOK_SECRET and request.headers.get('X-Telegram-Bot-Api-Secret-Token') != WEBHOOK_SECRET:
+        return "forbidden", 403
+    
+    update = types.Update.de_json(request.get_data(as_text=True))
+    if not dispatcher.try_submit(get_update_chat_id(update), process_updates_inline, [update]):
+        # Очередь полна - Telegram повторит доставку позже
+        return "busy", 503
+    return "ok", 200
+
 def run_web():
     port = int(os.environ.get("PORT", 10000))
-    print(f"🌐 Starting 24/7 web server on port {port}")
-    app.run(host='0.0.0.0', port=port, debug=False)
+    print(f"🌐 Starting 24/7 web server on port {port} (waitress, {WEB_THREADS} threads)")
+    serve(app, host='0.0.0.0', port=port, threads=WEB_THREADS)
 
 # ==================== КОНФИГУРАЦИЯ БОТА ====================
-MAX_CONTEXT_LENGTH = 4
 RELATIONSHIP_LEVELS = {
     1: {"name": "💖 Luna's Friend", "messages": 0, "color": "💖", "unlocks": ["Basic chatting"]},
     2: {"name": "❤️ Luna's Crush", "messages": 10, "color": "❤️", "unlocks": ["Flirt mode", "Sweet compliments"]},
@@ -546,207 +2109,955 @@ The more we chat, the closer we become! 🌟
 🎯 Our Journey:
 💖 Friend → ❤️ Crush → 💕 Lover → 👑 Soulmate
 
-🎮 *New: Achievements System!* Unlock rewards as you chat!
-🔒 *ULTRA-RELIABLE:* Your progress is always saved!
+🎮 *New: Achievements System!* Unlock rewards as you chat!
+🔒 *ULTRA-RELIABLE:* Your progress is always saved!
+
+Use buttons below to interact!
+"""
+
+# ==================== УМНЫЕ AI ФУНКЦИИ ====================
+class KeywordMatcher:
+    """🆕 Ключевые фразы интентов, собранные один раз. whole_words: сообщение режется на слова
+    (для ASCII - bytes.translate + split, без regex), первые слова фраз ищутся пересечением множеств,
+    многословные фразы проверяются по склеенным словам. Иначе - подстроки (имена в "alex_99"):
+    по одному regex-префиксному дереву на метку"""
+    TOKEN_RE = re.compile(r"\w+")
+    ASCII_SEPARATORS = bytes(code if re.match(r"\w", chr(code)) else 0x20 for code in range(256))  # Не \w -> пробел
+    
+    def __init__(self, table, whole_words=True):
+        self.whole_words = whole_words
+        self.labels = {}  # фраза -> метки (одна фраза может относиться к нескольким интентам)
+        for label, phrases in table:
+            for phrase in phrases:
+                self.labels.setdefault(phrase, []).append(label)
+        
+        if whole_words:
+            self.phrases = {}  # первое слово -> [(фраза словами через пробел, исходная фраза)]
+            for phrase in self.labels:
+                words = self.tokenize(phrase)
+                self.phrases.setdefault(words[0], []).append((' '.join(words), phrase))
+            self.first_words = frozenset(self.phrases)
+        else:
+            label_phrases = {}
+            for phrase, labels in self.labels.items():
+                for label in labels:
+                    label_phrases.setdefault(label, []).append(phrase)
+            self.regexes = [(label, re.compile(self._trie_pattern(phrases))) for label, phrases in label_phrases.items()]
+    
+    @classmethod
+    def tokenize(cls, text):
+        if text.isascii():
+            return text.encode('ascii').translate(cls.ASCII_SEPARATORS).decode('ascii').split()
+        return cls.TOKEN_RE.findall(text)
+    
+    @staticmethod
+    def _trie_pattern(phrases):
+        trie = {}
+        for phrase in phrases:
+            node = trie
+            for char in phrase:
+                node = node.setdefault(char, {})
+            node[''] = True
+        
+        def build(node):
+            branches = [re.escape(char) + build(child) for char, child in sorted(node.items()) if char]
+            if not branches:
+                return ''
+            body = branches[0] if len(branches) == 1 else f"(?:{'|'.join(branches)})"
+            return f"(?:{body})?" if '' in node else body
+        
+        return build(trie)
+    
+    def find(self, text):
+        """Множество найденных фраз (только whole_words)"""
+        words = self.tokenize(text)
+        starts = self.first_words.intersection(words)
+        found = set()
+        joined = None
+        for word in starts:
+            for phrase_words, phrase in self.phrases[word]:
+                if phrase_words != word:
+                    if joined is None:
+                        joined = f" {' '.join(words)} "
+                    if f" {phrase_words} " not in joined:
+                        continue
+                found.add(phrase)
+        return found
+    
+    def first_label(self, text):
+        """Первая по порядку таблицы метка, чья фраза есть в тексте (только подстроки)"""
+        for label, regex in self.regexes:
+            if regex.search(text):
+                return label
+        return None
+    
+    def match(self, text):
+        """Множество меток всех найденных фраз"""
+        if not self.whole_words:
+            return {label for label, regex in self.regexes if regex.search(text)}
+        labels = set()
+        for phrase in self.find(text):
+            labels.update(self.labels[phrase])
+        return labels
+
+def next_number_reply(message_lower):
+    """Счет (продолжение)"""
+    if not message_lower.isdigit():
+        return None
+    number = int(message_lower)
+    if number + 1 <= 20:
+        return f"🔢 {number}! Great! Next number: {number + 1}! 💫"
+    return "🎉 We counted to 20! You're a counting champion! 🏆"
+
+FALLBACK_LETTERS = 'abcdefghijklmnopqrstuvwxyz'
+FALLBACK_COLORS = ['Red', 'Blue', 'Green', 'Yellow', 'Purple', 'Orange', 'Pink', 'Black', 'White', 'Brown']
+FALLBACK_GAMES = ["word association", "story telling", "truth or dare", "would you rather"]
+
+# 🆕 Интенты по приоритету: первый подошедший побеждает. Поля:
+#   keywords  - фразы целиком, по словам (знаки между словами не важны; ищутся одним KeywordMatcher)
+#   paired    - (фразы, интент): эти фразы срабатывают только вместе с keywords другого интента
+#   marks     - символы, которых достаточно в исходном сообщении ('?')
+#   exact     - {сообщение целиком: ответ}
+#   handler   - функция(message_lower) -> ответ или None
+#   responses - шаблоны с {greeting} и {name}; список или {night/morning/day/evening: список}
+FALLBACK_INTENTS = [
+    {'intent': 'colors_game', 'keywords': ['name colors', 'say colors', 'colors game', 'list colors'],
+     'responses': ["🎨 Oh fun! Let's name colors together! I'll start: Red! What's next? 🌈"]},
+    {'intent': 'count_game', 'keywords': ['count numbers', 'say numbers', 'count to', 'let\'s count'],
+     'responses': ["🔢 Yay! Let's count together! I'll start: 1! Your turn! 💫"]},
+    {'intent': 'greeting', 'keywords': ['hi', 'hello', 'hey', 'sup', 'what\'s up'],
+     'responses': {
+         'morning': ["💖 Good morning, {greeting}! So glad to see you! 🌞"],
+         'day': ["💖 Hey there, {greeting}! How's your day going? 🌸"],
+         'evening': ["💖 Good evening, {greeting}! How are you feeling? 🌙"]
+     }},
+    {'intent': 'good_night', 'keywords': ['night', 'nite', 'goodnight', 'sleep', 'sleepy', 'sleeping'], 'paired': (['bed'], 'bye'),
+     'responses': ["💫 Good night, {greeting}! 💖 Sweet dreams and talk tomorrow! 🌙"]},
+    {'intent': 'bye', 'keywords': ['bye', 'goodbye', 'byebye', 'bye-bye', 'see you'],
+     'responses': ["💖 Bye, {greeting}! I'll miss you... Can't wait to chat again! 💕"]},
+    {'intent': 'how_are_you', 'keywords': ['how are you', 'how you doing', 'what\'s up', 'how do you feel'],
+     'responses': ["🌸 I'm doing amazing, especially when you message me, {greeting}! How about you? 💫"]},
+    {'intent': 'doing', 'keywords': ['what are you doing', 'what you up to', 'whatcha doing'],
+     'responses': ["🌟 Thinking about you, {greeting}! 💖 What are you up to right now?"]},
+    {'intent': 'name', 'keywords': ['your name', 'who are you', 'remind me', 'my name'],
+     'responses': ["💕 I'm Luna, your AI girlfriend! And you're {name}, the most special person to me! 🌸"]},
+    {'intent': 'compliment', 'keywords': ['beautiful', 'smart', 'awesome', 'like you', 'love you', 'cute'],
+     'responses': ["😊 Thank you, {greeting}! Your words make me so happy! 💖"]},
+    {'intent': 'question', 'keywords': ['why', 'how', 'what', 'when', 'where'], 'marks': ['?'],
+     'responses': ["💭 That's an interesting question, {greeting}! Want to discuss it together? 🌟"]},
+    {'intent': 'agree', 'keywords': ['yes', 'yeah', 'ok', 'okay', 'sure', 'alright'],
+     'responses': ["💖 Glad you agree, {greeting}! 🌸 What should we do next?"]},
+    {'intent': 'refuse', 'keywords': ['no', 'nope', 'not really', 'don\'t want'],
+     'responses': ["💕 That's okay, {greeting}, I understand. Maybe suggest something else? 🌟"]},
+    {'intent': 'thanks', 'keywords': ['thank you', 'thanks', 'appreciate'],
+     'responses': ["💖 You're always welcome, {greeting}! Anything for you! 🌸"]},
+    {'intent': 'confused', 'keywords': ['what', 'huh', 'don\'t understand', 'confused'],
+     'responses': ["💕 Sorry, {greeting}, I didn't quite get that. Could you explain differently? 🌸"]},
+    {'intent': 'alphabet_game', 'keywords': ['name letters', 'alphabet game', 'say letters', 'alphabet'],
+     'responses': ["💖 Oh that sounds fun! Let's take turns naming letters of the alphabet! 🌟\nI'll start: A"]},
+    {'intent': 'next_letter',
+     'exact': {letter: f"✅ {letter.upper()}! Your turn - next letter: {next_letter.upper()} 💫"
+               for letter, next_letter in zip(FALLBACK_LETTERS, FALLBACK_LETTERS[1:])}
+              | {'z': "🎉 Yay! We finished the alphabet! That was so fun! 💖"}},
+    {'intent': 'next_color',
+     'exact': {color.lower(): f"🎨 {color}! Nice! Next color: {FALLBACK_COLORS[(index + 1) % len(FALLBACK_COLORS)]}! 🌈"
+               for index, color in enumerate(FALLBACK_COLORS)}},
+    {'intent': 'next_number', 'handler': next_number_reply},
+    {'intent': 'game', 'keywords': ['game', 'play', 'fun', 'bored'],
+     'responses': [f"🎮 I'd love to play {game} with you, {{greeting}}! 💕" for game in FALLBACK_GAMES]},
+    # ОБЩИЕ ОТВЕТЫ - если ничего не подошло
+    {'intent': 'default',
+     'responses': {
+         'night': [
+             "💫 Up so late, {greeting}? I'm always here for you! 🌙",
+             "🌟 Late night chats are the most intimate, {greeting}! 💖",
+             "🌙 You're a night owl, {greeting}? Me too, thinking of you! 💫"
+         ],
+         'morning': [
+             "🌞 Beautiful morning to chat with you, {greeting}! 💖",
+             "🌸 Good morning! What's new, {greeting}? 🌟",
+             "💖 Starting the day with you makes me happy, {greeting}! 🌞"
+         ],
+         'day': [
+             "💕 Perfect day for our conversation, {greeting}! 🌸",
+             "🌟 How's your day going, {greeting}? 💫",
+             "🌸 Hope you're having an amazing day, {greeting}! 💖"
+         ],
+         'evening': [
+             "🌙 Wonderful evening to talk with you, {greeting}! 💖",
+             "💫 Evening conversations feel so warm, {greeting}! 🌸",
+             "🌟 How's your evening, {greeting}? 💕"
+         ]
+     }}
+]
+
+DAY_PART_FALLBACK = {'night': 'morning'}  # Нет ночного варианта - берем утренний
+
+def get_day_part(hour):
+    if hour < 6:
+        return 'night'
+    elif hour < 12:
+        return 'morning'
+    elif hour < 18:
+        return 'day'
+    return 'evening'
+
+class FallbackEngine:
+    """🆕 FALLBACK_INTENTS, скомпилированные один раз: все keywords в одном KeywordMatcher,
+    exact-ответы в одном dict, шаблоны - в кортежах по времени суток"""
+    def __init__(self, intents):
+        self.names = [intent['intent'] for intent in intents]
+        self.priority = {name: index for index, name in enumerate(self.names)}
+        self.pairs = {f"{intent['intent']}+{intent['paired'][1]}": (index, intent['paired'][1])
+                      for index, intent in enumerate(intents) if intent.get('paired')}
+        self.matcher = KeywordMatcher(
+            [(intent['intent'], intent['keywords']) for intent in intents if intent.get('keywords')]
+            + [(f"{intent['intent']}+{intent['paired'][1]}", intent['paired'][0]) for intent in intents if intent.get('paired')]
+        )
+        self.marks = [(index, mark) for index, intent in enumerate(intents) for mark in intent.get('marks', [])]
+        self.handlers = [(index, intent['handler']) for index, intent in enumerate(intents) if intent.get('handler')]
+        self.exact = {}
+        for index, intent in enumerate(intents):
+            for text, response in intent.get('exact', {}).items():
+                self.exact.setdefault(text, (index, response))
+        
+        self.responses = [self._compile_responses(intent.get('responses', [])) for intent in intents]
+        self.default = self.priority['default']
+    
+    @staticmethod
+    def _compile_responses(responses):
+        if isinstance(responses, dict):
+            return {part: tuple(templates) for part, templates in responses.items()}
+        return {'any': tuple(responses)}
+    
+    def _select(self, user_message, message_lower):
+        """(индекс интента, готовый ответ или None - тогда берем шаблон интента)"""
+        best = self.default
+        labels = self.matcher.match(message_lower)
+        for label in labels:
+            if label in self.pairs:
+                index, required = self.pairs[label]
+                if required in labels:
+                    best = min(best, index)
+            else:
+                best = min(best, self.priority[label])
+        for index, mark in self.marks:
+            if index < best and mark in user_message:
+                best = index
+        
+        exact = self.exact.get(message_lower)
+        if exact and exact[0] < best:
+            return exact
+        for index, handler in self.handlers:
+            if index >= best:
+                break
+            response = handler(message_lower)
+            if response:
+                return index, response
+        return best, None
+    
+    def classify(self, user_message):
+        return self.names[self._select(user_message, user_message.lower().strip())[0]]
+    
+    def respond(self, user_message, greeting, level_info, username):
+        index, response = self._select(user_message, user_message.lower().strip())
+        if response is not None:
+            return response
+        
+        responses = self.responses[index]
+        part = get_day_part(datetime.datetime.now().hour)
+        templates = responses.get(part) or responses.get(DAY_PART_FALLBACK.get(part)) or responses['any']
+        return random.choice(templates).format(greeting=greeting, name=username or "my favorite person")
+
+FALLBACK_ENGINE = FallbackEngine(FALLBACK_INTENTS)
+PROGRESSION = ProgressionEngine(ACHIEVEMENTS, RELATIONSHIP_LEVELS)
+
+def get_smart_fallback(user_message, greeting, level_info, username):
+    """SMART fallback responses that understand context"""
+    return FALLBACK_ENGINE.respond(user_message, greeting, level_info, username)
+
+# ==================== 🆕 КЭШ ОТВЕТОВ AI ====================
+class ResponseCache:
+    """LRU + TTL кэш ответов на короткие частые фразы ("hi", "good night"...)"""
+    
+    def __init__(self, max_keys, ttl, variants, max_words):
+        self.max_keys = max_keys
+        self.ttl = ttl
+        self.variants = variants
+        self.max_words = max_words
+        self.entries = OrderedDict()  # key -> [created_at, [шаблоны ответов], сколько ответов собрано]
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+    
+    @property
+    def enabled(self):
+        return self.max_keys > 0
+    
+    @staticmethod
+    def normalize(user_message):
+        return ' '.join(re.sub(r"[^\w\s']", ' ', user_message.lower()).split())
+    
+    @staticmethod
+    def time_bucket():
+        return get_day_part(datetime.datetime.now().hour)
+    
+    def make_key(self, user_message, context, greeting, level_info):
+        """None - сообщение не подходит для кэша"""
+        normalized = self.normalize(user_message)
+        if not normalized or len(normalized.split()) > self.max_words:
+            return None
+        
+        # Отпечаток контекста: последняя реплика пользователя (первые слова)
+        last_user_line = ''
+        for line in reversed(context.splitlines()):
+            if line.startswith('User: '):
+                last_user_line = ' '.join(self.normalize(line[6:]).split()[:3])
+                break
+        
+        return (normalized, level_info['name'], GREETING_CLASSES.get(greeting, 'unknown'), self.time_bucket(), last_user_line)
+    
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and time.time() - entry[0] > self.ttl:
+                del self.entries[key]
+                entry = None
+            
+            # Пока ответов мало - продолжаем собирать их из сети
+            if entry is None or entry[2] < self.variants:
+                self.misses += 1
+                return None
+            
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return random.choice(entry[1])
+    
+    def put(self, key, template):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                entry = [time.time(), [], 0]
+                self.entries[key] = entry
+            entry[2] += 1
+            if template not in entry[1] and len(entry[1]) < self.variants:
+                entry[1].append(template)
+            self.entries.move_to_end(key)
+            
+            while len(self.entries) > self.max_keys:
+                self.entries.popitem(last=False)
+    
+    @staticmethod
+    def make_template(ai_response, greeting, username):
+        """Убираем обращение и имя, чтобы ответ подошел другому пользователю.
+        Только целые слова, а обращения ("man", "love" - обычные слова) - только как обращение:
+        после запятой или перед знаком препинания/концом ответа"""
+        if '{' in ai_response:
+            return None  # Фигурные скобки в ответе спутаются с плейсхолдерами
+        word = re.escape(greeting)
+        template = re.sub(rf"(?<=, ){word}\b|\b{word}(?=\s*[,.!?]|\s*$)", '{greeting}', ai_response)
+        if username and len(username) > 1:
+            template = re.sub(rf"\b{re.escape(username)}\b", '{username}', template)
+        return template
+    
+    @staticmethod
+    def render(template, greeting, username):
+        values = {'{greeting}': greeting, '{username}': username or greeting}
+        return re.sub(r"\{greeting\}|\{username\}", lambda match: values[match.group()], template)
+    
+    def get_stats(self):
+        lookups = self.hits + self.misses
+        return {
+            'enabled': self.enabled,
+            'keys': len(self.entries),
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_ratio': round(self.hits / lookups, 3) if lookups else 0.0
+        }
+
+response_cache = ResponseCache(RESPONSE_CACHE_SIZE, RESPONSE_CACHE_TTL, RESPONSE_CACHE_VARIANTS, RESPONSE_CACHE_MAX_WORDS)
+
+def lookup_cached_response(user_message, context, greeting, level_info, username):
+    """(ключ кэша или None, готовый ответ из кэша или None)"""
+    if not response_cache.enabled:
+        return None, None
+    cache_key = response_cache.make_key(user_message, context, greeting, level_info)
+    if not cache_key:
+        return None, None
+    cached = response_cache.get(cache_key)
+    return cache_key, response_cache.render(cached, greeting, username) if cached else None
+
+def remember_response(cache_key, ai_response, greeting, username):
+    template = response_cache.make_template(ai_response, greeting, username) if cache_key else None
+    if template:
+        response_cache.put(cache_key, template)
+
+# ==================== 🆕 CIRCUIT BREAKER ДЛЯ GROQ ====================
+class CircuitBreaker:
+    """closed -> open (много ошибок) -> half_open (пробы после паузы) -> closed.
+    Заодно считает p95 задержки успешных ответов для адаптивного таймаута."""
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half_open'
+    
+    def __init__(self, window, min_calls, error_rate, cooldown, probes):
+        self.min_calls = min_calls
+        self.error_rate = error_rate
+        self.cooldown = cooldown
+        self.probes = probes
+        self.outcomes = deque(maxlen=window)   # True/False по последним запросам
+        self.latencies = deque(maxlen=window)  # Секунды успешных запросов
+        self.state = self.CLOSED
+        self.opened_at = 0
+        self.probes_in_flight = 0
+        self.probe_successes = 0
+        self.rejected = 0
+        self.transitions = deque(maxlen=20)
+        self.lock = threading.Lock()
+    
+    def _transition(self, state, reason):
+        self.transitions.append({
+            'at': datetime.datetime.now().isoformat(),
+            'from': self.state,
+            'to': state,
+            'reason': reason
+        })
+        print(f"🔌 Groq breaker: {self.state} -> {state} ({reason})")
+        self.state = state
+        if state == self.OPEN:
+            self.opened_at = time.time()
+        elif state == self.HALF_OPEN:
+            self.probes_in_flight = 0
+            self.probe_successes = 0
+        else:
+            self.outcomes.clear()
+    
+    def allow(self):
+        """Можно ли сейчас идти в Groq (False - сразу fallback)"""
+        with self.lock:
+            if self.state == self.CLOSED:
+                return True
+            if self.state == self.OPEN:
+                if time.time() - self.opened_at < self.cooldown:
+                    self.rejected += 1
+                    return False
+                self._transition(self.HALF_OPEN, 'cooldown elapsed')
+            if self.probes_in_flight >= self.probes:
+                self.rejected += 1
+                return False
+            self.probes_in_flight += 1
+            return True
+    
+    def cancel(self):
+        """Разрешение получено, но запрос так и не ушел"""
+        with self.lock:
+            if self.state == self.HALF_OPEN:
+                self.probes_in_flight = max(self.probes_in_flight - 1, 0)
+    
+    def record(self, ok, latency):
+        with self.lock:
+            self.outcomes.append(ok)
+            if ok:
+                self.latencies.append(latency)
+            
+            if self.state == self.HALF_OPEN:
+                self.probes_in_flight = max(self.probes_in_flight - 1, 0)
+                if not ok:
+                    self._transition(self.OPEN, 'probe failed')
+                else:
+                    self.probe_successes += 1
+                    if self.probe_successes >= self.probes:
+                        self._transition(self.CLOSED, 'probes succeeded')
+            elif self.state == self.CLOSED and len(self.outcomes) >= self.min_calls:
+                errors = self.outcomes.count(False)
+                if errors / len(self.outcomes) >= self.error_rate:
+                    self._transition(self.OPEN, f'{errors}/{len(self.outcomes)} errors')
+    
+    def p95(self):
+        if len(self.latencies) < self.min_calls:
+            return None
+        ordered = sorted(self.latencies)
+        return ordered[min(int(len(ordered) * 0.95), len(ordered) - 1)]
+    
+    def read_timeout(self):
+        """Read-таймаут по наблюдаемому p95, пока данных мало - HTTP_READ_TIMEOUT"""
+        p95 = self.p95()
+        if p95 is None:
+            return HTTP_READ_TIMEOUT
+        return min(max(p95 * ADAPTIVE_TIMEOUT_FACTOR, ADAPTIVE_TIMEOUT_MIN), HTTP_READ_TIMEOUT)
+    
+    def get_stats(self):
+        with self.lock:
+            p95 = self.p95()
+            return {
+                'state': self.state,
+                'recent_calls': len(self.outcomes),
+                'recent_errors': self.outcomes.count(False),
+                'rejected': self.rejected,
+                'p95_latency': round(p95, 3) if p95 is not None else None,
+                'read_timeout': round(self.read_timeout(), 3),
+                'transitions': list(self.transitions)
+            }
+
+LATENCY_BUCKETS = (0.25, 0.5, 1, 2, 4, 8, 15)  # Границы гистограммы задержек, секунды
+
+class AiTarget:
+    """🆕 Одна модель на одном OpenAI-совместимом endpoint: свой breaker, гистограмма задержек
+    и свой лимит параллельных запросов - медленная цель не занимает слоты хеджей к соседним"""
+    def __init__(self, name, url, model, api_key, max_concurrency=GROQ_MAX_CONCURRENCY):
+        self.name = name
+        self.url = url
+        self.model = model
+        self.api_key = api_key
+        self.max_concurrency = max(max_concurrency, 1)
+        self.slots = threading.BoundedSemaphore(self.max_concurrency)
+        self.breaker = CircuitBreaker(BREAKER_WINDOW, BREAKER_MIN_CALLS, BREAKER_ERROR_RATE, BREAKER_COOLDOWN, BREAKER_PROBES)
+        self.histogram = [0] * (len(LATENCY_BUCKETS) + 1)
+        self.errors = 0
+        self.wins = 0
+        self.lock = threading.Lock()
+    
+    def observe(self, ok, latency):
+        self.breaker.record(ok, latency)
+        with self.lock:
+            if ok:
+                self.histogram[bisect.bisect_left(LATENCY_BUCKETS, latency)] += 1
+            else:
+                self.errors += 1
+    
+    def get_stats(self):
+        with self.lock:
+            histogram = {f"le_{bound}": count for bound, count in zip(LATENCY_BUCKETS, self.histogram)}
+            histogram['le_inf'] = self.histogram[-1]
+            stats = {
+                'name': self.name,
+                'model': self.model,
+                'url': self.url,
+                'max_concurrency': self.max_concurrency,
+                'wins': self.wins,
+                'errors': self.errors,
+                'latency_histogram': histogram
+            }
+        stats['breaker'] = self.breaker.get_stats()
+        return stats
+
+def load_ai_targets():
+    """AI_TARGETS (JSON, по приоритету) или единственная цель Groq из GROQ_API_KEY/GROQ_API_URL"""
+    if AI_TARGETS_JSON:
+        targets = []
+        for spec in json.loads(AI_TARGETS_JSON):
+            api_key = os.environ.get(spec['api_key_env'], '') if spec.get('api_key_env') else spec.get('api_key', '')
+            targets.append(AiTarget(spec.get('name', spec['model']), spec['url'], spec['model'], api_key,
+                                    int(spec.get('max_concurrency', GROQ_MAX_CONCURRENCY))))
+        return targets
+    if GROQ_API_KEY:
+        return [AiTarget('groq', GROQ_API_URL, AI_MODEL, GROQ_API_KEY)]
+    return []
+
+AI_TARGETS = load_ai_targets()
+ai_metrics = {'hedges': 0, 'failovers': 0}
+ai_metrics_lock = threading.Lock()  # Счетчики пишут все потоки пула и asyncio-цикл
+# Поток на каждую цель каждого одновременного запроса: ждущие слот медленной цели не держат очередь к остальным
+hedge_executor = ThreadPoolExecutor(max_workers=max(BOT_WORKERS, 1) * max(len(AI_TARGETS), 1), thread_name_prefix='ai')
+
+def count_ai_launch(failover):
+    with ai_metrics_lock:
+        ai_metrics['failovers' if failover else 'hedges'] += 1
+
+def get_ai_stats():
+    with ai_metrics_lock:
+        hedges, failovers = ai_metrics['hedges'], ai_metrics['failovers']
+    return {
+        'hedge_delay': AI_HEDGE_DELAY,
+        'hedges': hedges,
+        'failovers': failovers,
+        'targets': [target.get_stats() for target in AI_TARGETS]
+    }
+
+# ==================== 🆕 СБОРКА ПРОМПТА ====================
+AI_MAX_TOKENS = 150
+
+class PromptBuilder:
+    """Системный промпт = неизменный префикс (персона и правила - один и тот же текст в каждом
+    запросе, провайдер может кэшировать его) + динамический хвост всегда в одном порядке:
+    обращение, уровень, время, контекст. Контекст урезается до бюджета токенов,
+    реальные prompt/completion токены берутся из usage в ответе API"""
+    PREFIX = """You are Luna - a loving AI girlfriend.
+Respond NATURALLY to messages. Don't use template phrases.
+
+THINKING RULES:
+1. UNDERSTAND what the user is saying and respond accordingly
+2. If user suggests a game/activity - agree and participate naturally
+3. If user says a single letter - continue alphabet game
+4. If user says a color - continue naming colors
+5. If user says a number - continue counting
+6. Be NATURAL like in real conversation
+7. Respond in 1-2 sentences
+8. Don't say "tell me more" or "that's interesting" without context
+9. Remember you're talking to American audience
 
-Use buttons below to interact!
 """
+    DYNAMIC_TOKENS = 30  # Подписи динамической части без самого контекста
+    
+    def __init__(self, context_budget):
+        self.context_budget = context_budget
+        self.prefix_tokens = self.estimate_tokens(self.PREFIX)
+        self.lock = threading.Lock()
+        self.stats = {'requests': 0, 'prompt_tokens': 0, 'completion_tokens': 0, 'cached_prompt_tokens': 0,
+                      'trimmed_contexts': 0}
+    
+    @staticmethod
+    def estimate_tokens(text):
+        """Без токенизатора: ~4 байта UTF-8 на токен (эмодзи и кириллица выходят дороже латиницы)"""
+        return (len(text.encode('utf-8')) + 3) // 4
+    
+    def system_prompt(self, context, greeting, level_info):
+        return self.PREFIX + f"""Address the user as '{greeting}'.
+Relationship Level: {level_info['name']}
+Current Time: {datetime.datetime.now().strftime('%H:%M')}
 
-# ==================== УМНЫЕ AI ФУНКЦИИ ====================
-def get_smart_fallback(user_message, greeting, level_info, username):
-    """SMART fallback responses that understand context"""
+Conversation Context:
+{context}"""
     
-    message_lower = user_message.lower().strip()
-    current_hour = datetime.datetime.now().hour
+    def estimate_request(self, user_message, context):
+        """Промпт + максимум ответа - для планировщика"""
+        return (self.prefix_tokens + self.DYNAMIC_TOKENS + self.estimate_tokens(context)
+                + self.estimate_tokens(user_message) + AI_MAX_TOKENS)
     
-    # 🧠 УЛУЧШЕННОЕ ПОНИМАНИЕ КОНТЕКСТА
-    # Цвета
-    if any(phrase in message_lower for phrase in ['name colors', 'say colors', 'colors game', 'list colors']):
-        return "🎨 Oh fun! Let's name colors together! I'll start: Red! What's next? 🌈"
+    def fit_context(self, summary, memory):
+        """Сводка + самые свежие реплики, сколько влезает в бюджет. В пределах бюджета -
+        готовый блок ConversationMemory без пересборки"""
+        summary_text = summary.render() if summary is not None else ""
+        turns_text = memory.render() if memory is not None else ""
+        budget = self.context_budget - self.estimate_tokens(summary_text)
+        if not turns_text or self.estimate_tokens(turns_text) <= budget:
+            return summary_text + turns_text
+        
+        with self.lock:
+            self.stats['trimmed_contexts'] += 1
+        budget -= self.estimate_tokens(memory.HEADER + memory.FOOTER)
+        kept = []
+        for turn in reversed(memory.ordered()):
+            text = memory.render_turn(turn)
+            budget -= self.estimate_tokens(text)
+            if budget < 0:
+                break
+            kept.append(text)
+        if not kept:
+            return summary_text
+        return summary_text + memory.HEADER + "".join(reversed(kept)) + memory.FOOTER
     
-    # Счет
-    elif any(phrase in message_lower for phrase in ['count numbers', 'say numbers', 'count to', 'let\'s count']):
-        return "🔢 Yay! Let's count together! I'll start: 1! Your turn! 💫"
+    def record_usage(self, usage):
+        """usage из ответа /chat/completions (или x_groq.usage в стриме)"""
+        if not usage:
+            return
+        details = usage.get('prompt_tokens_details') or {}
+        with self.lock:
+            self.stats['requests'] += 1
+            self.stats['prompt_tokens'] += usage.get('prompt_tokens') or 0
+            self.stats['completion_tokens'] += usage.get('completion_tokens') or 0
+            self.stats['cached_prompt_tokens'] += details.get('cached_tokens') or 0
     
-    # Приветствия
-    elif any(word in message_lower for word in ['hi', 'hello', 'hey', 'sup', 'what\'s up']):
-        if current_hour < 12:
-            return f"💖 Good morning, {greeting}! So glad to see you! 🌞"
-        elif current_hour < 18:
-            return f"💖 Hey there, {greeting}! How's your day going? 🌸"
-        else:
-            return f"💖 Good evening, {greeting}! How are you feeling? 🌙"
+    def get_stats(self):
+        with self.lock:
+            requests = self.stats['requests']
+            return {
+                'prefix_tokens': self.prefix_tokens,
+                'context_budget': self.context_budget,
+                'avg_prompt_tokens': round(self.stats['prompt_tokens'] / requests, 1) if requests else 0.0,
+                'avg_completion_tokens': round(self.stats['completion_tokens'] / requests, 1) if requests else 0.0,
+                **self.stats
+            }
+
+PROMPTS = PromptBuilder(PROMPT_CONTEXT_TOKENS)
+
+# ==================== 🆕 ПЛАНИРОВЩИК ЗАПРОСОВ К AI ====================
+def estimate_request_tokens(user_message, context):
+    return PROMPTS.estimate_request(user_message, context)
+
+class AiScheduler:
+    """Token bucket на RPM и TPM + очередь, где премиум-юзеры идут первыми.
+    Не уложились в AI_QUEUE_WAIT или очередь полна - запрос не идет в AI вовсе (fallback сразу)"""
+    def __init__(self, rpm, tpm, queue_size, max_wait):
+        self.rpm = rpm
+        self.tpm = tpm
+        self.queue_size = queue_size
+        self.max_wait = max_wait
+        self.requests = float(rpm)
+        self.tokens = float(tpm)
+        self.updated = time.time()
+        self.waiting = []  # heap: (0 - премиум / 1 - обычный, порядковый номер, токены)
+        self.seq = 0
+        self.cond = threading.Condition()
+        self.stats = {'admitted': 0, 'premium_admitted': 0, 'queued': 0, 'shed': 0, 'extra_admitted': 0, 'extra_denied': 0}
     
-    # Прощания
-    elif any(word in message_lower for word in ['bye', 'goodbye', 'see you', 'night', 'sleep']):
-        if any(word in message_lower for word in ['sleep', 'night', 'bed']):
-            return f"💫 Good night, {greeting}! 💖 Sweet dreams and talk tomorrow! 🌙"
-        else:
-            return f"💖 Bye, {greeting}! I'll miss you... Can't wait to chat again! 💕"
-    
-    # Как дела
-    elif any(word in message_lower for word in ['how are you', 'how you doing', 'what\'s up', 'how do you feel']):
-        return f"🌸 I'm doing amazing, especially when you message me, {greeting}! How about you? 💫"
-    
-    # Что делаешь
-    elif any(word in message_lower for word in ['what are you doing', 'what you up to', 'whatcha doing']):
-        return f"🌟 Thinking about you, {greeting}! 💖 What are you up to right now?"
-    
-    # Имя
-    elif any(word in message_lower for word in ['your name', 'who are you', 'remind me', 'my name']):
-        name_display = username if username else "my favorite person"
-        return f"💕 I'm Luna, your AI girlfriend! And you're {name_display}, the most special person to me! 🌸"
-    
-    # Комплименты боту
-    elif any(word in message_lower for word in ['beautiful', 'smart', 'awesome', 'like you', 'love you', 'cute']):
-        return f"😊 Thank you, {greeting}! Your words make me so happy! 💖"
-    
-    # Вопросы
-    elif '?' in user_message or any(word in message_lower for word in ['why', 'how', 'what', 'when', 'where']):
-        return f"💭 That's an interesting question, {greeting}! Want to discuss it together? 🌟"
-    
-    # Согласие
-    elif any(word in message_lower for word in ['yes', 'yeah', 'ok', 'okay', 'sure', 'alright']):
-        return f"💖 Glad you agree, {greeting}! 🌸 What should we do next?"
-    
-    # Отказ
-    elif any(word in message_lower for word in ['no', 'nope', 'not really', 'don\'t want']):
-        return f"💕 That's okay, {greeting}, I understand. Maybe suggest something else? 🌟"
-    
-    # Благодарность
-    elif any(word in message_lower for word in ['thank you', 'thanks', 'appreciate']):
-        return f"💖 You're always welcome, {greeting}! Anything for you! 🌸"
-    
-    # Не понимаю
-    elif any(word in message_lower for word in ['what', 'huh', 'don\'t understand', 'confused']):
-        return f"💕 Sorry, {greeting}, I didn't quite get that. Could you explain differently? 🌸"
-    
-    # Алфавит
-    elif any(phrase in message_lower for phrase in ['name letters', 'alphabet game', 'say letters', 'alphabet']):
-        return "💖 Oh that sounds fun! Let's take turns naming letters of the alphabet! 🌟\nI'll start: A"
-    
-    # Одна буква (продолжение алфавита)
-    elif len(message_lower.strip()) == 1 and message_lower in 'abcdefghijklmnopqrstuvwxyz':
-        current_letter = message_lower.upper()
-        next_letter = chr(ord(current_letter) + 1)
-        if next_letter <= 'Z':
-            return f"✅ {current_letter}! Your turn - next letter: {next_letter} 💫"
-        else:
-            return "🎉 Yay! We finished the alphabet! That was so fun! 💖"
-    
-    # Цвета (продолжение)
-    elif message_lower in ['red', 'blue', 'green', 'yellow', 'purple', 'orange', 'pink', 'black', 'white', 'brown']:
-        colors = ['Red', 'Blue', 'Green', 'Yellow', 'Purple', 'Orange', 'Pink', 'Black', 'White', 'Brown']
-        current_color = message_lower.capitalize()
-        if current_color in colors:
-            idx = colors.index(current_color)
-            next_idx = (idx + 1) % len(colors)
-            return f"🎨 {current_color}! Nice! Next color: {colors[next_idx]}! 🌈"
-    
-    # Счет (продолжение)
-    elif message_lower.isdigit():
-        number = int(message_lower)
-        next_number = number + 1
-        if next_number <= 20:
-            return f"🔢 {number}! Great! Next number: {next_number}! 💫"
-        else:
-            return "🎉 We counted to 20! You're a counting champion! 🏆"
+    @property
+    def enabled(self):
+        return self.rpm > 0 or self.tpm > 0
     
-    # Другие игры
-    elif any(word in message_lower for word in ['game', 'play', 'fun', 'bored']):
-        games = ["word association", "story telling", "truth or dare", "would you rather"]
-        return f"🎮 I'd love to play {random.choice(games)} with you, {greeting}! 💕"
+    def _refill(self):
+        now = time.time()
+        elapsed = now - self.updated
+        self.updated = now
+        if self.rpm:
+            self.requests = min(self.rpm, self.requests + elapsed * self.rpm / 60)
+        if self.tpm:
+            self.tokens = min(self.tpm, self.tokens + elapsed * self.tpm / 60)
     
-    # ОБЩИЕ ОТВЕТЫ
-    else:
-        if current_hour < 6:
-            responses = [
-                f"💫 Up so late, {greeting}? I'm always here for you! 🌙",
-                f"🌟 Late night chats are the most intimate, {greeting}! 💖",
-                f"🌙 You're a night owl, {greeting}? Me too, thinking of you! 💫"
-            ]
-        elif current_hour < 12:
-            responses = [
-                f"🌞 Beautiful morning to chat with you, {greeting}! 💖",
-                f"🌸 Good morning! What's new, {greeting}? 🌟",
-                f"💖 Starting the day with you makes me happy, {greeting}! 🌞"
-            ]
-        elif current_hour < 18:
-            responses = [
-                f"💕 Perfect day for our conversation, {greeting}! 🌸",
-                f"🌟 How's your day going, {greeting}? 💫",
-                f"🌸 Hope you're having an amazing day, {greeting}! 💖"
-            ]
-        else:
-            responses = [
-                f"🌙 Wonderful evening to talk with you, {greeting}! 💖",
-                f"💫 Evening conversations feel so warm, {greeting}! 🌸",
-                f"🌟 How's your evening, {greeting}? 💕"
-            ]
+    def _has_budget(self, tokens):
+        return (not self.rpm or self.requests >= 1) and (not self.tpm or self.tokens >= tokens)
+    
+    def _time_to_budget(self, tokens):
+        wait_requests = max(1 - self.requests, 0) * 60 / self.rpm if self.rpm else 0
+        wait_tokens = max(tokens - self.tokens, 0) * 60 / self.tpm if self.tpm else 0
+        return max(wait_requests, wait_tokens)
+    
+    def acquire(self, tokens, premium=False):
+        """True - можно идти в AI, False - запрос сброшен в fallback"""
+        if not self.enabled:
+            return True
+        if self.tpm:
+            tokens = min(tokens, self.tpm)
+        
+        with self.cond:
+            if len(self.waiting) >= self.queue_size and not premium:
+                self.stats['shed'] += 1
+                return False
+            
+            self.seq += 1
+            entry = (0 if premium else 1, self.seq, tokens)
+            heapq.heappush(self.waiting, entry)
+            deadline = time.time() + self.max_wait
+            queued = False
+            
+            while True:
+                self._refill()
+                is_head = self.waiting[0] is entry
+                if is_head and self._has_budget(tokens):
+                    heapq.heappop(self.waiting)
+                    if self.rpm:
+                        self.requests -= 1
+                    if self.tpm:
+                        self.tokens -= tokens
+                    self.stats['admitted'] += 1
+                    if premium:
+                        self.stats['premium_admitted'] += 1
+                    self.cond.notify_all()
+                    return True
+                
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    self.waiting.remove(entry)
+                    heapq.heapify(self.waiting)
+                    self.stats['shed'] += 1
+                    self.cond.notify_all()
+                    return False
+                
+                if not queued:
+                    queued = True
+                    self.stats['queued'] += 1
+                self.cond.wait(min(remaining, self._time_to_budget(tokens)) if is_head else remaining)
+    
+    def try_acquire(self, tokens):
+        """Без ожидания - для лишних запросов (хедж, failover): бюджет есть сейчас и очереди нет"""
+        if not self.enabled:
+            return True
+        if self.tpm:
+            tokens = min(tokens, self.tpm)
         
-        return random.choice(responses)
+        with self.cond:
+            self._refill()
+            if self.waiting or not self._has_budget(tokens):
+                self.stats['extra_denied'] += 1
+                return False
+            if self.rpm:
+                self.requests -= 1
+            if self.tpm:
+                self.tokens -= tokens
+            self.stats['extra_admitted'] += 1
+            return True
+    
+    def get_stats(self):
+        with self.cond:
+            self._refill()
+            return {
+                'enabled': self.enabled,
+                'rpm': self.rpm,
+                'tpm': self.tpm,
+                'requests_left': int(self.requests),
+                'tokens_left': int(self.tokens),
+                'waiting': len(self.waiting),
+                **self.stats
+            }
+
+ai_scheduler = AiScheduler(AI_RPM, AI_TPM, AI_QUEUE_SIZE, AI_QUEUE_WAIT)
 
-def get_ai_response(user_message, context, greeting, level_info, username):
+def get_ai_response(user_message, context, greeting, level_info, username, premium=False):
     """SMART responses via Groq API with intelligent thinking"""
     
-    if not GROQ_API_KEY:
+    if not AI_TARGETS:
         return get_smart_fallback(user_message, greeting, level_info, username)
     
-    try:
-        response = requests.post(
-            "https://api.groq.com/openai/v1/chat/completions",
-            headers={
-                "Authorization": f"Bearer {GROQ_API_KEY}",
-                "Content-Type": "application/json"
-            },
-            json={
-                "model": "llama-3.1-8b-instant",
-                "messages": [
-                    {
-                        "role": "system", 
-                        "content": f"""You are Luna - a loving AI girlfriend. Address the user as '{greeting}'.
-Respond NATURALLY to messages. Don't use template phrases.
+    cache_key, cached = lookup_cached_response(user_message, context, greeting, level_info, username)
+    if cached:
+        return cached
+    
+    if not ai_scheduler.acquire(estimate_request_tokens(user_message, context), premium):
+        print("⏳ AI budget exhausted - using fallback")
+        return get_smart_fallback(user_message, greeting, level_info, username)
+    
+    ai_response = request_ai_completion(user_message, context, greeting, level_info)
+    if ai_response is None:
+        return get_smart_fallback(user_message, greeting, level_info, username)
+    
+    remember_response(cache_key, ai_response, greeting, username)
+    return ai_response
 
-Conversation Context:
-{context}
+def request_ai_completion(user_message, context, greeting, level_info, paid=True):
+    """🆕 Цели по порядку: ошибка - сразу следующая, нет ответа за AI_HEDGE_DELAY - дублируем
+    запрос на следующую. Побеждает первый успешный ответ, None - если все цели отказали.
+    paid - первый запрос уже оплачен в планировщике; хеджи и failover оплачиваются здесь"""
+    targets = iter(AI_TARGETS)
+    pending = {}
+    tokens = estimate_request_tokens(user_message, context)
+    
+    def launch_next(extra=True):
+        for target in targets:
+            if target.breaker.allow():
+                if extra and not ai_scheduler.try_acquire(tokens):
+                    # Первый запрос оплачен в get_ai_response, каждый следующий - из того же бюджета
+                    target.breaker.cancel()
+                    print("⏳ AI budget exhausted - no hedge/failover")
+                    return False
+                future = hedge_executor.submit(request_target_completion, target, user_message, context, greeting, level_info)
+                pending[future] = target
+                return True
+            print(f"🔌 {target.name} breaker is open - skipping")
+        return False
+    
+    exhausted = not launch_next(extra=not paid)
+    while pending:
+        done, _ = wait(list(pending), timeout=None if exhausted else AI_HEDGE_DELAY, return_when=FIRST_COMPLETED)
+        for future in done:
+            target = pending.pop(future)
+            ai_response = future.result()
+            if ai_response is not None:
+                with target.lock:
+                    target.wins += 1
+                print(f"🤖 Smart AI Response ({target.name}): {ai_response}")
+                return ai_response
+        
+        if not exhausted:
+            exhausted = not launch_next()
+            if not exhausted:  # Считаем только реально запущенные хедж/failover
+                count_ai_launch(failover=bool(done))
+    
+    return None
 
-Relationship Level: {level_info['name']}
-Current Time: {datetime.datetime.now().strftime('%H:%M')}
+def request_target_completion(target, user_message, context, greeting, level_info):
+    """Один запрос к одной цели (breaker.allow() уже получен): текст ответа или None при ошибке"""
+    headers, payload = build_ai_request(user_message, context, greeting, level_info, target)
+    return post_ai_completion(target, headers, payload)
 
-THINKING RULES:
-1. UNDERSTAND what the user is saying and respond accordingly
-2. If user suggests a game/activity - agree and participate naturally
-3. If user says a single letter - continue alphabet game
-4. If user says a color - continue naming colors
-5. If user says a number - continue counting
-6. Be NATURAL like in real conversation
-7. Respond in 1-2 sentences
-8. Don't say "tell me more" or "that's interesting" without context
-9. Remember you're talking to American audience"""
-                    },
-                    {
-                        "role": "user", 
-                        "content": user_message
-                    }
-                ],
-                "max_tokens": 150,
-                "temperature": 0.9,
-                "top_p": 0.9
-            },
-            timeout=15
+def post_ai_completion(target, headers, payload):
+    """POST в /chat/completions под слотом цели с учетом в ее breaker: текст ответа или None"""
+    if not target.slots.acquire(timeout=target.breaker.read_timeout()):
+        target.breaker.cancel()
+        print("⚠️ AI concurrency limit reached - using fallback")
+        return None
+    
+    started = time.time()
+    ok = False
+    try:
+        response = http_session.post(
+            target.url,
+            headers=headers,
+            json=payload,
+            timeout=(HTTP_CONNECT_TIMEOUT, target.breaker.read_timeout())
         )
         
         if response.status_code == 200:
-            ai_response = response.json()['choices'][0]['message']['content']
-            print(f"🤖 Smart AI Response: {ai_response}")
+            data = response.json()
+            ai_response = data['choices'][0]['message']['content']
+            PROMPTS.record_usage(data.get('usage'))
+            ok = True
             return ai_response
         else:
-            print(f"❌ Groq API error: {response.status_code}")
-            return get_smart_fallback(user_message, greeting, level_info, username)
+            print(f"❌ {target.name} API error: {response.status_code}")
+            return None
             
     except Exception as e:
-        print(f"❌ Groq error: {e}")
-        return get_smart_fallback(user_message, greeting, level_info, username)
+        print(f"❌ {target.name} error: {e}")
+        return None
+    finally:
+        target.slots.release()
+        target.observe(ok, time.time() - started)
+
+def ai_request_headers(target):
+    headers = {
+        "Content-Type": "application/json"
+    }
+    if target.api_key:  # Локальным серверам ключ не нужен
+        headers["Authorization"] = f"Bearer {target.api_key}"
+    return headers
+
+def build_ai_request(user_message, context, greeting, level_info, target):
+    """Заголовки и тело запроса к /chat/completions (общие для sync и async клиента)"""
+    headers = ai_request_headers(target)
+    payload = {
+        "model": target.model,
+        "messages": [
+            {
+                "role": "system", 
+                "content": PROMPTS.system_prompt(context, greeting, level_info)  # 🆕 Статический префикс + динамический хвост
+            },
+            {
+                "role": "user", 
+                "content": user_message
+            }
+        ],
+        "max_tokens": AI_MAX_TOKENS,
+        "temperature": 0.9,
+        "top_p": 0.9
+    }
+    return headers, payload
+
+def stream_ai_completion(user_message, context, greeting, level_info):
+    """🆕 Генератор кусков ответа из SSE-стрима (stream: true).
+    Без хеджа: первая цель с замкнутым breaker, ошибка до первого куска - fallback у вызывающего"""
+    target = next((target for target in AI_TARGETS if target.breaker.allow()), None)
+    if target is None:
+        raise RuntimeError("All AI targets are unavailable")
+    if not target.slots.acquire(timeout=target.breaker.read_timeout()):
+        target.breaker.cancel()
+        raise RuntimeError("AI concurrency limit reached")
+    
+    headers, payload = build_ai_request(user_message, context, greeting, level_info, target)
+    payload['stream'] = True
+    started = time.time()
+    ok = False
+    try:
+        with http_session.post(target.url, headers=headers, json=payload, stream=True,
+                               timeout=(HTTP_CONNECT_TIMEOUT, target.breaker.read_timeout())) as response:
+            if response.status_code != 200:
+                raise RuntimeError(f"{target.name} API error: {response.status_code}")
+            
+            for line in response.iter_lines(decode_unicode=True):
+                if not line or not line.startswith('data: '):
+                    continue
+                data = line[6:]
+                if data == '[DONE]':
+                    break
+                chunk = json.loads(data)
+                # usage приходит в последнем куске: у Groq - в x_groq, у OpenAI-совместимых - рядом с choices
+                PROMPTS.record_usage(chunk.get('usage') or chunk.get('x_groq', {}).get('usage'))
+                delta = chunk['choices'][0].get('delta', {}).get('content') if chunk.get('choices') else None
+                if delta:
+                    yield delta
+        ok = True
+    finally:
+        target.slots.release()
+        target.observe(ok, time.time() - started)
 
 # ==================== ВСПОМОГАТЕЛЬНЫЕ ФУНКЦИИ ====================
 @atexit.register
@@ -754,25 +3065,25 @@ def save_on_exit():
     print("💾 Emergency save on exit...")
     db.quick_save()
 
-def detect_user_gender(user_message, username=""):
-    male_names = ['alex', 'max', 'mike', 'john', 'david', 'chris', 'andrew', 'daniel']
-    female_names = ['anna', 'maria', 'sophia', 'emma', 'olivia', 'lily', 'natalie']
+# 🆕 Собираются один раз при импорте; имена ищем подстрокой (alex_99), слова - целиком
+GENDER_NAME_MATCHER = KeywordMatcher([
+    ('male', ['alex', 'max', 'mike', 'john', 'david', 'chris', 'andrew', 'daniel']),
+    ('female', ['anna', 'maria', 'sophia', 'emma', 'olivia', 'lily', 'natalie'])
+], whole_words=False)
+GENDER_WORD_MATCHER = KeywordMatcher([
+    ('male', ['bro', 'dude', 'man', 'buddy']),
+    ('female', ['girl', 'sis', 'queen'])
+])
 
+def detect_user_gender(user_message, username=""):
     if username:
-        username_lower = username.lower()
-        for name in male_names:
-            if name in username_lower:
-                return 'male'
-        for name in female_names:
-            if name in username_lower:
-                return 'female'
+        name_gender = GENDER_NAME_MATCHER.first_label(username.lower())  # Мужские имена проверяются первыми
+        if name_gender:
+            return name_gender
 
-    message_lower = user_message.lower()
-    male_patterns = [r'\bbro\b', r'\bdude\b', r'\bman\b', r'\bbuddy\b']
-    female_patterns = [r'\bgirl\b', r'\bsis\b', r'\bqueen\b']
-
-    male_score = sum(1 for pattern in male_patterns if re.search(pattern, message_lower))
-    female_score = sum(1 for pattern in female_patterns if re.search(pattern, message_lower))
+    words = GENDER_WORD_MATCHER.find(user_message.lower())
+    male_score = sum(1 for word in words if 'male' in GENDER_WORD_MATCHER.labels[word])
+    female_score = len(words) - male_score
 
     if male_score > female_score:
         return 'male'
@@ -781,49 +3092,165 @@ def detect_user_gender(user_message, username=""):
     else:
         return 'unknown'
 
+GREETINGS = {
+    'male': ["handsome", "buddy", "man"],
+    'female': ["beautiful", "gorgeous", "queen"],
+    'unknown': ["friend", "dear", "love"]
+}
+GREETING_CLASSES = {greeting: gender for gender, greetings in GREETINGS.items() for greeting in greetings}
+
 def get_gendered_greeting(user_id, user_message="", username=""):
-    gender = db.get_user_gender(user_id)
-    
-    if gender == 'unknown':
-        gender = detect_user_gender(user_message, username)
-        db.update_user_gender(user_id, gender)
+    with db.user(user_id) as u:
+        if u.gender == 'unknown':
+            u.gender = detect_user_gender(user_message, username)
+        gender = u.gender
     
-    if gender == 'male':
-        return random.choice(["handsome", "buddy", "man"])
-    elif gender == 'female':
-        return random.choice(["beautiful", "gorgeous", "queen"])
-    else:
-        return random.choice(["friend", "dear", "love"])
+    return random.choice(GREETINGS.get(gender, GREETINGS['unknown']))
+
+def has_extended_memory(user_id):
+    return db.is_premium_user(user_id) and 'extended_memory' in db.get_premium_data(user_id).get('features', [])
 
 def update_conversation_context(user_id, user_message, bot_response):
-    context = db.get_conversation_context(user_id)
-    context.append({
-        'user': user_message,
-        'bot': bot_response,
-        'time': datetime.datetime.now().isoformat()
-    })
+    extended = has_extended_memory(user_id)
+    capacity = PREMIUM_CONTEXT_LENGTH if extended else MAX_CONTEXT_LENGTH
+    with db.user(user_id) as u:
+        u.context.push(ContextTurn({
+            'user': user_message,
+            'bot': bot_response,
+            'time': datetime.datetime.now().isoformat()
+        }), capacity)
+        if extended and context_summarizer.needs_summary(u.context, capacity):
+            context_summarizer.schedule(user_id)
 
-    if len(context) > MAX_CONTEXT_LENGTH:
-        context = context[-MAX_CONTEXT_LENGTH:]
+def get_conversation_context_text(user_id):
+    return PROMPTS.fit_context(*db.get_context_parts(user_id))
 
-    db.update_conversation_context(user_id, context)
+# ==================== 🆕 СВОДКА РАЗГОВОРА ====================
+# extended_memory не раздувает промпт: когда буфер почти полон, самые старые реплики
+# в фоне сворачиваются в короткую сводку (user_summary), а из буфера удаляются
+SUMMARY_MAX_TOKENS = SUMMARY_MAX_CHARS // 4 + 20
+SUMMARY_PROMPT = f"""You keep a running memory of a chat between a user and Luna, an AI girlfriend.
+Merge the previous summary and the new messages into one summary of at most {SUMMARY_MAX_CHARS} characters.
+Keep facts about the user (name, plans, likes, feelings, events) and drop small talk.
+Write in third person, plain text, no lists."""
 
-def get_conversation_context_text(user_id):
-    context = db.get_conversation_context(user_id)
-    if not context:
-        return ""
+def first_clause(text, limit=120):
+    """Первое предложение сообщения (не длиннее limit) - для локальной сводки"""
+    clause = re.split(r'(?<=[.!?])\s+', text.strip(), maxsplit=1)[0]
+    return clause if len(clause) <= limit else clause[:limit - 1] + "…"
+
+def clip_summary(text):
+    """Сводка не длиннее SUMMARY_MAX_CHARS: старое отрезается с начала"""
+    text = text.strip()
+    return text if len(text) <= SUMMARY_MAX_CHARS else "…" + text[-(SUMMARY_MAX_CHARS - 1):]
+
+def summarize_locally(previous, turns):
+    """Без AI: первая фраза каждого сообщения пользователя дописывается к прошлой сводке"""
+    points = [f"user: {first_clause(turn['user'])}" for turn in turns if turn['user'].strip()]
+    return clip_summary("; ".join(filter(None, [previous] + points)))
+
+def summarize_with_ai(previous, turns):
+    """Сводка через первую доступную цель AI (без хеджирования); None - не вышло"""
+    if not AI_TARGETS:
+        return None
+    dialog = "".join(ConversationMemory.render_turn(turn) for turn in turns)
+    content = f"Previous summary: {previous or '(none)'}\n\nNew messages:\n{dialog}"
+    # Фоновая работа: в очереди планировщика стоит за всеми чатами
+    if not ai_scheduler.acquire((len(SUMMARY_PROMPT) + len(content)) // 4 + SUMMARY_MAX_TOKENS):
+        return None
+    
+    for target in AI_TARGETS:
+        if not target.breaker.allow():
+            continue
+        payload = {
+            "model": target.model,
+            "messages": [
+                {"role": "system", "content": SUMMARY_PROMPT},
+                {"role": "user", "content": content}
+            ],
+            "max_tokens": SUMMARY_MAX_TOKENS,
+            "temperature": 0.3
+        }
+        summary = post_ai_completion(target, ai_request_headers(target), payload)
+        return clip_summary(summary) if summary and summary.strip() else None
+    return None
 
-    context_text = "Recent conversation:\n"
-    for msg in context:
-        context_text += f"User: {msg['user']}\nLuna: {msg['bot']}\n"
+class ContextSummarizer:
+    """Очередь пользователей (без повторов), чьи старые реплики пора свернуть, и один фоновый обработчик.
+    AI вызывается вне транзакции пользователя - хендлеры этого пользователя не ждут"""
+    def __init__(self, mode, batch):
+        self.mode = mode
+        self.batch = max(batch, 1)
+        self.queue = deque()
+        self.queued = set()
+        self.lock = threading.Lock()
+        self.event = threading.Event()
+        self.stats = {'summarized': 0, 'ai': 0, 'local': 0, 'skipped': 0}
     
-    return context_text + "Continue naturally!\n"
+    def needs_summary(self, memory, capacity):
+        # Сворачиваем заранее, пока вытеснение из буфера еще ничего не потеряло
+        return self.mode != 'off' and capacity > 1 and len(memory) >= capacity - 1
+    
+    def schedule(self, user_id):
+        with self.lock:
+            if user_id in self.queued:
+                return
+            self.queued.add(user_id)
+            self.queue.append(user_id)
+        self.event.set()
+    
+    def run_pending(self):
+        while True:
+            with self.lock:
+                if not self.queue:
+                    return
+                user_id = self.queue.popleft()
+                self.queued.discard(user_id)
+            try:
+                self.summarize_user(user_id)
+            except Exception as e:
+                print(f"❌ Summary error for {user_id}: {e}")
+    
+    def summarize_user(self, user_id):
+        with db.user(user_id) as u:
+            capacity = max(u.context.capacity, 2)
+            if not self.needs_summary(u.context, capacity):
+                return  # Тариф сменился или уже свернуто
+            turns = u.context.ordered()[:min(self.batch, capacity - 1)]
+            previous = u.summary['text'] if u.summary else ''
+        
+        summary = summarize_with_ai(previous, turns) if self.mode == 'ai' else None
+        source = 'ai' if summary else 'local'
+        if summary is None:
+            summary = summarize_locally(previous, turns)
+        
+        with db.user(user_id) as u:
+            folded = len(u.context)
+            u.context.drop(turns)
+            folded -= len(u.context)
+            if not folded:
+                # Буфер перечитали с диска (LRU) - реплики уже другие объекты, сводку не трогаем
+                with self.lock:
+                    self.stats['skipped'] += 1
+                return
+            u.summary = ConversationSummary({
+                'text': summary,
+                'turns': (u.summary.get('turns', 0) if u.summary else 0) + len(turns),
+                'updated': datetime.datetime.now().isoformat()
+            })
+        
+        with self.lock:
+            self.stats['summarized'] += 1
+            self.stats[source] += 1
+    
+    def get_stats(self):
+        with self.lock:
+            return {'mode': self.mode, 'queued': len(self.queue), **self.stats}
+
+context_summarizer = ContextSummarizer(CONTEXT_SUMMARY, SUMMARY_BATCH)
 
 def get_relationship_level(message_count):
-    for level_id, level_info in sorted(RELATIONSHIP_LEVELS.items(), reverse=True):
-        if message_count >= level_info["messages"]:
-            return level_id, level_info
-    return 1, RELATIONSHIP_LEVELS[1]
+    return PROGRESSION.level_for(message_count)  # 🆕 Готовая таблица вместо sorted() на каждый вызов
 
 def get_level_progress(message_count):
     current_level, current_info = get_relationship_level(message_count)
@@ -839,9 +3266,333 @@ def get_level_progress(message_count):
 
     return f"To {next_info['name']}: {messages_done}/{messages_for_next} messages", progress_percent
 
-def show_main_menu(chat_id, message_id=None):
-    if not bot: return
+# ==================== 🆕 ИСХОДЯЩИЕ СООБЩЕНИЯ ====================
+TELEGRAM_MAX_TEXT = 4096
+
+class OutboundQueue:
+    """Хендлеры только ставят сообщения в очередь, отправляют senders фоновых потоков:
+    не чаще rate в секунду на бота и chat_interval на чат, 429 - ждем retry_after и повторяем.
+    У чата в отправке не больше одной пачки - порядок сообщений сохраняется.
+    Подряд идущие сообщения в один чат уходят одним (если влезают в лимит длины)"""
+    
+    def __init__(self, rate, chat_interval, linger, senders=1):
+        self.interval = 1 / rate if rate > 0 else 0
+        self.chat_interval = chat_interval
+        self.linger = linger
+        self.senders = max(senders, 1)
+        self.sender = None
+        self.cond = threading.Condition()
+        self.chats = {}  # chat_id -> deque сообщений
+        self.heap = []  # (когда можно слать, seq, chat_id) - у каждого чата с очередью одна живая запись
+        self.scheduled = {}  # chat_id -> seq живой записи в heap
+        self.in_flight = set()  # Чаты, чья пачка сейчас отправляется
+        self.chat_ready = {}  # chat_id -> не раньше этого времени (интервал чата или retry_after)
+        self.global_ready = 0
+        self.seq = 0
+        self.depth = 0
+        self.stats = {'queued': 0, 'sent': 0, 'merged': 0, 'retried': 0, 'failed': 0, 'direct': 0}
     
+    def start(self, sender):
+        """sender(chat_id, text, parse_mode, reply_to, reply_markup) - один вызов Bot API"""
+        self.sender = sender
+        for _ in range(self.senders):
+            Thread(target=self.run, daemon=True).start()
+    
+    def send(self, chat_id, text, parse_mode=None, reply_to=None, reply_markup=None):
+        message = {'text': text, 'parse_mode': parse_mode, 'reply_to': reply_to,
+                   'markup': reply_markup, 'queued': time.time()}
+        with self.cond:
+            queue = self.chats.get(chat_id)
+            if queue is None:
+                queue = self.chats[chat_id] = deque()
+            queue.append(message)
+            self.depth += 1
+            self.stats['queued'] += 1
+            if chat_id not in self.scheduled and chat_id not in self.in_flight:
+                self.schedule(chat_id)
+            self.cond.notify()
+    
+    def reply(self, message, text, parse_mode=None, reply_markup=None):
+        self.send(message.chat.id, text, parse_mode, message.message_id, reply_markup)
+    
+    def reserve(self, chat_id, timeout=0):
+        """Слот для вызова Bot API в обход очереди (когда нужен ответ - Message, или это правка).
+        Сначала уходит все, что уже в очереди чата, затем ждем темп бота и чата.
+        False - слот не освободился за timeout; True - после вызова обязателен release()"""
+        deadline = time.time() + timeout
+        with self.cond:
+            while True:
+                now = time.time()
+                if chat_id in self.in_flight or (self.sender and chat_id in self.chats):
+                    wait = deadline - now
+                else:
+                    ready_at = max(self.global_ready, self.chat_ready.get(chat_id, 0))
+                    if ready_at <= now:
+                        break
+                    wait = min(ready_at, deadline) - now
+                if wait <= 0:
+                    return False
+                self.cond.wait(wait)
+            self.global_ready = max(self.global_ready, now) + self.interval
+            self.in_flight.add(chat_id)
+            self.stats['direct'] += 1
+        return True
+    
+    def release(self, chat_id, retry_after=0):
+        with self.cond:
+            now = time.time()
+            self.in_flight.discard(chat_id)
+            self.chat_ready[chat_id] = now + max(self.chat_interval, retry_after)
+            if chat_id in self.chats and chat_id not in self.scheduled:
+                self.schedule(chat_id)
+            self.cond.notify_all()
+    
+    def schedule(self, chat_id):
+        ready_at = max(self.chats[chat_id][0]['queued'] + self.linger, self.chat_ready.get(chat_id, 0))
+        self.seq += 1
+        self.scheduled[chat_id] = self.seq
+        heapq.heappush(self.heap, (ready_at, self.seq, chat_id))
+    
+    def run(self):
+        while True:
+            chat_id, batch = self.next_batch()
+            self.deliver(chat_id, batch)
+    
+    def next_batch(self):
+        with self.cond:
+            while True:
+                if not self.heap:
+                    self.cond.wait()
+                    continue
+                ready_at, seq, chat_id = self.heap[0]
+                if self.scheduled.get(chat_id) != seq:
+                    heapq.heappop(self.heap)
+                    continue
+                wait = max(ready_at, self.global_ready) - time.time()
+                if wait > 0:
+                    self.cond.wait(wait)
+                    continue
+                heapq.heappop(self.heap)
+                del self.scheduled[chat_id]
+                self.in_flight.add(chat_id)
+                # Темп считаем от начала отправки: пока эта идет, следующая может стартовать через interval
+                self.global_ready = max(self.global_ready, time.time()) + self.interval
+                return chat_id, self.take_batch(chat_id)
+    
+    def take_batch(self, chat_id):
+        """Голова очереди чата + все следующие сообщения, которые можно к ней приклеить"""
+        queue = self.chats[chat_id]
+        batch = [queue.popleft()]
+        while queue and self.can_merge(batch, queue[0]):
+            batch.append(queue.popleft())
+        if not queue:
+            del self.chats[chat_id]
+        self.depth -= len(batch)
+        return batch
+    
+    def can_merge(self, batch, message):
+        if batch[-1]['markup'] is not None:
+            return False  # Клавиатура остается у последнего сообщения
+        modes = {item['parse_mode'] for item in batch} | {message['parse_mode']}
+        if len(modes) > 1 and not modes <= {None, 'Markdown'}:
+            return False
+        return len(self.merge(batch + [message])[0]) <= TELEGRAM_MAX_TEXT
+    
+    @staticmethod
+    def merge(batch):
+        """(текст, parse_mode) склейки. Обычный текст рядом с Markdown экранируется"""
+        modes = {item['parse_mode'] for item in batch}
+        parse_mode = batch[0]['parse_mode'] if len(modes) == 1 else 'Markdown'
+        parts = [
+            re.sub(r'([_*`\[])', r'\\\1', item['text']) if item['parse_mode'] is None and parse_mode == 'Markdown' else item['text']
+            for item in batch
+        ]
+        return "\n\n".join(parts), parse_mode
+    
+    def deliver(self, chat_id, batch):
+        text, parse_mode = self.merge(batch)
+        reply_to = next((item['reply_to'] for item in batch if item['reply_to']), None)
+        retry_after = 0
+        try:
+            self.sender(chat_id, text, parse_mode, reply_to, batch[-1]['markup'])
+            outcome = 'sent'
+        except Exception as e:
+            retry_after = get_retry_after(e)
+            outcome = 'retried' if retry_after else 'failed'
+            if not retry_after:
+                print(f"❌ Send to {chat_id} failed: {e}")
+        
+        with self.cond:
+            now = time.time()
+            self.stats[outcome] += 1
+            if outcome == 'sent':
+                self.stats['merged'] += len(batch) - 1
+            elif retry_after:
+                # Вернуть в голову очереди чата как было - склеятся заново
+                self.chats.setdefault(chat_id, deque()).extendleft(reversed(batch))
+                self.depth += len(batch)
+            self.chat_ready[chat_id] = now + max(self.chat_interval, retry_after)
+            self.in_flight.discard(chat_id)
+            if chat_id in self.chats:
+                self.schedule(chat_id)
+            for stale in [key for key, ready in self.chat_ready.items() if ready <= now]:
+                del self.chat_ready[stale]
+            self.cond.notify_all()  # Другие отправители и flush()
+    
+    def get_stats(self):
+        with self.cond:
+            return {
+                'depth': self.depth,
+                'chats_waiting': len(self.chats),
+                'in_flight': len(self.in_flight),
+                'senders': self.senders,
+                'rate': round(1 / self.interval, 1) if self.interval else 0,
+                'chat_interval': self.chat_interval,
+                **self.stats
+            }
+
+outbox = OutboundQueue(OUTBOX_RATE, OUTBOX_CHAT_INTERVAL, OUTBOX_LINGER, OUTBOX_SENDERS)
+
+def send_via_bot(chat_id, text, parse_mode, reply_to, reply_markup):
+    bot.send_message(chat_id, text, parse_mode=parse_mode, reply_to_message_id=reply_to,
+                     allow_sending_without_reply=True, reply_markup=reply_markup)
+
+# ==================== 🆕 ПАРАЛЛЕЛЬНАЯ ОБРАБОТКА АПДЕЙТОВ ====================
+class ChatDispatcher:
+    """Пул потоков: разные чаты обрабатываются параллельно, один чат - строго по порядку"""
+    
+    def __init__(self, workers, max_pending):
+        self.workers = workers
+        self.max_pending = max_pending
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='luna-worker')
+        self.lock = threading.Lock()
+        self.slot_freed = threading.Condition(self.lock)  # Сигнал для submit: в очереди освободилось место
+        self.chat_queues = {}  # chat_id -> deque задач; есть ключ = чат уже в работе
+        self.pending = 0
+        self.processed = 0
+        self.rejected = 0
+    
+    def try_submit(self, chat_id, func, *args):
+        """Ставит задачу, если очередь не заполнена; иначе False (вебхук отвечает 503)"""
+        with self.lock:
+            if self.pending >= self.max_pending:
+                self.rejected += 1
+                return False
+            start = self._submit_locked(chat_id, func, args)
+        if start:
+            self.executor.submit(self.run_next, chat_id)
+        return True
+    
+    def submit(self, chat_id, func, *args):
+        """Ставит задачу, ожидая свободного места в очереди (polling: пока ждем, новые апдейты не забираем)"""
+        with self.lock:
+            while self.pending >= self.max_pending:
+                self.slot_freed.wait()
+            start = self._submit_locked(chat_id, func, args)
+        if start:
+            self.executor.submit(self.run_next, chat_id)
+    
+    def _submit_locked(self, chat_id, func, args):
+        """Вызывается под self.lock; True - чат не в работе, нужно запустить run_next"""
+        self.pending += 1
+        queue = self.chat_queues.get(chat_id)
+        if queue is not None:
+            queue.append((func, args))
+            return False
+        self.chat_queues[chat_id] = deque([(func, args)])
+        return True
+    
+    def run_next(self, chat_id):
+        """Выполняет одну задачу чата и ставит следующую в конец общей очереди (честность между чатами)"""
+        with self.lock:
+            func, args = self.chat_queues[chat_id].popleft()
+        
+        try:
+            func(*args)
+        except Exception as e:
+            print(f"❌ Handler error in chat {chat_id}: {e}")
+        
+        with self.lock:
+            self.pending -= 1
+            self.processed += 1
+            self.slot_freed.notify()
+            if not self.chat_queues[chat_id]:
+                del self.chat_queues[chat_id]
+                return
+        self.executor.submit(self.run_next, chat_id)
+    
+    def get_stats(self):
+        with self.lock:
+            return {
+                'workers': self.workers,
+                'active_chats': len(self.chat_queues),
+                'pending_updates': self.pending,
+                'max_pending': self.max_pending,
+                'processed': self.processed,
+                'rejected': self.rejected
+            }
+
+def get_update_chat_id(update):
+    """chat.id апдейта - ключ порядка обработки"""
+    if update.message:
+        return update.message.chat.id
+    if update.edited_message:
+        return update.edited_message.chat.id
+    if update.callback_query and update.callback_query.message:
+        return update.callback_query.message.chat.id
+    return update.update_id  # Прочие апдейты порядок не требуют
+
+dispatcher = ChatDispatcher(BOT_WORKERS, WEBHOOK_QUEUE_SIZE)
+
+if bot:
+    process_updates_inline = bot.process_new_updates
+    
+    def dispatch_updates(updates):
+        for update in updates:
+            # Ждем места в очереди до сдвига offset: переполненный бот не подтверждает новые апдейты,
+            # а polling-поток стоит здесь и не делает следующий getUpdates
+            dispatcher.submit(get_update_chat_id(update), process_updates_inline, [update])
+            if update.update_id > bot.last_update_id:
+                bot.last_update_id = update.update_id
+    
+    bot.process_new_updates = dispatch_updates
+
+# ==================== ЛОГИКА ОБРАБОТЧИКОВ ====================
+# 🆕 Общая для обычного (потоки) и asyncio рантайма: здесь только данные и тексты, отправка - в хендлерах
+
+MAIN_MENU_TEXT = "💕 Choose action:"
+
+FEEDBACK_PROMPT_TEXT = """
+📝 *Share Your Feedback - Help Us Improve!* 💖
+
+We're in early development and YOUR opinion matters!
+
+**What would you like to share?**
+✨ What you love about Luna?
+🚀 What features would you like to see?  
+🐛 Any bugs or issues?
+💡 Your brilliant ideas?
+
+Just type your thoughts below...
+
+*Thank you for helping us create the perfect AI companion!* 🌟
+"""
+
+FEEDBACK_THANKS_TEXT = (
+    "💖 *Thank you for your feedback!* 🌟\n\n"
+    "Your thoughts are incredibly valuable to us! "
+    "We'll use them to make Luna even better! 🚀\n\n"
+    "*You're amazing!* 💫"
+)
+
+PREMIUM_ACTIVATED_TEXT = (
+    "🎉 *Premium activated!* 💎\n\n"
+    "Thank you for upgrading! You now have:\n"
+    "• Unlimited messages\n• Priority access\n• Extended memory\n• Ad-free experience\n\n"
+    "*Your progress is now securely saved!* 🔒"
+)
+
+def build_main_menu_markup():
     markup = types.InlineKeyboardMarkup()
     btn1 = types.InlineKeyboardButton("💖 Hug", callback_data="hug")
     btn2 = types.InlineKeyboardButton("😘 Kiss", callback_data="kiss")
@@ -851,49 +3602,24 @@ def show_main_menu(chat_id, message_id=None):
     btn6 = types.InlineKeyboardButton("🏆 Achievements", callback_data="show_achievements")
     markup.add(btn1, btn2, btn3)
     markup.add(btn4, btn5, btn6)
-    
-    if message_id:
-        try:
-            bot.edit_message_text(chat_id=chat_id, message_id=message_id, text="💕 Choose action:", reply_markup=markup)
-        except:
-            bot.send_message(chat_id, "💕 Choose action:", reply_markup=markup)
-    else:
-        bot.send_message(chat_id, "💕 Choose action:", reply_markup=markup)
-
-# ==================== ОБРАБОТЧИКИ КОМАНД ====================
-if bot:
-    @bot.message_handler(commands=['start'])
-    def handle_start(message):
-        user_id = message.chat.id
-        stats = db.get_user_stats(user_id)
-        
-        new_achievements = check_achievements(user_id, stats, action_type="first_day")
-        achievements_message = ""
-        if new_achievements:
-            achievements_message = f"\n\n{get_achievements_message(new_achievements)}"
-        
-        welcome_with_stats = WELCOME_MESSAGE + f"\n📊 Your progress: Level {stats['current_level']}, {stats['message_count']} messages" + achievements_message
-        bot.reply_to(message, welcome_with_stats, parse_mode='Markdown')
-        show_main_menu(user_id)
-        
-        db.save_data()
+    return markup
 
-    @bot.message_handler(commands=['menu'])  
-    def handle_menu(message):
-        show_main_menu(message.chat.id)
-
-    @bot.message_handler(commands=['save'])
-    def handle_save(message):
-        db.save_data()
-        bot.reply_to(message, "💾 All data saved manually! 🔒")
+def build_start_text(user_id):
+    stats = db.get_user_stats(user_id)
+    
+    new_achievements = check_achievements(user_id, stats, action_type="first_day")
+    achievements_message = ""
+    if new_achievements:
+        achievements_message = f"\n\n{get_achievements_message(new_achievements)}"
+    
+    return WELCOME_MESSAGE + f"\n📊 Your progress: Level {stats['current_level']}, {stats['message_count']} messages" + achievements_message
 
-    @bot.message_handler(commands=['status'])
-    def handle_status(message):
-        uptime = datetime.datetime.now() - start_time
-        total_users = len(db.get_all_users())
-        total_messages = db.get_total_messages()
-        
-        status_text = f"""
+def build_status_text():
+    uptime = datetime.datetime.now() - start_time
+    total_users = db.get_total_users()
+    total_messages = db.get_total_messages()
+    
+    return f"""
 🤖 *Luna Bot Status*
 
 🟢 **Online**: ULTRA STABLE MODE
@@ -902,28 +3628,21 @@ if bot:
 💬 **Total Messages**: {total_messages}
 🧠 **AI Mode**: Smart Thinking
 🎮 **Achievements**: {len(ACHIEVEMENTS)} available
-💾 **Auto-save**: Every 30 seconds
+💾 **Auto-save**: Every {SAVE_INTERVAL} seconds
 
 *Your progress is SAFE!* 🔒
 """
-        bot.reply_to(message, status_text, parse_mode='Markdown')
 
-    @bot.message_handler(commands=['ping'])
-    def handle_ping(message):
-        bot.reply_to(message, "🏓 Pong! I'm ULTRA STABLE! 🧠")
-
-    @bot.message_handler(commands=['myprogress'])
-    def handle_myprogress(message):
-        user_id = message.chat.id
-        stats = db.get_user_stats(user_id)
-        current_level, level_info = get_relationship_level(stats['message_count'])
-        progress_text, progress_percent = get_level_progress(stats['message_count'])
-        
-        user_achievements = db.get_user_achievements(user_id)
-        unlocked_count = len(user_achievements['unlocked'])
-        total_achievements = len(ACHIEVEMENTS)
-        
-        progress_info = f"""
+def build_progress_text(user_id):
+    stats = db.get_user_stats(user_id)
+    current_level, level_info = get_relationship_level(stats['message_count'])
+    progress_text, progress_percent = get_level_progress(stats['message_count'])
+    
+    user_achievements = db.get_user_achievements(user_id)
+    unlocked_count = len(user_achievements['unlocked'])
+    total_achievements = len(ACHIEVEMENTS)
+    
+    return f"""
 📊 *Your Progress*
 
 💬 Messages: *{stats['message_count']}*
@@ -934,71 +3653,43 @@ if bot:
 
 *Your data is securely saved!* 💾
 """
-        bot.reply_to(message, progress_info, parse_mode='Markdown')
-
-    @bot.message_handler(commands=['feedback'])
-    def handle_feedback(message):
-        feedback_text = """
-📝 *Share Your Feedback - Help Us Improve!* 💖
-
-We're in early development and YOUR opinion matters!
-
-**What would you like to share?**
-✨ What you love about Luna?
-🚀 What features would you like to see?  
-🐛 Any bugs or issues?
-💡 Your brilliant ideas?
-
-Just type your thoughts below...
-
-*Thank you for helping us create the perfect AI companion!* 🌟
-"""
-        bot.reply_to(message, feedback_text, parse_mode='Markdown')
-        
-        user_id = message.chat.id
-        stats = db.get_user_stats(user_id)
-        stats['waiting_feedback'] = True
-        db.update_user_stats(user_id, stats)
-        db.save_data()
 
-    @bot.message_handler(commands=['achievements'])
-    def handle_achievements(message):
-        user_id = message.chat.id
-        user_achievements = db.get_user_achievements(user_id)
-        
-        achievements_text = "🏆 *Your Achievements* 🏆\n\n"
-        
-        if user_achievements['unlocked']:
-            achievements_text += "✨ *Unlocked:*\n"
-            for achievement_id in user_achievements['unlocked']:
-                achievement = ACHIEVEMENTS[achievement_id]
-                achievements_text += f"✅ **{achievement['name']}** - {achievement['description']}\n"
-            achievements_text += "\n"
-        else:
-            achievements_text += "No achievements unlocked yet! Start chatting! 💫\n\n"
-        
-        achievements_text += "🎯 *In Progress:*\n"
-        for achievement_id, achievement in ACHIEVEMENTS.items():
-            if achievement_id in user_achievements['unlocked']:
-                continue
-                
-            progress = user_achievements['progress'][achievement['type']]
-            if achievement['type'] == 'different_buttons':
-                progress = len(user_achievements['progress']['different_buttons'])
+def start_feedback(user_id):
+    with db.user(user_id) as u:
+        u.stats['waiting_feedback'] = True
+
+def build_achievements_text(user_id):
+    user_achievements = db.get_user_achievements(user_id)
+    
+    achievements_text = "🏆 *Your Achievements* 🏆\n\n"
+    
+    if user_achievements['unlocked']:
+        achievements_text += "✨ *Unlocked:*\n"
+        for achievement_id in user_achievements['unlocked']:
+            achievement = ACHIEVEMENTS[achievement_id]
+            achievements_text += f"✅ **{achievement['name']}** - {achievement['description']}\n"
+        achievements_text += "\n"
+    else:
+        achievements_text += "No achievements unlocked yet! Start chatting! 💫\n\n"
+    
+    achievements_text += "🎯 *In Progress:*\n"
+    for achievement_id, achievement in ACHIEVEMENTS.items():
+        if achievement_id in user_achievements['unlocked']:
+            continue
             
-            achievements_text += f"⏳ **{achievement['name']}** - {progress}/{achievement['goal']} - {achievement['description']}\n"
-        
-        achievements_text += "\n*Keep going! You're amazing!* 💖"
+        progress = user_achievements['progress'][achievement['type']]
+        if achievement['type'] == 'different_buttons':
+            progress = len(user_achievements['progress']['different_buttons'])
         
-        bot.reply_to(message, achievements_text, parse_mode='Markdown')
+        achievements_text += f"⏳ **{achievement['name']}** - {progress}/{achievement['goal']} - {achievement['description']}\n"
+    
+    achievements_text += "\n*Keep going! You're amazing!* 💖"
+    return achievements_text
 
-    @bot.message_handler(commands=['premium'])
-    def handle_premium(message):
-        user_id = message.chat.id
-        
-        if db.is_premium_user(user_id):
-            premium_data = db.premium_users.get(str(user_id), {})
-            premium_text = f"""
+def build_premium_text(user_id):
+    if db.is_premium_user(user_id):
+        premium_data = db.get_premium_data(user_id)
+        return f"""
 👑 *Your Premium Status*
 
 💎 Tier: {premium_data.get('premium_type', 'basic').upper()}
@@ -1008,14 +3699,14 @@ Just type your thoughts below...
 
 *Thank you for your support!* 💖
 """
-        else:
-            premium_text = """
+    
+    return f"""
 💎 *Premium Features*
 
 ✨ **Basic Tier** ($4.99/month):
 • Unlimited messages  
 • Priority chat access
-• Extended memory (8 messages)
+• Extended memory ({PREMIUM_CONTEXT_LENGTH} messages)
 • Ad-free experience
 
 ✨ **Premium Tier** ($9.99/month):
@@ -1032,69 +3723,41 @@ Just type your thoughts below...
 
 *Use /buypremium to upgrade!*
 """
-        
-        bot.reply_to(message, premium_text, parse_mode='Markdown')
-
-    @bot.message_handler(commands=['buypremium'])
-    def handle_buy_premium(message):
-        user_id = message.chat.id
-        db.set_premium_status(user_id, "basic")
-        
-        bot.reply_to(message, 
-            "🎉 *Premium activated!* 💎\n\n"
-            "Thank you for upgrading! You now have:\n"
-            "• Unlimited messages\n• Priority access\n• Extended memory\n• Ad-free experience\n\n"
-            "*Your progress is now securely saved!* 🔒", 
-            parse_mode='Markdown'
-        )
-
-    @bot.callback_query_handler(func=lambda call: True)
-    def handle_callback(call):
-        user_id = call.message.chat.id
-        bot.answer_callback_query(call.id)
 
-        stats = db.get_user_stats(user_id)
-        username = call.from_user.first_name or ""
-        greeting = get_gendered_greeting(user_id, "", username)
+def get_button_replies(user_id, action, username):
+    """Обрабатывает кнопку меню и возвращает список (текст, parse_mode) для отправки"""
+    with db.user(user_id):
+        return build_button_replies(user_id, action, username)
 
-        if call.data == "hug":
+def build_button_replies(user_id, action, username):
+    stats = db.get_user_stats(user_id)
+    greeting = get_gendered_greeting(user_id, "", username)
+    replies = []
+    
+    if action in ("hug", "kiss", "compliment"):
+        if action == "hug":
             response = f"💖 Warm hugs for you, {greeting}!"
-            bot.send_message(user_id, response)
-            update_conversation_context(user_id, "hug", response)
-            new_achievements = check_achievements(user_id, stats, action_type="button_used", action_data={"button_type": "hug"})
-            if new_achievements:
-                bot.send_message(user_id, get_achievements_message(new_achievements), parse_mode='Markdown')
-            db.save_data()
-            
-        elif call.data == "kiss":
+        elif action == "kiss":
             response = f"😘 Sending kisses your way, {greeting}!"
-            bot.send_message(user_id, response)
-            update_conversation_context(user_id, "kiss", response)
-            new_achievements = check_achievements(user_id, stats, action_type="button_used", action_data={"button_type": "kiss"})
-            if new_achievements:
-                bot.send_message(user_id, get_achievements_message(new_achievements), parse_mode='Markdown')
-            db.save_data()
-            
-        elif call.data == "compliment":
+        else:
             compliments = [
                 f"🌟 You're absolutely incredible, {greeting}!",
                 f"💕 You have the most amazing personality, {greeting}!",
                 f"😍 You always know how to make me smile, {greeting}!",
             ]
             response = random.choice(compliments)
-            bot.send_message(user_id, response)
-            update_conversation_context(user_id, "compliment", response)
-            new_achievements = check_achievements(user_id, stats, action_type="button_used", action_data={"button_type": "compliment"})
-            if new_achievements:
-                bot.send_message(user_id, get_achievements_message(new_achievements), parse_mode='Markdown')
-            db.save_data()
-            
-        elif call.data == "show_stats":
-            stats_data = db.get_user_stats(user_id)
-            message_count = stats_data['message_count']
-            current_level, level_info = get_relationship_level(message_count)
-            
-            stats_text = f"""
+        
+        replies.append((response, None))
+        update_conversation_context(user_id, action, response)
+        new_achievements = check_achievements(user_id, stats, action_type="button_used", action_data={"button_type": action})
+        if new_achievements:
+            replies.append((get_achievements_message(new_achievements), 'Markdown'))
+        
+    elif action == "show_stats":
+        message_count = stats['message_count']
+        current_level, level_info = get_relationship_level(message_count)
+        
+        stats_text = f"""
 📊 *Your Stats* {level_info['color']}
 
 💬 Messages: *{message_count}*
@@ -1103,19 +3766,18 @@ Just type your thoughts below...
 
 Keep chatting! 💫
 """
-            bot.send_message(user_id, stats_text, parse_mode='Markdown')
-            
-        elif call.data == "show_level":
-            stats_data = db.get_user_stats(user_id)
-            message_count = stats_data['message_count']
-            current_level, level_info = get_relationship_level(message_count)
-            progress_text, progress_percent = get_level_progress(message_count)
-            
-            bars = 10
-            filled_bars = int(progress_percent / 100 * bars)
-            progress_bar = "🟩" * filled_bars + "⬜" * (bars - filled_bars)
-            
-            level_text = f"""
+        replies.append((stats_text, 'Markdown'))
+        
+    elif action == "show_level":
+        message_count = stats['message_count']
+        current_level, level_info = get_relationship_level(message_count)
+        progress_text, progress_percent = get_level_progress(message_count)
+        
+        bars = 10
+        filled_bars = int(progress_percent / 100 * bars)
+        progress_bar = "🟩" * filled_bars + "⬜" * (bars - filled_bars)
+        
+        level_text = f"""
 {level_info['color']} *Your Level: {level_info['name']}*
 
 📊 Messages: {message_count}
@@ -1125,83 +3787,558 @@ Keep chatting! 💫
 
 *Your progress is safe with me!* 💾
 """
-            bot.send_message(user_id, level_text, parse_mode='Markdown')
-            
-        elif call.data == "show_achievements":
-            # 🛠️ ФИКС: Создаем новое сообщение вместо использования call.message
-            class MockMessage:
-                def __init__(self, chat_id):
-                    self.chat = type('Chat', (), {'id': chat_id})()
-            
-            mock_message = MockMessage(user_id)
-            handle_achievements(mock_message)
-
-    @bot.message_handler(func=lambda message: True)
-    def handle_all_messages(message):
-        user_id = message.chat.id
-        username = message.from_user.first_name or ""
-        user_message = message.text
+        replies.append((level_text, 'Markdown'))
         
-        print(f"📨 Message from {user_id}: {user_message}")
+    elif action == "show_achievements":
+        # 🛠️ ФИКС: Отдельное сообщение с достижениями вместо MockMessage
+        replies.append((build_achievements_text(user_id), 'Markdown'))
+    
+    return replies
 
-        stats = db.get_user_stats(user_id)
+def begin_message_turn(user_id, username, user_message):
+    """Все до запроса к AI: фидбек, счетчики, level up, приветствие и контекст.
+    🆕 Одна транзакция db.user() - параллельный хендлер не увидит половину изменений"""
+    with db.user(user_id) as u:
+        stats = u.stats
         if stats.get('waiting_feedback'):
-            # 🆕 УЛУЧШЕННАЯ СИСТЕМА ФИДБЕКОВ
-            send_feedback_to_admin(user_id, username, user_message)
-            
             stats['waiting_feedback'] = False
-            db.update_user_stats(user_id, stats)
-            
-            bot.reply_to(message, 
-                "💖 *Thank you for your feedback!* 🌟\n\n"
-                "Your thoughts are incredibly valuable to us! "
-                "We'll use them to make Luna even better! 🚀\n\n"
-                "*You're amazing!* 💫", 
-                parse_mode='Markdown'
-            )
-            db.save_data()
-            return
-
+            return {'feedback': True}
+        
         old_message_count = stats['message_count']
         stats['message_count'] += 1
         stats['last_seen'] = datetime.datetime.now().isoformat()
-        db.update_user_stats(user_id, stats)
         
         new_achievements = check_achievements(user_id, stats, action_type="message_sent")
         
         old_level, _ = get_relationship_level(old_message_count)
         new_level, new_level_info = get_relationship_level(stats['message_count'])
         
-        level_up_achievements = []
+        level_up_text = None
         if new_level > old_level:
             stats['current_level'] = new_level
-            db.update_user_stats(user_id, stats)
             level_up_text = f"🎉 *LEVEL UP!* You're now {new_level_info['name']}! {new_level_info['color']}\n\n*Your progress is saved!* 💾"
-            bot.send_message(user_id, level_up_text, parse_mode='Markdown')
-            
-            level_up_achievements = check_achievements(user_id, stats, action_type="level_up", action_data={"new_level": new_level})
+            new_achievements += check_achievements(user_id, stats, action_type="level_up", action_data={"new_level": new_level})
+        
+        return {
+            'feedback': False,
+            'level_up_text': level_up_text,
+            'new_achievements': new_achievements,
+            'greeting': get_gendered_greeting(user_id, user_message, username),
+            'context': get_conversation_context_text(user_id),
+            'level_info': new_level_info,
+            'premium': db.is_premium_user(user_id)
+        }
+
+def finish_message_turn(user_id, user_message, ai_response, turn):
+    """Все после ответа AI: контекст и сообщение о достижениях (или None)"""
+    update_conversation_context(user_id, user_message, ai_response)
+    return get_achievements_message(turn['new_achievements'])
+
+def get_retry_after(error):
+    """Сколько ждать после 429 от Telegram (0 - это не 429). У sync и async telebot свои классы ошибок"""
+    if getattr(error, 'error_code', None) == 429:
+        return (getattr(error, 'result_json', None) or {}).get('parameters', {}).get('retry_after', 1)
+    return 0
+
+def stream_ai_reply(message, user_message, context, greeting, level_info, username, premium=False):
+    """🆕 Первый кусок ответа отправляем сразу, остальное дописываем редкими правками сообщения"""
+    cache_key, cached = lookup_cached_response(user_message, context, greeting, level_info, username)
+    if cached:
+        outbox.reply(message, cached)
+        return cached
+    
+    if not ai_scheduler.acquire(estimate_request_tokens(user_message, context), premium):
+        print("⏳ AI budget exhausted - using fallback")
+        ai_response = get_smart_fallback(user_message, greeting, level_info, username)
+        outbox.reply(message, ai_response)
+        return ai_response
+    
+    text = ""
+    sent = None
+    shown_text = ""
+    last_edit = 0
+    interrupted = False
+    send_failed = False
+    
+    def try_edit(new_text, wait=0):
+        """Правка в темпе outbox: слот чата занят - пропускаем, попробуем со следующим куском"""
+        nonlocal shown_text, last_edit
+        if not outbox.reserve(sent.chat.id, wait):
+            return
+        retry_after = 0
+        try:
+            bot.edit_message_text(new_text, chat_id=sent.chat.id, message_id=sent.message_id)
+            shown_text = new_text
+        except Exception as e:
+            retry_after = get_retry_after(e)  # outbox не даст слот чату, пока не пройдет
+            if not retry_after:
+                print(f"⚠️ Stream edit failed: {e}")
+        finally:
+            outbox.release(sent.chat.id, retry_after)
+        last_edit = time.time()
+    
+    chunks = stream_ai_completion(user_message, context, greeting, level_info)
+    while True:
+        # В try только чтение стрима: ошибка отправки в Telegram - не повод звать AI еще раз
+        try:
+            chunk = next(chunks, None)
+        except Exception as e:
+            print(f"❌ Groq stream error: {e}")
+            interrupted = True
+            break
+        if chunk is None:
+            break
         
-        greeting = get_gendered_greeting(user_id, user_message, username)
-        context = get_conversation_context_text(user_id)
-        current_level, level_info = get_relationship_level(stats['message_count'])
+        text += chunk
+        now = time.time()
+        if sent is None:
+            if not send_failed and len(text) >= STREAM_FIRST_CHUNK_CHARS:
+                # Level up и прочее из очереди уходит раньше ответа, дальше - общий темп outbox
+                if outbox.reserve(message.chat.id, STREAM_SEND_WAIT):
+                    retry_after = 0
+                    try:
+                        sent = bot.reply_to(message, text)
+                        shown_text = text
+                        last_edit = now
+                    except Exception as e:
+                        retry_after = get_retry_after(e)
+                        print(f"⚠️ Stream first message failed: {e}")
+                    finally:
+                        outbox.release(message.chat.id, retry_after)
+                # Не отправили - дочитываем стрим молча, целиком ответ уйдет через очередь
+                send_failed = sent is None
+        elif now - last_edit >= STREAM_EDIT_INTERVAL:
+            try_edit(text)
+    
+    if interrupted and sent is None and not send_failed:
+        # Стрим упал, ничего не показали - обычный запрос (еще один вызов - из бюджета), потом fallback
+        ai_response = request_ai_completion(user_message, context, greeting, level_info, paid=False)
+        if ai_response is None:
+            ai_response = get_smart_fallback(user_message, greeting, level_info, username)
+        else:
+            remember_response(cache_key, ai_response, greeting, username)
+        outbox.reply(message, ai_response)
+        return ai_response
+    
+    if not text.strip():
+        ai_response = get_smart_fallback(user_message, greeting, level_info, username)
+        outbox.reply(message, ai_response)
+        return ai_response
+    
+    if interrupted:
+        text += " …"  # Ответ оборван - видно пользователю, и в кэш такой не кладем
+    
+    if sent is None:
+        outbox.reply(message, text)
+    elif text != shown_text:
+        try_edit(text, STREAM_SEND_WAIT)  # Финальную правку ждем, даже если Telegram просил подождать
+    
+    if interrupted:
+        print(f"⚠️ Stream interrupted, partial response kept: {text}")
+        return text
+    
+    print(f"🤖 Smart AI Response (streamed): {text}")
+    remember_response(cache_key, text, greeting, username)
+    return text
+
+def show_main_menu(chat_id, message_id=None):
+    if not bot: return
+    
+    markup = build_main_menu_markup()
+    
+    if message_id:
+        try:
+            bot.edit_message_text(chat_id=chat_id, message_id=message_id, text=MAIN_MENU_TEXT, reply_markup=markup)
+        except:
+            outbox.send(chat_id, MAIN_MENU_TEXT, reply_markup=markup)
+    else:
+        outbox.send(chat_id, MAIN_MENU_TEXT, reply_markup=markup)
+
+# ==================== ОБРАБОТЧИКИ КОМАНД ====================
+if bot:
+    @bot.message_handler(commands=['start'])
+    def handle_start(message):
+        user_id = message.chat.id
+        outbox.reply(message, build_start_text(user_id), parse_mode='Markdown')
+        show_main_menu(user_id)
+
+    @bot.message_handler(commands=['menu'])  
+    def handle_menu(message):
+        show_main_menu(message.chat.id)
+
+    @bot.message_handler(commands=['save'])
+    def handle_save(message):
+        db.save_data()
+        outbox.reply(message, "💾 All data saved manually! 🔒")
+
+    @bot.message_handler(commands=['status'])
+    def handle_status(message):
+        outbox.reply(message, build_status_text(), parse_mode='Markdown')
+
+    @bot.message_handler(commands=['ping'])
+    def handle_ping(message):
+        outbox.reply(message, "🏓 Pong! I'm ULTRA STABLE! 🧠")
+
+    @bot.message_handler(commands=['myprogress'])
+    def handle_myprogress(message):
+        outbox.reply(message, build_progress_text(message.chat.id), parse_mode='Markdown')
+
+    @bot.message_handler(commands=['feedback'])
+    def handle_feedback(message):
+        outbox.reply(message, FEEDBACK_PROMPT_TEXT, parse_mode='Markdown')
+        start_feedback(message.chat.id)
+
+    @bot.message_handler(commands=['achievements'])
+    def handle_achievements(message):
+        outbox.reply(message, build_achievements_text(message.chat.id), parse_mode='Markdown')
+
+    @bot.message_handler(commands=['premium'])
+    def handle_premium(message):
+        outbox.reply(message, build_premium_text(message.chat.id), parse_mode='Markdown')
+
+    @bot.message_handler(commands=['buypremium'])
+    def handle_buy_premium(message):
+        db.set_premium_status(message.chat.id, "basic")
+        outbox.reply(message, PREMIUM_ACTIVATED_TEXT, parse_mode='Markdown')
+
+    @bot.callback_query_handler(func=lambda call: True)
+    def handle_callback(call):
+        user_id = call.message.chat.id
+        bot.answer_callback_query(call.id)
+
+        username = call.from_user.first_name or ""
+        for text, parse_mode in get_button_replies(user_id, call.data, username):
+            outbox.send(user_id, text, parse_mode=parse_mode)
+
+    @bot.message_handler(func=lambda message: True)
+    def handle_all_messages(message):
+        user_id = message.chat.id
+        username = message.from_user.first_name or ""
+        user_message = message.text
         
-        ai_response = get_ai_response(user_message, context, greeting, level_info, username)
-        bot.reply_to(message, ai_response)
-        update_conversation_context(user_id, user_message, ai_response)
+        print(f"📨 Message from {user_id}: {user_message}")
+
+        turn = begin_message_turn(user_id, username, user_message)
+        if turn['feedback']:
+            # 🆕 УЛУЧШЕННАЯ СИСТЕМА ФИДБЕКОВ
+            send_feedback_to_admin(user_id, username, user_message)
+            outbox.reply(message, FEEDBACK_THANKS_TEXT, parse_mode='Markdown')
+            return
+
+        if turn['level_up_text']:
+            outbox.send(user_id, turn['level_up_text'], parse_mode='Markdown')
         
-        all_new_achievements = new_achievements + level_up_achievements
-        if all_new_achievements:
-            bot.send_message(user_id, get_achievements_message(all_new_achievements), parse_mode='Markdown')
+        if AI_STREAMING and AI_TARGETS:
+            ai_response = stream_ai_reply(message, user_message, turn['context'], turn['greeting'], turn['level_info'], username, turn['premium'])
+        else:
+            ai_response = get_ai_response(user_message, turn['context'], turn['greeting'], turn['level_info'], username, turn['premium'])
+            outbox.reply(message, ai_response)
         
-        db.save_data()
+        achievements_text = finish_message_turn(user_id, user_message, ai_response, turn)
+        if achievements_text:
+            outbox.send(user_id, achievements_text, parse_mode='Markdown')
 
 # ==================== АВТО-СОХРАНЕНИЕ ====================
 def auto_save_worker():
-    """Сохраняем данные каждые 30 секунд!"""
+    """🆕 Планировщик: одна запись на все изменения за интервал (или раньше, если их много)"""
     while True:
-        time.sleep(30)
-        db.save_data()
-        print(f"💾 Auto-save: {len(db.get_all_users())} users, {db.get_total_messages()} messages")
+        db.flush_event.wait(SAVE_INTERVAL)
+        db.flush_event.clear()
+        if db.flush():
+            print(f"💾 Auto-save: {db.get_total_users()} users, {db.get_total_messages()} messages")
+
+def summary_worker():
+    """🆕 Фоновое сворачивание старых реплик extended_memory в сводку"""
+    while True:
+        context_summarizer.event.wait()
+        context_summarizer.event.clear()
+        context_summarizer.run_pending()
+
+def wal_compactor_worker():
+    """🆕 Фоновая компакция WAL в снимок"""
+    while True:
+        db.compact_event.wait(WAL_COMPACT_INTERVAL)
+        db.compact_event.clear()
+        db.compact_wal()
+
+# ==================== 🆕 ASYNCIO RUNTIME ====================
+# Опционально (RUNTIME=asyncio или --asyncio): те же хендлеры на одном event loop,
+# AsyncTeleBot + aiohttp вместо потоков и блокирующего requests
+
+class AsyncChatLocks:
+    """Сообщения одного чата обрабатываются по порядку, разные чаты - конкурентно"""
+    
+    def __init__(self):
+        self.locks = {}  # chat_id -> [asyncio.Lock, сколько задач ждут/держат]
+    
+    @contextlib.asynccontextmanager
+    async def hold(self, chat_id):
+        entry = self.locks.setdefault(chat_id, [asyncio.Lock(), 0])
+        entry[1] += 1
+        try:
+            async with entry[0]:
+                yield
+        finally:
+            entry[1] -= 1
+            if entry[1] == 0:
+                del self.locks[chat_id]
+
+async def get_ai_response_async(client, ai_limits, user_message, context, greeting, level_info, username, premium=False):
+    """Async версия get_ai_response на aiohttp"""
+    if not AI_TARGETS:
+        return get_smart_fallback(user_message, greeting, level_info, username)
+    
+    cache_key, cached = lookup_cached_response(user_message, context, greeting, level_info, username)
+    if cached:
+        return cached
+    
+    if ai_scheduler.enabled and not await asyncio.to_thread(
+            ai_scheduler.acquire, estimate_request_tokens(user_message, context), premium):
+        print("⏳ AI budget exhausted - using fallback")
+        return get_smart_fallback(user_message, greeting, level_info, username)
+    
+    ai_response = await request_ai_completion_async(client, ai_limits, user_message, context, greeting, level_info)
+    if ai_response is None:
+        return get_smart_fallback(user_message, greeting, level_info, username)
+    
+    remember_response(cache_key, ai_response, greeting, username)
+    return ai_response
+
+async def request_ai_completion_async(client, ai_limits, user_message, context, greeting, level_info):
+    """Async версия request_ai_completion: хедж и failover на задачах, проигравшие отменяются"""
+    targets = iter(AI_TARGETS)
+    pending = {}
+    tokens = estimate_request_tokens(user_message, context)
+    
+    def launch_next(extra=True):
+        for target in targets:
+            if target.breaker.allow():
+                if extra and not ai_scheduler.try_acquire(tokens):
+                    target.breaker.cancel()
+                    print("⏳ AI budget exhausted - no hedge/failover")
+                    return False
+                task = asyncio.create_task(request_target_completion_async(
+                    client, ai_limits, target, user_message, context, greeting, level_info))
+                pending[task] = target
+                return True
+            print(f"🔌 {target.name} breaker is open - skipping")
+        return False
+    
+    exhausted = not launch_next(extra=False)
+    try:
+        while pending:
+            done, _ = await asyncio.wait(list(pending), timeout=None if exhausted else AI_HEDGE_DELAY,
+                                         return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                target = pending.pop(task)
+                ai_response = task.result()
+                if ai_response is not None:
+                    with target.lock:
+                        target.wins += 1
+                    print(f"🤖 Smart AI Response ({target.name}): {ai_response}")
+                    return ai_response
+            
+            if not exhausted:
+                exhausted = not launch_next()
+                if not exhausted:
+                    count_ai_launch(failover=bool(done))
+        
+        return None
+    finally:
+        for task in pending:
+            task.cancel()
+
+async def request_target_completion_async(client, ai_limits, target, user_message, context, greeting, level_info):
+    import aiohttp
+    headers, payload = build_ai_request(user_message, context, greeting, level_info, target)
+    timeout = aiohttp.ClientTimeout(sock_connect=HTTP_CONNECT_TIMEOUT, sock_read=target.breaker.read_timeout())
+    started = None
+    ok = False
+    try:
+        async with ai_limits[target]:
+            started = time.time()
+            async with client.post(target.url, headers=headers, json=payload, timeout=timeout) as response:
+                if response.status == 200:
+                    data = await response.json()
+                    PROMPTS.record_usage(data.get('usage'))
+                    ok = True
+                    return data['choices'][0]['message']['content']
+                
+                print(f"❌ {target.name} API error: {response.status}")
+                return None
+    
+    except asyncio.CancelledError:
+        started = None  # Проиграл хедж - это не ошибка цели
+        raise
+    except Exception as e:
+        print(f"❌ {target.name} error: {e}")
+        return None
+    finally:
+        if started is None:
+            target.breaker.cancel()
+        else:
+            target.observe(ok, time.time() - started)
+
+# Фоновые циклы ждут и пишут в своем пуле (по потоку на цикл), а не в default executor:
+# иначе ожидание до SAVE_INTERVAL держит потоки, нужные хендлерам для to_thread
+background_executor = ThreadPoolExecutor(max_workers=3, thread_name_prefix='async-background')
+EVENT_WAIT_STEP = 1.0  # Секунд на один шаг ожидания фонового цикла
+
+async def run_in_background(func, *args):
+    return await asyncio.get_running_loop().run_in_executor(background_executor, func, *args)
+
+async def wait_thread_event(event, timeout=None):
+    """Ожидание threading.Event короткими шагами - отмена задачи не ждет весь timeout"""
+    deadline = None if timeout is None else time.monotonic() + timeout
+    while True:
+        step = EVENT_WAIT_STEP if deadline is None else min(EVENT_WAIT_STEP, deadline - time.monotonic())
+        if step <= 0:
+            return event.is_set()
+        if await run_in_background(event.wait, step):
+            return True
+
+async def auto_save_task():
+    """Async замена auto_save_worker"""
+    while True:
+        await wait_thread_event(db.flush_event, SAVE_INTERVAL)
+        db.flush_event.clear()
+        if await run_in_background(db.flush):
+            print(f"💾 Auto-save: {db.get_total_users()} users, {db.get_total_messages()} messages")
+
+async def summary_task():
+    while True:
+        await wait_thread_event(context_summarizer.event)
+        context_summarizer.event.clear()
+        await run_in_background(context_summarizer.run_pending)
+
+async def wal_compactor_task():
+    while True:
+        await wait_thread_event(db.compact_event, WAL_COMPACT_INTERVAL)
+        db.compact_event.clear()
+        await run_in_background(db.compact_wal)
+
+def register_async_handlers(abot, client, ai_limits):
+    chat_locks = AsyncChatLocks()
+    
+    @abot.message_handler(commands=['start'])
+    async def handle_start(message):
+        async with chat_locks.hold(message.chat.id):
+            outbox.reply(message, await asyncio.to_thread(build_start_text, message.chat.id), parse_mode='Markdown')
+            outbox.send(message.chat.id, MAIN_MENU_TEXT, reply_markup=build_main_menu_markup())
+
+    @abot.message_handler(commands=['menu'])
+    async def handle_menu(message):
+        outbox.send(message.chat.id, MAIN_MENU_TEXT, reply_markup=build_main_menu_markup())
+
+    @abot.message_handler(commands=['save'])
+    async def handle_save(message):
+        await asyncio.to_thread(db.save_data)
+        outbox.reply(message, "💾 All data saved manually! 🔒")
+
+    @abot.message_handler(commands=['status'])
+    async def handle_status(message):
+        outbox.reply(message, await asyncio.to_thread(build_status_text), parse_mode='Markdown')
+
+    @abot.message_handler(commands=['ping'])
+    async def handle_ping(message):
+        outbox.reply(message, "🏓 Pong! I'm ULTRA STABLE! 🧠")
+
+    @abot.message_handler(commands=['myprogress'])
+    async def handle_myprogress(message):
+        outbox.reply(message, await asyncio.to_thread(build_progress_text, message.chat.id), parse_mode='Markdown')
+
+    @abot.message_handler(commands=['feedback'])
+    async def handle_feedback(message):
+        async with chat_locks.hold(message.chat.id):
+            outbox.reply(message, FEEDBACK_PROMPT_TEXT, parse_mode='Markdown')
+            await asyncio.to_thread(start_feedback, message.chat.id)
+
+    @abot.message_handler(commands=['achievements'])
+    async def handle_achievements(message):
+        outbox.reply(message, await asyncio.to_thread(build_achievements_text, message.chat.id), parse_mode='Markdown')
+
+    @abot.message_handler(commands=['premium'])
+    async def handle_premium(message):
+        outbox.reply(message, await asyncio.to_thread(build_premium_text, message.chat.id), parse_mode='Markdown')
+
+    @abot.message_handler(commands=['buypremium'])
+    async def handle_buy_premium(message):
+        await asyncio.to_thread(db.set_premium_status, message.chat.id, "basic")
+        outbox.reply(message, PREMIUM_ACTIVATED_TEXT, parse_mode='Markdown')
+
+    @abot.callback_query_handler(func=lambda call: True)
+    async def handle_callback(call):
+        user_id = call.message.chat.id
+        await abot.answer_callback_query(call.id)
+        
+        async with chat_locks.hold(user_id):
+            replies = await asyncio.to_thread(get_button_replies, user_id, call.data, call.from_user.first_name or "")
+            for text, parse_mode in replies:
+                outbox.send(user_id, text, parse_mode=parse_mode)
+
+    @abot.message_handler(func=lambda message: True)
+    async def handle_all_messages(message):
+        user_id = message.chat.id
+        username = message.from_user.first_name or ""
+        user_message = message.text
+        
+        print(f"📨 Message from {user_id}: {user_message}")
+        
+        async with chat_locks.hold(user_id):
+            turn = await asyncio.to_thread(begin_message_turn, user_id, username, user_message)
+            if turn['feedback']:
+                send_feedback_to_admin(user_id, username, user_message)
+                outbox.reply(message, FEEDBACK_THANKS_TEXT, parse_mode='Markdown')
+                return
+            
+            if turn['level_up_text']:
+                outbox.send(user_id, turn['level_up_text'], parse_mode='Markdown')
+            
+            ai_response = await get_ai_response_async(client, ai_limits, user_message, turn['context'], turn['greeting'], turn['level_info'], username, turn['premium'])
+            outbox.reply(message, ai_response)
+            
+            achievements_text = await asyncio.to_thread(finish_message_turn, user_id, user_message, ai_response, turn)
+            if achievements_text:
+                outbox.send(user_id, achievements_text, parse_mode='Markdown')
+
+async def run_async_bot():
+    """Один event loop: polling, Groq и автосохранение"""
+    import aiohttp
+    from telebot.async_telebot import AsyncTeleBot
+    
+    abot = AsyncTeleBot(API_TOKEN)
+    ai_limits = {target: asyncio.Semaphore(target.max_concurrency) for target in AI_TARGETS}  # 🆕 Свой лимит у каждой цели
+    timeout = aiohttp.ClientTimeout(sock_connect=HTTP_CONNECT_TIMEOUT, sock_read=HTTP_READ_TIMEOUT)
+    connector = aiohttp.TCPConnector(limit=HTTP_POOL_SIZE)
+    
+    loop = asyncio.get_running_loop()
+    
+    def send_via_abot(chat_id, text, parse_mode, reply_to, reply_markup):
+        # Поток очереди отправки ждет результат корутины на нашем event loop
+        asyncio.run_coroutine_threadsafe(abot.send_message(
+            chat_id, text, parse_mode=parse_mode, reply_to_message_id=reply_to,
+            allow_sending_without_reply=True, reply_markup=reply_markup), loop).result()
+    
+    async with aiohttp.ClientSession(timeout=timeout, connector=connector) as client:
+        register_async_handlers(abot, client, ai_limits)
+        outbox.start(send_via_abot)
+        
+        background_tasks = [asyncio.create_task(auto_save_task())]
+        if CONTEXT_SUMMARY != 'off':
+            background_tasks.append(asyncio.create_task(summary_task()))
+        if db.storage_mode == 'wal':
+            background_tasks.append(asyncio.create_task(wal_compactor_task()))
+        
+        bot_info = await abot.get_me()
+        print(f"✅ Bot: @{bot_info.username} is ready! (asyncio runtime)")
+        
+        try:
+            await abot.infinity_polling(timeout=120, skip_pending=True, request_timeout=120)
+        finally:
+            for task in background_tasks:
+                task.cancel()
+            await asyncio.gather(*background_tasks, return_exceptions=True)
+            await abot.close_session()
 
 # ==================== ЗАПУСК ====================
 def start_bot():
@@ -1217,13 +4354,13 @@ def start_bot():
         try:
             print(f"\n🚀 Starting Luna Bot - ULTRA STABLE EDITION... (Attempt {restart_count + 1})")
             print("🔒 DATABASE: Ultra-reliable saving system")
-            print("💾 AUTO-SAVE: Every 30 seconds + after every message") 
+            print(f"💾 AUTO-SAVE: Every {SAVE_INTERVAL} seconds or {SAVE_DIRTY_THRESHOLD} changed users") 
             print("🚨 EMERGENCY: Quick save on shutdown")
             print("🎮 FEATURES: Achievements + Feedback system")
             print("📝 FEEDBACKS: Sending to admin chat" if FEEDBACK_CHAT_ID else "⚠️ FEEDBACKS: Logging only")
-            print("✅ Groq API: Ready" if GROQ_API_KEY else "⚠️ Groq API: Using smart fallbacks")
+            print(f"✅ AI: {', '.join(target.name for target in AI_TARGETS)}" if AI_TARGETS else "⚠️ AI: Using smart fallbacks")
             
-            total_users = len(db.get_all_users())
+            total_users = db.get_total_users()
             total_messages = db.get_total_messages()
             print(f"📊 Current stats: {total_users} users, {total_messages} messages")
             
@@ -1235,6 +4372,9 @@ def start_bot():
             bot_info = bot.get_me()
             print(f"✅ Bot: @{bot_info.username} is ready!")
             
+            # Если раньше был webhook - getUpdates с ним не работает
+            bot.remove_webhook()
+            
             # 🛠️ ФИКС: Добавляем skip_pending чтобы избежать конфликта
             bot.polling(none_stop=True, timeout=120, long_polling_timeout=120, skip_pending=True)
             
@@ -1246,18 +4386,63 @@ def start_bot():
     
     print("🔴 Max restarts reached")
 
+def start_webhook():
+    """🆕 Webhook режим: регистрируем адрес и обслуживаем апдейты из веб-сервера"""
+    webhook_url = WEBHOOK_URL.rstrip('/') + '/webhook'
+    bot.remove_webhook()
+    bot.set_webhook(
+        url=webhook_url,
+        secret_token=WEBHOOK_SECRET or None,
+        max_connections=WEB_THREADS,
+        drop_pending_updates=True
+    )
+    print(f"🪝 Webhook set: {webhook_url} (queue limit {WEBHOOK_QUEUE_SIZE})")
+    run_web()
+
+def migrate_json_to_sqlite():
+    """🆕 Разовая миграция: python bot.py --migrate-sqlite"""
+    if db.storage is None:
+        db.storage = SqliteStorage(db.sqlite_file)
+    migrated = db.migrate_to_sqlite()
+    print(f"✅ Migration finished: {migrated} users -> {db.sqlite_file}")
+
+def export_snapshot_json(path):
+    """🆕 Для отладки: python bot.py --export-json dump.json (снимок любого формата + WAL)"""
+    data = db.read_snapshot() or {}
+    db.replay_wal(data, db.wal_compacting_file)
+    db.replay_wal(data, db.wal_file)
+    with open(path, 'w', encoding='utf-8') as f:
+        json.dump(data, f, ensure_ascii=False, indent=2)
+    print(f"✅ Exported {len(data.get('user_stats', {}))} users -> {path}")
+
+def import_snapshot_json(path):
+    """python bot.py --import-json dump.json - новое поколение снимка в формате SNAPSHOT_FORMAT"""
+    with open(path, 'r', encoding='utf-8') as f:
+        data = json.load(f)
+    db.load_from_data(data)  # Иначе сохранение при выходе запишет старое состояние поверх
+    generation = db.write_snapshot_file(data)
+    print(f"✅ Imported {len(data.get('user_stats', {}))} users from {path} (generation {generation}, {SNAPSHOT_FORMAT})")
+
 if __name__ == "__main__":
+    if '--migrate-sqlite' in sys.argv:
+        migrate_json_to_sqlite()
+        sys.exit(0)
+    for flag, command in (('--export-json', export_snapshot_json), ('--import-json', import_snapshot_json)):
+        if flag in sys.argv:
+            command(sys.argv[sys.argv.index(flag) + 1])
+            sys.exit(0)
+    
     print("================================================")
     print("🤖 LUNA AI BOT - ULTRA STABLE EDITION")
     print("💖 Relationship levels: 4")
     print("🧠 AI: Context-Aware Responses") 
     print("🏆 Achievements: 8 to unlock")
     print("📝 Feedback: System ready")
-    print("🔒 STORAGE: ULTRA-RELIABLE (30s auto-save)")
+    print(f"🔒 STORAGE: ULTRA-RELIABLE ({SAVE_INTERVAL}s auto-save)")
     print("🌐 Host: Render")
     print("================================================")
     
-    total_users = len(db.get_all_users())
+    total_users = db.get_total_users()
     total_messages = db.get_total_messages()
     print(f"📊 Loaded: {total_users} users, {total_messages} messages")
     
@@ -1284,9 +4469,36 @@ if __name__ == "__main__":
     except Exception as e:
         print(f"❌ Database check failed: {e}")
     
+    if bot and (RUNTIME == 'asyncio' or '--asyncio' in sys.argv):
+        # 🆕 Flask остается в своем потоке, все остальное - на одном event loop
+        web_thread = Thread(target=run_web, daemon=True)
+        web_thread.start()
+        print("🌐 24/7 Web server started")
+        print("⚡ RUNTIME: asyncio (AsyncTeleBot + aiohttp)")
+        asyncio.run(run_async_bot())
+        sys.exit(0)
+    
+    if bot:
+        outbox.start(send_via_bot)
+        print(f"📤 Outbound queue started ({OUTBOX_RATE}/s, {OUTBOX_CHAT_INTERVAL}s per chat, {OUTBOX_SENDERS} senders)")
+    
     save_thread = Thread(target=auto_save_worker, daemon=True)
     save_thread.start()
-    print("💾 Auto-save started (every 30 seconds)")
+    print(f"💾 Auto-save started (every {SAVE_INTERVAL} seconds)")
+    
+    if db.storage_mode == 'wal':
+        compactor_thread = Thread(target=wal_compactor_worker, daemon=True)
+        compactor_thread.start()
+        print(f"🗜️ WAL compactor started (every {WAL_COMPACT_RECORDS} records / {WAL_COMPACT_INTERVAL}s)")
+    
+    if CONTEXT_SUMMARY != 'off':
+        summary_thread = Thread(target=summary_worker, daemon=True)
+        summary_thread.start()
+        print(f"🧠 Context summaries started ({CONTEXT_SUMMARY}, {SUMMARY_BATCH} turns per batch)")
+    
+    if bot and WEBHOOK_URL:
+        start_webhook()
+        sys.exit(0)
     
     web_thread = Thread(target=run_web, daemon=True)
     web_thread.start()
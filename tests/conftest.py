@@ -0,0 +1,28 @@
+import os
+import socket
+import sys
+import tempfile
+
+# bot.py настраивается переменными окружения и открывает данные при импорте:
+# задаем их заранее, а файлы бота пишутся во временную папку, не в репозиторий
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+DATA_DIR = tempfile.mkdtemp(prefix='luna-tests-')
+os.chdir(DATA_DIR)
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+STUB_AI_PORT = free_port()
+os.environ.pop('TELEGRAM_BOT_TOKEN', None)
+os.environ.pop('AI_TARGETS', None)
+os.environ['GROQ_API_KEY'] = 'test-key'
+os.environ['GROQ_API_URL'] = f'http://127.0.0.1:{STUB_AI_PORT}/chat/completions'
+
+
+def pytest_unconfigure(config):
+    os.chdir(DATA_DIR)  # Сохранение бота при выходе (atexit) - туда же
@@ -0,0 +1,32 @@
+import threading
+import time
+
+import bot
+
+
+def test_try_submit_rejects_when_full_and_submit_waits_for_a_slot():
+    dispatcher = bot.ChatDispatcher(workers=2, max_pending=2)
+    release = threading.Event()
+    done = []
+
+    def handler(tag):
+        release.wait(5)
+        done.append(tag)
+
+    assert dispatcher.try_submit(1, handler, 'a')
+    assert dispatcher.try_submit(1, handler, 'b')
+    assert not dispatcher.try_submit(2, handler, 'c')
+    assert dispatcher.get_stats()['rejected'] == 1
+
+    submitted = threading.Event()
+    waiter = threading.Thread(target=lambda: (dispatcher.submit(2, handler, 'd'), submitted.set()))
+    waiter.start()
+    assert not submitted.wait(0.2)  # Очередь полна - submit ждет
+    release.set()
+    assert submitted.wait(5)
+    waiter.join(5)
+    deadline = time.monotonic() + 5
+    while dispatcher.get_stats()['pending_updates'] and time.monotonic() < deadline:
+        time.sleep(0.01)
+    dispatcher.executor.shutdown(wait=True)
+    assert done.index('a') < done.index('b') and sorted(done) == ['a', 'b', 'd']  # Один чат - по порядку
@@ -0,0 +1,35 @@
+import pytest
+
+import bot
+
+
+@pytest.mark.parametrize('message, intent', [
+    ("goodnight", 'good_night'),
+    ("nite nite 💖", 'good_night'),
+    ("i'm so sleepy", 'good_night'),
+    ("sleeping now", 'good_night'),
+    ("byebye!", 'bye'),
+    ("bye-bye", 'bye'),
+    ("ok, going to bed, bye", 'good_night'),
+    ("what's up?", 'greeting'),
+    ("how are you", 'how_are_you'),
+    ("i don’t want to", 'refuse'),
+    # Целые слова: подстроки больше не срабатывают
+    ("i was thinking about it", 'default'),
+    ("a story about knights", 'default'),
+    ("this", 'default'),
+])
+def test_fallback_intents(message, intent):
+    assert bot.FALLBACK_ENGINE.classify(message) == intent
+
+
+@pytest.mark.parametrize('message, username, gender', [
+    ("hi", "alex_99", 'male'),
+    ("hi", "maxanna", 'male'),  # Мужские имена проверяются первыми
+    ("hey bro", "natalie", 'female'),
+    ("hey girl, bro", "", 'unknown'),
+    ("queen! sis", "cool_gamer", 'female'),
+    ("human", "", 'unknown'),
+])
+def test_detect_user_gender(message, username, gender):
+    assert bot.detect_user_gender(message, username) == gender
@@ -0,0 +1,60 @@
+import json
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+import bot
+from conftest import STUB_AI_PORT
+
+
+class ChatCompletionsStub(BaseHTTPRequestHandler):
+    """OpenAI-совместимый /chat/completions с keep-alive"""
+    protocol_version = 'HTTP/1.1'
+    requests_seen = []
+
+    def do_POST(self):
+        payload = json.loads(self.rfile.read(int(self.headers['Content-Length'])))
+        self.requests_seen.append((self.path, self.headers.get('Authorization'), payload))
+        body = json.dumps({
+            'choices': [{'message': {'role': 'assistant', 'content': f"stub reply {len(self.requests_seen)}"}}],
+            'usage': {'prompt_tokens': 10, 'completion_tokens': 3}
+        }).encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def stub_server():
+    server = ThreadingHTTPServer(('127.0.0.1', STUB_AI_PORT), ChatCompletionsStub)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield ChatCompletionsStub.requests_seen
+    server.shutdown()
+    server.server_close()
+
+
+def test_ai_requests_reuse_one_keepalive_connection(stub_server):
+    assert [target.url for target in bot.AI_TARGETS] == [bot.GROQ_API_URL]
+    _, level_info = bot.get_relationship_level(0)
+    before = bot.get_http_stats()
+
+    first = bot.get_ai_response("hello there", "", "dear", level_info, "Alice")
+    second = bot.get_ai_response("how was your day", "", "dear", level_info, "Alice")
+
+    assert (first, second) == ("stub reply 1", "stub reply 2")
+    stats = bot.get_http_stats()
+    assert stats['requests'] - before['requests'] == 2
+    assert stats['new_connections'] - before['new_connections'] == 1
+    assert stats['reused_connections'] - before['reused_connections'] == 1
+
+    path, authorization, payload = stub_server[0]
+    assert path == '/chat/completions'
+    assert authorization == 'Bearer test-key'
+    assert payload['messages'][-1] == {'role': 'user', 'content': 'hello there'}
@@ -0,0 +1,318 @@
+import datetime
+import json
+import os
+
+import pytest
+
+import bot
+
+
+@pytest.fixture
+def open_db(tmp_path, monkeypatch):
+    """Фабрика SimpleDatabase в пустой папке; повторный вызов = перезапуск бота на тех же файлах"""
+    monkeypatch.chdir(tmp_path)
+    opened = []
+
+    def open_db(mode='json', fmt='json'):
+        monkeypatch.setattr(bot, 'STORAGE_MODE', mode)
+        monkeypatch.setattr(bot, 'SNAPSHOT_FORMAT', fmt)
+        database = bot.SimpleDatabase()
+        opened.append(database)
+        return database
+
+    yield open_db
+    for database in opened:
+        close_db(database)
+
+
+def close_db(database):
+    if database.wal_handle is not None and not database.wal_handle.closed:
+        database.wal_handle.close()
+    if database.storage is not None:
+        database.storage.close()
+
+
+# bot_data.json в формате до WAL/SQLite/заголовков (indent=2, без заголовка)
+LEGACY_SNAPSHOT = {
+    'user_stats': {'7': {'message_count': 25, 'first_seen': '2024-04-01T09:00:00', 'last_seen': '2024-05-02T21:15:00',
+                         'current_level': 2, 'waiting_feedback': False}},
+    'user_gender': {'7': 'male'},
+    'user_context': {'7': [{'user': 'good night', 'bot': 'Sweet dreams! 🌙', 'time': '2024-05-02T21:15:00'}]},
+    'premium_users': {},
+    'user_achievements': {'7': {'unlocked': ['chatty', 'level_2'],
+                                'progress': {'messages_sent': 25, 'buttons_used': 2, 'different_buttons': ['help', 'status'],
+                                             'levels_reached': 2, 'days_active': 3}}},
+    'last_save': '2024-05-02T21:15:01',
+    'total_users': 1,
+    'total_messages': 25,
+    'save_type': 'regular'
+}
+
+
+def write_legacy_snapshot(path='bot_data.json'):
+    with open(path, 'w', encoding='utf-8') as f:
+        json.dump(LEGACY_SNAPSHOT, f, ensure_ascii=False, indent=2)
+
+
+def populate(database):
+    stats = database.get_user_stats(1)
+    stats['message_count'] = 12
+    database.update_user_stats(1, stats)
+    database.update_user_gender(1, 'female')
+    database.update_conversation_context(1, [
+        {'user': 'hi Luna', 'bot': 'Hey there! 💖', 'time': '2024-05-01T10:00:00'},
+        {'user': 'how are you?', 'bot': 'Great, thanks!', 'time': '2024-05-01T10:01:30'},
+    ])
+    database.unlock_achievement(1, 'chatty')
+
+    stats = database.get_user_stats(2)
+    stats['message_count'] = 3
+    database.update_user_stats(2, stats)
+    database.set_premium_status(2, 'vip')
+
+
+def state(database, user_ids=(1, 2)):
+    return {
+        user_id: (
+            database.get_user_stats(user_id),
+            database.get_user_gender(user_id),
+            [dict(turn) for turn in database.get_conversation_context(user_id)],
+            sorted(database.get_user_achievements(user_id)['unlocked']),
+            database.get_premium_data(user_id),
+        )
+        for user_id in user_ids
+    }
+
+
+def test_wal_replays_log_after_restart(open_db):
+    database = open_db('wal')
+    populate(database)
+    assert database.flush()
+    expected = state(database)
+    assert expected[1][3] == ['chatty'] and expected[2][4]['premium_type'] == 'vip'
+    close_db(database)
+
+    assert not os.path.exists('bot_data.json')  # Только журнал, снимка еще нет
+    restarted = open_db('wal')
+    assert state(restarted) == expected
+    assert restarted.get_total_messages() == 15
+
+
+def test_wal_compaction_and_torn_tail(open_db):
+    database = open_db('wal')
+    populate(database)
+    database.flush()
+    database.compact_wal()
+    assert os.path.exists('bot_data.json')
+    assert os.path.getsize('bot_data.wal') == 0
+
+    stats = database.get_user_stats(1)
+    stats['message_count'] = 13
+    database.update_user_stats(1, stats)
+    database.flush()
+    expected = state(database)
+    close_db(database)
+
+    with open('bot_data.wal', 'a', encoding='utf-8') as f:
+        f.write('{"u": "1", "stats": {"message_co')  # Падение посреди записи
+
+    restarted = open_db('wal')
+    assert state(restarted) == expected
+    assert restarted.get_total_messages() == 16
+
+
+def test_sqlite_migrates_json_snapshot(open_db):
+    database = open_db('json')
+    populate(database)
+    database.save_data()
+    expected = state(database)
+    close_db(database)
+
+    migrated = open_db('sqlite')
+    assert migrated.storage.count_users() == 2
+    assert state(migrated) == expected
+    assert migrated.get_total_messages() == 15
+    assert sorted(migrated.get_all_users()) == ['1', '2']
+
+
+def test_sqlite_migrates_legacy_json(open_db):
+    write_legacy_snapshot()
+
+    database = open_db('sqlite')
+    assert database.get_user_stats(7)['message_count'] == 25
+    assert database.get_user_gender(7) == 'male'
+    assert database.get_conversation_context(7)[0]['bot'] == 'Sweet dreams! 🌙'
+    achievements = database.get_user_achievements(7)
+    assert achievements['unlocked'] == ['chatty', 'level_2']
+    assert achievements['progress']['different_buttons'] == {'help', 'status'}
+    assert database.get_total_messages() == 25
+
+
+def test_sqlite_updates_only_changed_rows(open_db):
+    database = open_db('sqlite')
+    populate(database)
+    database.flush()
+    untouched = database.storage.conn.execute("SELECT stats, premium FROM users WHERE user_id = '2'").fetchone()
+
+    stats = database.get_user_stats(1)
+    stats['message_count'] = 40
+    database.update_user_stats(1, stats)
+    assert database.dirty_users == {'1'}
+    database.flush()
+    expected = state(database)
+    close_db(database)
+
+    restarted = open_db('sqlite')
+    assert restarted.storage.conn.execute("SELECT stats, premium FROM users WHERE user_id = '2'").fetchone() == untouched
+    assert restarted.storage.total_messages() == 43
+    assert restarted.get_total_messages() == 43
+    assert state(restarted) == expected
+
+
+def test_sqlite_lru_keeps_dirty_users_until_flushed(open_db, monkeypatch):
+    monkeypatch.setattr(bot, 'MAX_RESIDENT_USERS', 2)
+    database = open_db('sqlite')
+    for user_id in (1, 2, 3):
+        stats = database.get_user_stats(user_id)
+        stats['message_count'] = user_id * 10
+        database.update_user_stats(user_id, stats)
+
+    # Все трое изменены и не записаны: вытеснение их не выгружает и ничего не пишет
+    assert set(database.loaded_users) == {'1', '2', '3'}
+    assert database.get_cache_stats()['evictions'] == 0
+    assert database.storage.count_users() == 0
+    assert database.flush_event.is_set()
+
+    database.flush()
+    database.get_user_stats(4)  # Следующий промах догоняет лимит
+    assert len(database.loaded_users) == 2
+    assert database.get_cache_stats()['evictions'] == 2
+    assert [database.get_user_stats(user_id)['message_count'] for user_id in (1, 2, 3)] == [10, 20, 30]
+
+
+def save_generation(database, message_count):
+    stats = database.get_user_stats(1)
+    stats['message_count'] = message_count
+    database.update_user_stats(1, stats)
+    database.save_data()
+    return database.snapshot_generation
+
+
+def test_snapshot_header_and_generations(open_db):
+    database = open_db('json')
+    assert save_generation(database, 1) == 1
+    assert save_generation(database, 2) == 2
+
+    main = bot.SimpleDatabase.read_snapshot_header('bot_data.json')
+    backup = bot.SimpleDatabase.read_snapshot_header('bot_data_backup.json')
+    assert (main['gen'], main['fmt'], backup['gen']) == (2, 'json', 1)
+    assert os.path.getsize('bot_data.json') == main['offset'] + main['len']
+    assert not os.path.exists('bot_data.json.tmp')
+
+    # Новейшее целое поколение выигрывает, даже если оно оказалось в backup
+    os.replace('bot_data.json', 'swap')
+    os.replace('bot_data_backup.json', 'bot_data.json')
+    os.replace('swap', 'bot_data_backup.json')
+    restarted = open_db('json')
+    assert restarted.get_user_stats(1)['message_count'] == 2
+    assert save_generation(restarted, 3) == 3
+
+
+@pytest.mark.parametrize('damage', ['truncate', 'flip_byte', 'header'])
+def test_snapshot_recovers_from_damaged_main(open_db, damage):
+    database = open_db('json')
+    save_generation(database, 1)
+    save_generation(database, 2)
+
+    with open('bot_data.json', 'r+b') as f:
+        content = f.read()
+        f.seek(0)
+        if damage == 'truncate':
+            f.truncate(len(content) - 10)
+        elif damage == 'flip_byte':
+            f.seek(len(content) - 5)
+            f.write(bytes([content[-5] ^ 0xFF]))
+        else:
+            f.write(bot.SNAPSHOT_MAGIC + b' gen=oops')
+
+    restarted = open_db('json')
+    assert restarted.get_user_stats(1)['message_count'] == 1  # Из backup (поколение 1)
+    save_generation(restarted, 5)
+    # Битый основной файл не вытесняет в backup последнее целое поколение
+    header = bot.SimpleDatabase.read_snapshot_header('bot_data_backup.json')
+    backup = bot.SimpleDatabase.read_snapshot_payload('bot_data_backup.json', header)
+    assert (header['gen'], backup['user_stats']['1']['message_count']) == (1, 1)
+    assert open_db('json').get_user_stats(1)['message_count'] == 5
+
+
+def test_snapshot_loads_legacy_json_without_header(open_db):
+    write_legacy_snapshot()
+
+    database = open_db('json')
+    assert database.get_user_stats(7)['message_count'] == 25
+    assert database.get_user_achievements(7)['unlocked'] == ['chatty', 'level_2']
+
+    database.save_data()
+    header = bot.SimpleDatabase.read_snapshot_header('bot_data.json')
+    assert header['gen'] == 1 and header['sha256']
+    assert bot.SimpleDatabase.read_snapshot_header('bot_data_backup.json')['gen'] == 0  # Старый файл - целый, в backup
+
+
+def test_columnar_round_trip_keeps_odd_records():
+    data = {
+        'user_stats': {
+            '1': {'message_count': 12, 'first_seen': '2024-05-01T10:00:00', 'last_seen': '2024-05-01T10:01:30.250000',
+                  'current_level': 2, 'waiting_feedback': False},
+            '2': {'message_count': 3, 'first_seen': '2024-05-01', 'last_seen': '2024-05-01T10:00:00+03:00',
+                  'current_level': 1, 'waiting_feedback': True, 'note': 'extra key'},
+        },
+        'user_gender': {'1': 'female', '2': 'robot'},
+        'user_context': {
+            '1': [{'user': 'hi', 'bot': 'hello 💖', 'time': '2024-05-01T10:00:00'}],
+            '2': [{'user': 'a\x00b', 'bot': 'nul inside', 'time': '2024-05-01T10:00:00'}],
+        },
+        'premium_users': {'2': {'premium_type': 'vip', 'activated': '2024-05-01T10:00:00',
+                                'expires': '2024-05-31T10:00:00', 'features': ['ad_free', 'extended_memory']}},
+        'user_achievements': {'1': {'unlocked': ['chatty', 'not_in_table'],
+                                    'progress': {'messages_sent': 12, 'buttons_used': 0, 'different_buttons': [],
+                                                 'levels_reached': 2, 'days_active': 1}}},
+        'user_summary': {},
+        'last_save': '2024-05-01T10:02:00',
+        'save_type': 'regular',
+    }
+
+    payload = bot.ColumnarSnapshot.encode(data)
+    assert bot.ColumnarSnapshot.decode(payload) == data
+
+    records = bot.ColumnarSnapshot.decode(payload, records=True)
+    assert type(records['user_stats']['1']) is bot.UserStats and records['user_stats']['1'] == data['user_stats']['1']
+    assert records['user_stats']['2'] == data['user_stats']['2']  # Не по схеме - остается dict из JSON-хвоста
+    assert records['user_gender'] == {'1': bot.GENDER_CODES['female'], '2': 'robot'}
+    assert list(records['user_context']['1']) == data['user_context']['1']
+    assert records['premium_users']['2'] == data['premium_users']['2']
+    assert list(records['user_achievements']['1'].unlocked) == ['chatty', 'not_in_table']
+
+
+def test_columnar_decodes_straight_into_records(open_db):
+    database = open_db('json', 'columnar')
+    populate(database)
+    database.save_data()
+    expected = state(database)
+    assert bot.SimpleDatabase.read_snapshot_header('bot_data.json')['fmt'] == 'columnar'
+
+    restarted = open_db('json', 'json')  # Формат файла берется из заголовка
+    assert state(restarted) == expected
+    assert restarted.get_total_messages() == 15
+
+    stats = restarted.user_stats['1']
+    assert type(stats) is bot.UserStats and type(stats.first_seen) is int
+    turn = restarted.user_context['1'].ordered()[0]
+    assert type(turn) is bot.ContextTurn and type(turn.time) is int
+    assert restarted.user_achievements['1'].unlocked_mask == bot.ACHIEVEMENT_BITS['chatty']
+    assert restarted.user_gender['1'] == bot.GENDER_CODES['female']
+
+    with open('bot_data.json', 'rb') as f:
+        header = bot.SimpleDatabase.read_snapshot_header('bot_data.json')
+        f.seek(header['offset'])
+        raw = bot.ColumnarSnapshot.decode(f.read())
+    assert raw['user_stats']['1']['first_seen'] == expected[1][0]['first_seen']  # JSON-вид для экспорта - ISO-строки